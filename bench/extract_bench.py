@@ -0,0 +1,75 @@
+# 对比 tarfile.extractall 和 Extractor 解压大量小文件镜像的耗时
+# python3 bench/extract_bench.py --files 50000 --compression gz
+import argparse
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from container.extractor import Extractor
+
+
+def make_image(path, files, compression):
+    random.seed(0)
+    mode = "w" if compression == "none" else f"w:{compression}"
+    with tarfile.open(path, mode) as tar:
+        for i in range(files):
+            data = random.randbytes(random.randint(512, 8192))
+            info = tarfile.TarInfo(f"usr/share/d{i % 256:03d}/f{i}")
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            with tempfile.SpooledTemporaryFile() as f:
+                f.write(data)
+                f.seek(0)
+                tar.addfile(info, f)
+        # 一个 256M 的稀疏文件，检查 Extractor 不会把空洞写成真实的数据块
+        sparse = os.path.join(os.path.dirname(path), "sparse")
+        with open(sparse, "wb") as f:
+            f.truncate(256 << 20)
+            f.write(b"head")
+        tar.add(sparse, arcname="var/sparse")
+        os.remove(sparse)
+
+
+def extractall(image_path, dest):
+    with tarfile.open(image_path, "r") as tar:
+        tar.extractall(dest, filter="fully_trusted")
+
+
+def extractor(image_path, dest):
+    Extractor(dest).extract(image_path)
+
+
+def bench(func, image_path, work_dir, rounds):
+    timings = []
+    for _ in range(rounds):
+        dest = os.path.join(work_dir, "dest")
+        shutil.rmtree(dest, ignore_errors=True)
+        os.sync()
+        start = time.perf_counter()
+        func(image_path, dest)
+        timings.append(time.perf_counter() - start)
+    sparse_blocks = os.stat(os.path.join(dest, "var", "sparse")).st_blocks
+    shutil.rmtree(dest)
+    return min(timings), sparse_blocks * 512
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--compression", choices=["none", "gz", "xz"], default="gz")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_path = os.path.join(work_dir, "image.tar")
+        make_image(image_path, args.files, args.compression)
+        print(f"image: {args.files} files, {os.path.getsize(image_path)} bytes")
+        for name, func in [("extractall", extractall), ("Extractor", extractor)]:
+            seconds, disk = bench(func, image_path, work_dir, args.rounds)
+            print(f"{name:>10}: {seconds:.3f}s, sparse file uses {disk} bytes on disk")
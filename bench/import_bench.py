@@ -0,0 +1,102 @@
+# 检查命令行的启动开销：每个命令只能导入自己用到的模块，启动时间不能超过预算，超过时退出码为 1，
+# 可以放在提交前的检查中防止启动时间退化
+# python3 bench/import_bench.py --rounds 20 --max-ms 80
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+main_path = os.path.join(base_path, "main.py")
+# 只在特定命令中才需要的模块，出现在其他命令的启动过程中说明又被提前导入了
+forbidden = ["tabulate", "tarfile", "asyncio", "concurrent.futures", "ctypes.util"]
+# ps、stop 只读写状态数据库和 cgroup，网络、镜像层、日志、沙箱池这些模块都不应该加载
+heavy = [
+    "ipaddress",
+    "gzip",
+    "network.network",
+    "network.ipam",
+    "network.iptables",
+    "network.nftables",
+    "network.netlink",
+    "container.layer_store",
+    "container.logger",
+    "container.monitor",
+    "container.numa",
+    "container.pool",
+    "container.trash",
+]
+commands = [
+    (["--help"], forbidden + ["container.container", "network.network", "sqlite3"]),
+    (["ps", "-q"], forbidden + heavy),
+    (["stop", "--filter", "id=none"], forbidden + heavy),
+    (["network", "list"], forbidden + ["container.container", "sqlite3"]),
+]
+
+
+# 子进程退出时把 sys.modules 写到 stderr 的最后一行；-X importtime 看不到 importlib.import_module
+# 按需导入的模块，例如 network.network，所以直接看进程退出时加载了哪些模块
+probe = (
+    "import atexit, json, runpy, sys\n"
+    "atexit.register(lambda: print('modules:', json.dumps(sorted(sys.modules)), file=sys.stderr))\n"
+    "sys.argv = sys.argv[1:]\n"
+    "runpy.run_path(sys.argv[0], run_name='__main__')\n"
+)
+
+
+def imported_modules(args):
+    result = subprocess.run(
+        [sys.executable, "-c", probe, main_path, *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=dict(os.environ, MYDOCKER_NO_DAEMON="1"),
+    )
+    for line in reversed(result.stderr.splitlines()):
+        if line.startswith("modules: "):
+            return set(json.loads(line[len("modules: ") :]))
+    return set()
+
+
+def startup_time(args, rounds):
+    # args 为 None 时测量空解释器
+    cmd = (
+        [sys.executable, "-c", "pass"]
+        if args is None
+        else [sys.executable, main_path, *args]
+    )
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=dict(os.environ, MYDOCKER_NO_DAEMON="1"),
+        )
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, help="fail if a command is slower")
+    args = parser.parse_args()
+    # 空解释器的启动时间作为基线，命令的开销是两者之差
+    interpreter = startup_time(None, args.rounds)
+    print(f"{'python -c pass':>21}: {interpreter:.1f}ms")
+    failed = False
+    for command, modules in commands:
+        imported = imported_modules(command)
+        unexpected = [module for module in modules if module in imported]
+        elapsed = startup_time(command, args.rounds)
+        print(
+            f"{' '.join(command):>21}: {elapsed:.1f}ms, {len(imported)} modules"
+            + (f", unexpected imports: {', '.join(unexpected)}" if unexpected else "")
+        )
+        if unexpected or (args.max_ms is not None and elapsed > args.max_ms):
+            failed = True
+    sys.exit(1 if failed else 0)
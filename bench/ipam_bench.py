@@ -0,0 +1,51 @@
+# 分配一个子网中的全部地址（默认 /16，共 65534 个），统计每次 allocate 的耗时，
+# 每次分配都包含加锁、读取、写回 subnet.json，和命令行中 run -net 的开销一致
+# python3 bench/ipam_bench.py --subnet 10.0.0.0/16
+import argparse
+import ipaddress
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network.ipam import IPAM
+
+
+def report(name, timings):
+    timings = sorted(t * 1000 for t in timings)
+    p99 = timings[int(len(timings) * 0.99) - 1 if len(timings) > 1 else 0]
+    print(
+        f"{name:>10}: {len(timings)} ops in {sum(timings) / 1000:.2f}s, "
+        f"mean {statistics.mean(timings):.3f}ms, "
+        f"p50 {statistics.median(timings):.3f}ms, p99 {p99:.3f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subnet", default="10.0.0.0/16")
+    args = parser.parse_args()
+    subnet = ipaddress.ip_network(args.subnet)
+    with tempfile.TemporaryDirectory() as tmp:
+        ipam = IPAM(os.path.join(tmp, "subnet.json"))
+        allocated = set()
+        timings = []
+        while True:
+            start = time.perf_counter()
+            ip_interface = ipam.allocate(subnet)
+            timings.append(time.perf_counter() - start)
+            if ip_interface is None:
+                timings.pop()
+                break
+            allocated.add(ip_interface.ip)
+        assert allocated == set(subnet.hosts()), "allocated addresses mismatch"
+        report("allocate", timings)
+        timings = []
+        for ip in list(allocated)[:1000]:
+            start = time.perf_counter()
+            assert ipam.release(subnet, str(ip))
+            timings.append(time.perf_counter() - start)
+        report("release", timings)
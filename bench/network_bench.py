@@ -0,0 +1,80 @@
+# 对比 netlink 和 ip 命令两种后端连接容器网络的耗时，需要 root 权限
+# 建议在独立的 net namespace 中运行，避免影响宿主机网络：
+# unshare -n python3 bench/network_bench.py --rounds 50
+import argparse
+import ipaddress
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network.bridge_network_driver import BridgeNetworkDriver
+from network.netlink import link_backend
+from network.network import Network
+
+bridge_name = "benchbr"
+subnet = ipaddress.ip_network("10.250.0.0/16")
+gateway = ipaddress.ip_interface("10.250.0.1/16")
+
+
+def connect(container_id, pid, ip_interface):
+    endpoint = {"ID": container_id, "IPINTERFACE": ip_interface}
+    BridgeNetworkDriver.connect({"NAME": bridge_name}, endpoint)
+    Network.config_endpoint_ip_address_and_route(
+        {"IP": str(gateway.ip)}, endpoint, {"PID": pid}
+    )
+    return endpoint
+
+
+def bench(backend, rounds):
+    os.environ["MYDOCKER_NET_BACKEND"] = backend
+    connect_timings = []
+    disconnect_timings = []
+    for i in range(rounds):
+        # 用一个新的 net namespace 里的 sleep 进程模拟容器
+        container = subprocess.Popen(["unshare", "-n", "sleep", "60"])
+        while os.readlink(f"/proc/{container.pid}/ns/net") == os.readlink(
+            "/proc/self/ns/net"
+        ):
+            time.sleep(0.001)
+        container_id = f"{i:05d}"
+        ip_interface = ipaddress.ip_interface(f"{subnet[i + 2]}/{subnet.prefixlen}")
+        start = time.perf_counter()
+        endpoint = connect(container_id, container.pid, ip_interface)
+        connect_timings.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        BridgeNetworkDriver.disconnect({"NAME": bridge_name}, endpoint)
+        disconnect_timings.append(time.perf_counter() - start)
+        container.kill()
+        container.wait()
+    return connect_timings, disconnect_timings
+
+
+def report(name, timings):
+    timings = sorted(t * 1000 for t in timings)
+    p95 = timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0]
+    print(
+        f"{name:>20}: mean {statistics.mean(timings):.2f}ms, "
+        f"p50 {statistics.median(timings):.2f}ms, p95 {p95:.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    link = link_backend()
+    link.link_add_bridge(bridge_name)
+    link.addr_add(bridge_name, gateway)
+    link.link_set_up(bridge_name)
+    link.close()
+    try:
+        for backend in ["ip", "netlink"]:
+            connect_timings, disconnect_timings = bench(backend, args.rounds)
+            report(f"{backend} connect", connect_timings)
+            report(f"{backend} disconnect", disconnect_timings)
+    finally:
+        BridgeNetworkDriver.delete(bridge_name)
@@ -0,0 +1,544 @@
+# 容器生命周期各个操作的基准测试，在 1..64 的并发下统计 p50/p95/p99 和吞吐量，结果保存为 json 方便在提交之间对比
+# 不需要 root 的微基准（IPAM、状态数据库、ps、日志 tail）在临时目录中运行，不影响已有的容器：
+# python3 bench/suite.py --suite micro --output bench-micro.json
+# 端到端的基准（run 到容器执行第一条指令、ps、commit、stop、rm、网络 connect/disconnect）需要 root，
+# 使用本地的 images/busybox.tar，不需要外部网络；网络基准在独立的 net namespace 中运行：
+# sudo python3 bench/suite.py --suite e2e --concurrency 1,4,16 --ops 32 --compare bench-old.json
+import argparse
+import ipaddress
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timezone
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(bench_path)
+sys.path.insert(0, base_path)
+sys.path.insert(0, bench_path)
+
+import network_bench
+from container.container import Container, images_path
+from container.logger import LogReader
+from container.state_store import StateStore
+from network.bridge_network_driver import BridgeNetworkDriver
+from network.ipam import IPAM
+from network.netlink import link_backend
+from utility import format_table
+
+main_path = os.path.join(base_path, "main.py")
+
+
+class Benchmark:
+    # 每个基准在父进程中 setup，fork 出 concurrency 个工作进程并发执行 op，index 在所有工作进程之间唯一；
+    # op 的返回值按 index 收集回父进程，后面的阶段（例如 stop 用 run 得到的 ID）可以继续使用
+    name = None
+
+    def setup(self, ops):
+        pass
+
+    def worker_setup(self):
+        # fork 之后在工作进程中调用，例如重新打开数据库连接
+        pass
+
+    def op(self, index):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+def percentile(timings, p):
+    # 最近秩法，timings 已经排好序
+    return timings[max(math.ceil(p * len(timings)) - 1, 0)]
+
+
+def run_level(benchmark, concurrency, ops):
+    # 所有工作进程 fork 完成后同时关闭起跑管道，工作进程读到 EOF 后开始计时，
+    # 每个工作进程把 [(index, 耗时, 返回值)] 以 json 写回结果管道
+    benchmark.setup(ops)
+    gate_r, gate_w = os.pipe()
+    workers = []
+    for worker in range(concurrency):
+        indexes = list(range(worker, ops, concurrency))
+        if not indexes:
+            break
+        result_r, result_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(gate_w)
+                os.close(result_r)
+                benchmark.worker_setup()
+                os.read(gate_r, 1)
+                results = []
+                for index in indexes:
+                    start = time.perf_counter()
+                    value = benchmark.op(index)
+                    results.append((index, time.perf_counter() - start, value))
+                with os.fdopen(result_w, "w") as f:
+                    json.dump(results, f)
+                code = 0
+            except BaseException:
+                # os._exit 不会打印异常，这里先打印出来
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        os.close(result_w)
+        workers.append((pid, result_r))
+    os.close(gate_r)
+    start = time.perf_counter()
+    os.close(gate_w)
+    timings = []
+    values = {}
+    failed = 0
+    for pid, result_r in workers:
+        with os.fdopen(result_r) as f:
+            content = f.read()
+        _, status = os.waitpid(pid, 0)
+        if status != 0 or not content:
+            failed += 1
+            continue
+        for index, seconds, value in json.loads(content):
+            timings.append(seconds)
+            values[index] = value
+    wall = time.perf_counter() - start
+    benchmark.teardown()
+    if failed:
+        print(f"{benchmark.name}: {failed} of {len(workers)} workers failed")
+    return summarize(benchmark.name, concurrency, timings, wall), values
+
+
+def summarize(name, concurrency, timings, wall):
+    timings = sorted(t * 1000 for t in timings)
+    result = {"name": name, "concurrency": concurrency, "ops": len(timings)}
+    if timings:
+        result.update(
+            {
+                "mean": sum(timings) / len(timings),
+                "p50": percentile(timings, 0.5),
+                "p95": percentile(timings, 0.95),
+                "p99": percentile(timings, 0.99),
+                "throughput": len(timings) / wall if wall > 0 else 0,
+            }
+        )
+    return result
+
+
+def quiet():
+    # 被测函数会往标准输出打印表格或者日志，工作进程中丢弃
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+
+class IpamAllocate(Benchmark):
+    name = "ipam.allocate"
+
+    def __init__(self, work_dir):
+        self.path = os.path.join(work_dir, "subnet.json")
+        self.subnet = ipaddress.ip_network("10.0.0.0/16")
+
+    def setup(self, ops):
+        for path in [self.path, self.path + ".lock"]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.ipam = IPAM(self.path)
+
+    def op(self, index):
+        return str(self.ipam.allocate(self.subnet).ip)
+
+
+class IpamRelease(IpamAllocate):
+    name = "ipam.release"
+
+    def setup(self, ops):
+        super().setup(ops)
+        self.ips = [str(self.ipam.allocate(self.subnet).ip) for _ in range(ops)]
+
+    def op(self, index):
+        return self.ipam.release(self.subnet, self.ips[index])
+
+
+class StateUpdate(Benchmark):
+    # 每次更新都是一个 BEGIN IMMEDIATE 事务，并发时测的是写锁的争用
+    name = "state.update"
+
+    def __init__(self, work_dir, containers):
+        self.path = os.path.join(work_dir, "state.db")
+        self.containers = containers
+
+    def setup(self, ops):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        store = StateStore(self.path)
+        with store.transaction():
+            for i in range(self.containers):
+                store.put(
+                    f"{i:010d}",
+                    {
+                        "ID": f"{i:010d}",
+                        "PID": "",
+                        "COMMAND": "/bin/sh",
+                        "CREATE_TIME": "2024-01-01 00:00:00",
+                        "STATUS": "exited",
+                        "NAME": f"bench{i}",
+                    },
+                )
+        store.conn.close()
+
+    def worker_setup(self):
+        self.store = StateStore(self.path)
+
+    def op(self, index):
+        self.store.update(f"{index % self.containers:010d}", {"LAST_EVENT": index})
+
+
+class Ps(StateUpdate):
+    # Container.ps 的完整路径：读取全部容器、检查进程状态、格式化表格
+    name = "ps"
+
+    def worker_setup(self):
+        quiet()
+        Container._state_store = StateStore(self.path)
+        Container._state_pid = os.getpid()
+
+    def op(self, index):
+        Container.ps()
+
+
+class LogTail(Benchmark):
+    name = "logs.tail"
+
+    def __init__(self, work_dir, lines):
+        self.path = os.path.join(work_dir, "bench-json.log")
+        with open(self.path, "w") as f:
+            for i in range(lines):
+                f.write(
+                    json.dumps(
+                        {
+                            "log": f"line {i} " + "x" * 80 + "\n",
+                            "stream": "stdout",
+                            "time": "2024-01-01T00:00:00.000000+00:00",
+                        }
+                    )
+                    + "\n"
+                )
+
+    def worker_setup(self):
+        quiet()
+
+    def op(self, index):
+        LogReader(self.path).print(tail=100)
+
+
+def mydocker(*args):
+    result = subprocess.run(
+        [sys.executable, main_path, *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise Exception(f"mydocker {' '.join(args)} failed: {result.stdout}")
+    return result.stdout
+
+
+class Run(Benchmark):
+    # 从执行 mydocker run 到容器中的命令输出第一行日志的时间，
+    # 日志由 json-file 驱动的 shim 写入，这里每 0.5ms 检查一次
+    name = "run"
+
+    def __init__(self, image_name):
+        self.image_name = image_name
+
+    def op(self, index):
+        output = mydocker(
+            "run",
+            "-d",
+            "-name",
+            f"bench{index}",
+            self.image_name,
+            "/bin/sh",
+            "-c",
+            "echo ready; exec sleep 3600",
+        )
+        container_id = output.split("container_id: ")[1].split()[0]
+        log_path = Container.log_path(container_id)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                with open(log_path, "rb") as f:
+                    if b"ready" in f.read():
+                        return container_id
+            except FileNotFoundError:
+                pass
+            time.sleep(0.0005)
+        raise Exception(f"container {container_id} did not start")
+
+
+class Command(Benchmark):
+    # 对 run 得到的每个容器执行一次 mydocker 命令
+    def __init__(self, name, args, ids):
+        self.name = name
+        self.args = args
+        self.ids = ids
+
+    def op(self, index):
+        mydocker(*[arg.format(id=self.ids[index], index=index) for arg in self.args])
+
+
+class PsCommand(Benchmark):
+    # 有 N 个容器在运行时 mydocker ps 的耗时，包括解释器启动
+    name = "ps.cli"
+
+    def op(self, index):
+        mydocker("ps")
+
+
+class NetworkConnect(Benchmark):
+    # 只在 net namespace 中运行，用 unshare -n 的 sleep 进程模拟容器
+    name = "network.connect"
+
+    def setup(self, ops):
+        self.sleepers = [
+            subprocess.Popen(["unshare", "-n", "sleep", "600"]) for _ in range(ops)
+        ]
+        for sleeper in self.sleepers:
+            while os.readlink(f"/proc/{sleeper.pid}/ns/net") == os.readlink(
+                "/proc/self/ns/net"
+            ):
+                time.sleep(0.001)
+
+    @staticmethod
+    def endpoint(index):
+        return {
+            "ID": f"{index:05d}",
+            "IPINTERFACE": ipaddress.ip_interface(
+                f"{network_bench.subnet[index + 2]}/{network_bench.subnet.prefixlen}"
+            ),
+        }
+
+    def connect(self, index):
+        endpoint = NetworkConnect.endpoint(index)
+        network_bench.connect(
+            endpoint["ID"], self.sleepers[index].pid, endpoint["IPINTERFACE"]
+        )
+
+    @staticmethod
+    def disconnect(index):
+        BridgeNetworkDriver.disconnect(
+            {"NAME": network_bench.bridge_name}, NetworkConnect.endpoint(index)
+        )
+
+    def op(self, index):
+        self.connect(index)
+
+    def teardown(self):
+        # 容器一端的 veth 在 sleep 进程的 net namespace 中，进程退出后整对 veth 都会被删除
+        for sleeper in self.sleepers:
+            sleeper.kill()
+            sleeper.wait()
+
+
+class NetworkDisconnect(NetworkConnect):
+    name = "network.disconnect"
+
+    def setup(self, ops):
+        super().setup(ops)
+        for index in range(ops):
+            self.connect(index)
+
+    def op(self, index):
+        NetworkConnect.disconnect(index)
+
+
+def micro(args, levels, work_dir):
+    results = []
+    benchmarks = [
+        IpamAllocate(work_dir),
+        IpamRelease(work_dir),
+        StateUpdate(work_dir, args.containers),
+        Ps(work_dir, args.containers),
+        LogTail(work_dir, args.log_lines),
+    ]
+    for benchmark in benchmarks:
+        for concurrency in levels:
+            result, _ = run_level(benchmark, concurrency, max(args.ops, concurrency))
+            results.append(result)
+            report(result)
+    return results
+
+
+def e2e(args, levels):
+    if os.geteuid() != 0:
+        print("end-to-end benchmarks require root")
+        sys.exit(1)
+    if not any(
+        os.path.exists(os.path.join(images_path, args.image + suffix))
+        for suffix in ["", ".tar", ".json"]
+    ):
+        print(f"image {args.image} not found in {images_path}")
+        sys.exit(1)
+    results = []
+    for concurrency in levels:
+        ops = max(args.ops, concurrency)
+        # 一个并发级别内按生命周期的顺序执行：run N 个容器 -> ps -> commit -> stop -> rm
+        result, ids = run_level(Run(args.image), concurrency, ops)
+        stages = [(result, None)]
+        stages.append(run_level(PsCommand(), concurrency, ops))
+        stages.append(
+            run_level(
+                Command("commit", ["commit", "{id}", "bench-commit-{index}"], ids),
+                concurrency,
+                ops,
+            )
+        )
+        stages.append(
+            run_level(Command("stop", ["stop", "{id}"], ids), concurrency, ops)
+        )
+        stages.append(run_level(Command("rm", ["rm", "{id}"], ids), concurrency, ops))
+        for result, _ in stages:
+            results.append(result)
+            report(result)
+        remove_committed_images(ops)
+    results.extend(network(levels, args.ops))
+    return results
+
+
+def remove_committed_images(ops):
+    # commit 产生的镜像清单删掉，新层的 blob 按摘要命名，留给之后的 commit 复用
+    for index in range(ops):
+        path = os.path.join(images_path, f"bench-commit-{index}.json")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def network(levels, ops):
+    # 在子进程中创建新的 net namespace，网桥和 veth 不会出现在宿主机上
+    result_r, result_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.close(result_r)
+            os.unshare(os.CLONE_NEWNET)
+            link = link_backend()
+            link.link_add_bridge(network_bench.bridge_name)
+            link.addr_add(network_bench.bridge_name, network_bench.gateway)
+            link.link_set_up(network_bench.bridge_name)
+            link.close()
+            results = []
+            for concurrency in levels:
+                for benchmark in [NetworkConnect(), NetworkDisconnect()]:
+                    result, _ = run_level(benchmark, concurrency, max(ops, concurrency))
+                    results.append(result)
+                    report(result)
+            BridgeNetworkDriver.delete(network_bench.bridge_name)
+            with os.fdopen(result_w, "w") as f:
+                json.dump(results, f)
+            code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+    os.close(result_w)
+    with os.fdopen(result_r) as f:
+        content = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(content) if content else []
+
+
+def report(result):
+    if result["ops"] == 0:
+        print(f"{result['name']:>20} c={result['concurrency']:<3} failed")
+        return
+    print(
+        f"{result['name']:>20} c={result['concurrency']:<3} "
+        f"p50 {result['p50']:.3f}ms, p95 {result['p95']:.3f}ms, "
+        f"p99 {result['p99']:.3f}ms, {result['throughput']:.1f} ops/s",
+        flush=True,
+    )
+
+
+def compare(results, baseline_path):
+    # 按 (name, concurrency) 对比 p50、p99 和吞吐量，百分比为相对基线的变化
+    with open(baseline_path) as f:
+        baseline = {
+            (result["name"], result["concurrency"]): result
+            for result in json.load(f)["results"]
+        }
+    data = []
+    for result in results:
+        old = baseline.get((result["name"], result["concurrency"]))
+        if old is None or not old["ops"] or not result["ops"]:
+            continue
+        row = [result["name"], str(result["concurrency"])]
+        for key in ["p50", "p99", "throughput"]:
+            change = (result[key] - old[key]) / old[key] * 100 if old[key] else 0
+            row.append(f"{old[key]:.3f} -> {result[key]:.3f} ({change:+.1f}%)")
+        data.append(row)
+    print(format_table(data, ["BENCHMARK", "C", "P50(ms)", "P99(ms)", "OPS/S"]))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "-C", base_path, "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suite", choices=["micro", "e2e", "all"], default="micro")
+    parser.add_argument(
+        "--concurrency",
+        default="1,2,4,8,16,32,64",
+        help="comma separated concurrency levels",
+    )
+    parser.add_argument(
+        "--ops", type=int, default=64, help="operations per benchmark and level"
+    )
+    parser.add_argument(
+        "--containers", type=int, default=1000, help="containers in the state store"
+    )
+    parser.add_argument("--log-lines", type=int, default=200000)
+    parser.add_argument("--image", default="busybox.tar")
+    parser.add_argument("--output", help="save results as json")
+    parser.add_argument("--compare", help="compare with results saved by --output")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(",")]
+    results = []
+    if args.suite in ["micro", "all"]:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results.extend(micro(args, levels, work_dir))
+    if args.suite in ["e2e", "all"]:
+        results.extend(e2e(args, levels))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "cpus": os.cpu_count(),
+                    "args": vars(args),
+                    "results": results,
+                },
+                f,
+                indent=4,
+            )
+    if args.compare:
+        compare(results, args.compare)
@@ -1,2 +1,13 @@
-from .cgroup_manager import CgroupManager
-from .container import Container
+import importlib
+
+# 按需导入，main.py 一次只执行一个子命令，用不到的模块不加载
+lazy_imports = {
+    "CgroupManager": ".cgroup_manager",
+    "Container": ".container",
+}
+
+
+def __getattr__(name):
+    if name in lazy_imports:
+        return getattr(importlib.import_module(lazy_imports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
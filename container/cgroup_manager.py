@@ -1,34 +1,163 @@
-import subprocess
+import os
+import stat
+import sys
+
+from tracing import traced
+from utility import CGROUP2_SUPER_MAGIC, parse_size, statfs_type
+
+cgroup_root = "/sys/fs/cgroup"
 
 
 class CgroupManager:
+    # 进程内只检测一次 cgroup 版本
+    cgroup_version = None
+
     def __init__(self, cgroup_path) -> None:
-        # stat -fc %T /sys/fs/cgroup/ 如果输出是cgroup2fs 那就是v2; 如果输出是tmpfs 那就是v1
+        # /sys/fs/cgroup/ 的文件系统类型如果是 cgroup2 那就是v2; 如果是tmpfs 那就是v1
         # 如果宿主机是WSL2, 在/etc/wsl.conf加上
         # [boot]
         # systemd=true
         self.cgroup_path = cgroup_path
-        cgroup_version = (
-            subprocess.check_output("stat -fc %T /sys/fs/cgroup/", shell=True)
-            .decode()
-            .strip()
-        )
-        if cgroup_version == "cgroup2fs":
-            self.cgroup_version = 2
-            from .cgroups2 import CpusetSubSystem, CpuSubsystem, MemorySubsystem
+        if CgroupManager.cgroup_version is None:
+            CgroupManager.cgroup_version = (
+                2 if statfs_type(cgroup_root) == CGROUP2_SUPER_MAGIC else 1
+            )
+        self.cgroup_version = CgroupManager.cgroup_version
+        if self.cgroup_version == 2:
+            from .cgroups2 import (
+                CpusetSubSystem,
+                CpuSubsystem,
+                IoSubsystem,
+                MemorySubsystem,
+                PidsSubsystem,
+            )
+
+            accounting = [PidsSubsystem(), IoSubsystem()]
         else:
-            self.cgroup_version = 1
-            from .cgroups1 import CpusetSubSystem, CpuSubsystem, MemorySubsystem
-        self.subsystems = [CpuSubsystem(), MemorySubsystem(), CpusetSubSystem()]
+            from .cgroups1 import (
+                BlkioSubsystem,
+                CpuacctSubsystem,
+                CpusetSubSystem,
+                CpuSubsystem,
+                MemorySubsystem,
+                PidsSubsystem,
+            )
+
+            accounting = [CpuacctSubsystem(), PidsSubsystem(), BlkioSubsystem()]
+        # cgroup v1 中没有挂载的子系统跳过，设置了由它负责的限制时在 validate 中报错
+        self.subsystems = [CpuSubsystem(), MemorySubsystem(), CpusetSubSystem()] + [
+            sub for sub in accounting if sub.available()
+        ]
+        self.unavailable = [sub for sub in accounting if not sub.available()]
+
+    def validate(self, resource_config):
+        # 在启动容器之前检查并规范化资源限制，避免进程已经创建了才发现限制写不进去
+        config = dict(resource_config)
+        try:
+            if config.get("cpu") is not None:
+                config["cpu"] = float(config["cpu"])
+                if config["cpu"] <= 0:
+                    raise ValueError("cpu must be greater than 0")
+            for key in ["mem", "mem_high"]:
+                if config.get(key) is not None:
+                    config[key] = parse_size(config[key])
+            for key, low, high in [
+                ("cpu_weight", 1, 10000),
+                ("io_weight", 1, 10000),
+                ("cpu_burst", 0, None),
+                ("pids", 1, None),
+            ]:
+                if config.get(key) is None:
+                    continue
+                config[key] = int(config[key])
+                if config[key] < low or (high is not None and config[key] > high):
+                    raise ValueError(
+                        f"{key} must be between {low} and {high}"
+                        if high is not None
+                        else f"{key} must be at least {low}"
+                    )
+            # 内核要求可以累积的突发配额不超过每个周期的配额
+            if config.get("cpu_burst") and config.get("cpu"):
+                if config["cpu_burst"] > config["cpu"] * 100000:
+                    raise ValueError("cpu_burst must not exceed the cpu quota")
+            config["io_max"] = CgroupManager.parse_io_max(config)
+        except (ValueError, OSError) as e:
+            print(f"invalid resource config: {e}")
+            sys.exit(1)
+        for sub in self.unavailable:
+            for key in sub.options:
+                if config.get(key):
+                    print(f"{key} requires the {sub.subsystem_name} cgroup controller")
+                    sys.exit(1)
+        for sub in self.subsystems:
+            error = sub.validate(config)
+            if error:
+                print(error)
+                sys.exit(1)
+        return config
 
+    @staticmethod
+    def parse_io_max(resource_config):
+        # -device-read-bps /dev/sda:10m 转换成 {"8:0": {"rbps": 10485760}}
+        io_max = {}
+        for key, field in [
+            ("device_read_bps", "rbps"),
+            ("device_write_bps", "wbps"),
+            ("device_read_iops", "riops"),
+            ("device_write_iops", "wiops"),
+        ]:
+            for limit in resource_config.get(key) or []:
+                path, _, value = limit.rpartition(":")
+                st = os.stat(path)
+                if not stat.S_ISBLK(st.st_mode):
+                    raise ValueError(f"{path} is not a block device")
+                device = f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+                value = parse_size(value) if field.endswith("bps") else int(value)
+                io_max.setdefault(device, {})[field] = value
+        return io_max
+
+    @staticmethod
+    def list_cgroups():
+        # 每个容器的 cgroup 直接建在各个层级的根目录下，目录名就是容器 ID
+        names = set()
+        for sub in CgroupManager("").subsystems:
+            root = sub.get_cgroup_path("", False)
+            names.update(entry.name for entry in os.scandir(root) if entry.is_dir())
+        return names
+
+    @traced("CgroupManager.set")
     def set(self, resource_config):
         for sub in self.subsystems:
             sub.set(self.cgroup_path, resource_config)
 
+    @traced("CgroupManager.apply")
     def apply(self, pid):
+        # cgroup v2 中所有子系统是同一个目录，同一个目录只需要写一次
+        applied = set()
         for sub in self.subsystems:
-            sub.apply(self.cgroup_path, pid)
+            path = sub.get_cgroup_path(self.cgroup_path, False)
+            if path in applied:
+                continue
+            if sub.apply(self.cgroup_path, pid):
+                applied.add(path)
 
     def remove(self):
+        removed = set()
         for sub in self.subsystems:
+            path = sub.get_cgroup_path(self.cgroup_path, False)
+            if path in removed:
+                sub.close(self.cgroup_path)
+                continue
+            removed.add(path)
             sub.remove(self.cgroup_path)
+
+    def close(self):
+        for sub in self.subsystems:
+            sub.close(self.cgroup_path)
+
+    def stat(self):
+        # 合并各个子系统的统计: cpu_usage(ns)、mem_usage、mem_peak、mem_limit、pids、io_read、io_write
+        stat = {}
+        for sub in self.subsystems:
+            stat.update(sub.stat(self.cgroup_path))
+        return stat
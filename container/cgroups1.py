@@ -3,36 +3,71 @@ import sys
 
 
 class Subsystem:
+    # 子系统名 -> 挂载点，只解析一次 /proc/self/mountinfo
+    mount_points = None
+    # 为 true 时总是创建 cgroup 并加入进程，stats 才能统计资源使用
+    account = False
+    # 由这个子系统负责的资源限制，子系统没有挂载时不能设置
+    options = []
+
     def __init__(self) -> None:
-        pass
+        # cgroup 目录的 fd，之后的读写都通过 dir_fd 进行，不用每次解析完整路径
+        self.dir_fds = {}
+        # stats 读取的统计文件的 fd
+        self.file_fds = {}
 
     def set(self, cgroup_path, resource_config):
         pass
 
+    def validate(self, resource_config):
+        # 检查当前系统是否支持设置的限制，不支持时返回错误信息
+        return None
+
     def apply(self, cgroup_path, pid):
-        path = os.path.join(self.get_cgroup_path(cgroup_path, False), "tasks")
-        if not os.path.exists(path):
-            return
-        with open(path, "w") as f:
-            f.write(str(pid))
+        # 需要统计资源使用的子系统总是创建 cgroup，其他的只有设置过限制才加入
+        path = self.get_cgroup_path(cgroup_path, self.account)
+        if cgroup_path not in self.dir_fds and not os.path.isdir(path):
+            return False
+        self.write(cgroup_path, "tasks", pid)
+        return True
 
     def remove(self, cgroup_path):
+        self.close(cgroup_path)
         path = self.get_cgroup_path(cgroup_path, False)
         if os.path.exists(path):
             os.rmdir(path)
 
-    def get_cgroup_path(self, cgroup_path, auto_create=True):
-        res_path = None
+    def close(self, cgroup_path):
+        for key in [key for key in self.file_fds if key[0] == cgroup_path]:
+            os.close(self.file_fds.pop(key))
+        if cgroup_path in self.dir_fds:
+            os.close(self.dir_fds.pop(cgroup_path))
+
+    @staticmethod
+    def load_mount_points():
+        # mountinfo 每一行: ID 父ID 设备号 root 挂载点 挂载选项 [可选字段...] - 文件系统类型 源 超级块选项
+        # cgroup v1 的超级块选项中包含挂载的子系统，例如 rw,cpu,cpuacct
+        mount_points = {}
         mount_point_index = 4
         with open("/proc/self/mountinfo") as f:
             for line in f:
                 fields = line.split()
-                subsystems = fields[-1].split(",")
-                if self.subsystem_name in subsystems:
-                    res_path = fields[mount_point_index]
-                    break
-                if res_path is not None:
-                    break
+                separator = fields.index("-")
+                if fields[separator + 1] != "cgroup":
+                    continue
+                for subsystem in fields[-1].split(","):
+                    mount_points.setdefault(subsystem, fields[mount_point_index])
+        return mount_points
+
+    def available(self):
+        if Subsystem.mount_points is None:
+            Subsystem.mount_points = Subsystem.load_mount_points()
+        return self.subsystem_name in Subsystem.mount_points
+
+    def get_cgroup_path(self, cgroup_path, auto_create=True):
+        if Subsystem.mount_points is None:
+            Subsystem.mount_points = Subsystem.load_mount_points()
+        res_path = Subsystem.mount_points.get(self.subsystem_name)
         if res_path is None:
             print(f"Failed to find cgroup {self.subsystem_name}")
             sys.exit(1)
@@ -41,6 +76,51 @@ class Subsystem:
             os.makedirs(res_path, mode=0o755, exist_ok=True)
         return res_path
 
+    def get_cgroup_dir_fd(self, cgroup_path, auto_create=True):
+        if cgroup_path not in self.dir_fds:
+            self.dir_fds[cgroup_path] = os.open(
+                self.get_cgroup_path(cgroup_path, auto_create),
+                os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC,
+            )
+        return self.dir_fds[cgroup_path]
+
+    def write(self, cgroup_path, name, value):
+        fd = os.open(name, os.O_WRONLY, dir_fd=self.get_cgroup_dir_fd(cgroup_path))
+        try:
+            os.write(fd, str(value).encode())
+        finally:
+            os.close(fd)
+
+    def read(self, cgroup_path, name):
+        # 统计文件的 fd 缓存起来，每次采样用 pread 从头读取，不用重新 open；
+        # cgroup 不存在或者已经被删除时返回 None
+        key = (cgroup_path, name)
+        try:
+            if key not in self.file_fds:
+                self.file_fds[key] = os.open(
+                    name,
+                    os.O_RDONLY | os.O_CLOEXEC,
+                    dir_fd=self.get_cgroup_dir_fd(cgroup_path, False),
+                )
+            return os.pread(self.file_fds[key], 65536, 0).decode()
+        except OSError:
+            if key in self.file_fds:
+                os.close(self.file_fds.pop(key))
+            return None
+
+    def stat(self, cgroup_path):
+        return {}
+
+    @staticmethod
+    def parse_kv(content):
+        # 解析 cpu.stat、memory.stat 这种每行 "key value" 的文件
+        if content is None:
+            return {}
+        return {
+            key: int(value)
+            for key, value in (line.split() for line in content.splitlines())
+        }
+
 
 class CpuSubsystem(Subsystem):
     def __init__(self):
@@ -48,32 +128,65 @@ class CpuSubsystem(Subsystem):
         self.subsystem_name = "cpu"
 
     def set(self, cgroup_path, resource_config):
-        if resource_config.get("cpu") is None:
-            return
-        path = self.get_cgroup_path(cgroup_path)
-        with open(os.path.join(path, "cpu.cfs_period_us"), "w") as f:
-            f.write("100000")
-        with open(os.path.join(path, "cpu.cfs_quota_us"), "w") as f:
-            f.write(str(int(resource_config["cpu"] * 100000)))
+        if resource_config.get("cpu") is not None:
+            self.write(cgroup_path, "cpu.cfs_period_us", "100000")
+            self.write(
+                cgroup_path, "cpu.cfs_quota_us", int(resource_config["cpu"] * 100000)
+            )
+        if resource_config.get("cpu_weight") is not None:
+            # cgroup v2 的 cpu.weight 1~10000 换算成 v1 的 cpu.shares 2~262144，和 runc 的换算方式相反
+            weight = resource_config["cpu_weight"]
+            self.write(cgroup_path, "cpu.shares", 2 + (weight - 1) * 262142 // 9999)
+        if resource_config.get("cpu_burst") is not None:
+            self.write(cgroup_path, "cpu.cfs_burst_us", resource_config["cpu_burst"])
+
+    def validate(self, resource_config):
+        # cpu.cfs_burst_us 需要 5.14 以上的内核
+        if resource_config.get("cpu_burst") is not None and not os.path.exists(
+            os.path.join(self.get_cgroup_path("", False), "cpu.cfs_burst_us")
+        ):
+            return "cpu burst is not supported by the kernel"
+        return None
 
 
 class MemorySubsystem(Subsystem):
+    account = True
+
     def __init__(self):
         super().__init__()
         self.subsystem_name = "memory"
 
     def set(self, cgroup_path, resource_config):
+        if resource_config.get("mem_high") is not None:
+            # v1 没有 memory.high，用软限制代替：内存紧张时优先回收超过软限制的 cgroup
+            self.write(
+                cgroup_path, "memory.soft_limit_in_bytes", resource_config["mem_high"]
+            )
         if resource_config.get("mem") is None:
             return
-        path = self.get_cgroup_path(cgroup_path)
-        with open(
-            os.path.join(path, "memory.limit_in_bytes"),
-            "w",
-        ) as f:
-            f.write(resource_config["mem"])
+        self.write(cgroup_path, "memory.limit_in_bytes", resource_config["mem"])
         # 由于memory.swappiness，即使超过了内存限制，也不会杀死进程，只是会将进程的内存交换到swap分区，这里直接简单设置为0
-        with open(os.path.join(path, "memory.swappiness"), "w") as f:
-            f.write("0")
+        self.write(cgroup_path, "memory.swappiness", "0")
+
+    def stat(self, cgroup_path):
+        usage = self.read(cgroup_path, "memory.usage_in_bytes")
+        if usage is None:
+            return {}
+        # 和 docker 一样，内存使用量不计算可以直接回收的 inactive_file 页缓存
+        memory_stat = Subsystem.parse_kv(self.read(cgroup_path, "memory.stat"))
+        stat = {
+            "mem_usage": int(usage) - memory_stat.get("total_inactive_file", 0),
+            "mem_peak": int(self.read(cgroup_path, "memory.max_usage_in_bytes") or 0),
+        }
+        # 没有限制时 memory.limit_in_bytes 是一个接近 2^63 的数
+        limit = int(self.read(cgroup_path, "memory.limit_in_bytes") or 0)
+        if 0 < limit < 1 << 62:
+            stat["mem_limit"] = limit
+        # memory.oom_control 中的 oom_kill 需要 4.13 以上的内核
+        oom_control = Subsystem.parse_kv(self.read(cgroup_path, "memory.oom_control"))
+        if "oom_kill" in oom_control:
+            stat["oom_kill"] = oom_control["oom_kill"]
+        return stat
 
 
 class CpusetSubSystem(Subsystem):
@@ -84,12 +197,108 @@ class CpusetSubSystem(Subsystem):
     def set(self, cgroup_path, resource_config):
         if resource_config.get("cpuset") is None:
             return
-        path = self.get_cgroup_path(cgroup_path)
-        with open(os.path.join(path, "cpuset.cpus"), "w") as f:
-            f.write(resource_config["cpuset"])
-        # 还要对cpuset.mems进行设置，不然之后无法将pid加入到tasks中
-        with open(os.path.join(path, "cpuset.mems"), "w") as f:
-            f.write("0-1")
+        self.write(cgroup_path, "cpuset.cpus", resource_config["cpuset"])
+        # 还要对cpuset.mems进行设置，不然之后无法将pid加入到tasks中；
+        # 没有指定时继承上一级 cgroup 的 cpuset.mems，单节点的机器上只有 0
+        mems = resource_config.get("cpuset_mems")
+        if mems is None:
+            with open(
+                os.path.join(self.get_cgroup_path("", False), "cpuset.mems")
+            ) as f:
+                mems = f.read().strip()
+        self.write(cgroup_path, "cpuset.mems", mems)
+
+
+class CpuacctSubsystem(Subsystem):
+    account = True
+
+    def __init__(self):
+        super().__init__()
+        self.subsystem_name = "cpuacct"
+
+    def stat(self, cgroup_path):
+        usage = self.read(cgroup_path, "cpuacct.usage")
+        if usage is None:
+            return {}
+        return {"cpu_usage": int(usage)}
+
+
+class PidsSubsystem(Subsystem):
+    account = True
+    options = ["pids"]
+
+    def __init__(self):
+        super().__init__()
+        self.subsystem_name = "pids"
+
+    def set(self, cgroup_path, resource_config):
+        if resource_config.get("pids") is None:
+            return
+        self.write(cgroup_path, "pids.max", resource_config["pids"])
+
+    def stat(self, cgroup_path):
+        current = self.read(cgroup_path, "pids.current")
+        if current is None:
+            return {}
+        return {"pids": int(current)}
+
+
+class BlkioSubsystem(Subsystem):
+    account = True
+    options = ["io_weight", "io_max"]
+
+    def __init__(self):
+        super().__init__()
+        self.subsystem_name = "blkio"
+
+    def set(self, cgroup_path, resource_config):
+        if resource_config.get("io_weight") is not None:
+            # cgroup v2 的 io.weight 1~10000 换算成 v1 的 10~1000，CFQ 调度器是 blkio.weight，BFQ 是 blkio.bfq.weight
+            weight = 10 + (resource_config["io_weight"] - 1) * 990 // 9999
+            path = self.get_cgroup_path(cgroup_path)
+            name = (
+                "blkio.weight"
+                if os.path.exists(os.path.join(path, "blkio.weight"))
+                else "blkio.bfq.weight"
+            )
+            self.write(cgroup_path, name, weight)
+        # 每个设备每种限制写一行: 8:0 1048576
+        files = {
+            "rbps": "blkio.throttle.read_bps_device",
+            "wbps": "blkio.throttle.write_bps_device",
+            "riops": "blkio.throttle.read_iops_device",
+            "wiops": "blkio.throttle.write_iops_device",
+        }
+        for device, limits in (resource_config.get("io_max") or {}).items():
+            for key, value in limits.items():
+                self.write(cgroup_path, files[key], f"{device} {value}")
+
+    def validate(self, resource_config):
+        if resource_config.get("io_weight") is None:
+            return None
+        root = self.get_cgroup_path("", False)
+        if not any(
+            name == "blkio.weight" or name.startswith("blkio.bfq.")
+            for name in os.listdir(root)
+        ):
+            return "io weight requires the CFQ or BFQ io scheduler"
+        return None
+
+    def stat(self, cgroup_path):
+        # 每行一个设备和操作类型: 8:0 Read 1459200，最后一行是 Total
+        content = self.read(cgroup_path, "blkio.throttle.io_service_bytes")
+        if content is None:
+            return {}
+        stat = {"io_read": 0, "io_write": 0}
+        for line in content.splitlines():
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            if fields[1] == "Read":
+                stat["io_read"] += int(fields[2])
+            elif fields[1] == "Write":
+                stat["io_write"] += int(fields[2])
+        return stat
 
 
 if __name__ == "__main__":
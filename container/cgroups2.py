@@ -1,60 +1,281 @@
 import os
 
+cgroup_root = "/sys/fs/cgroup"
+
 
 class Subsystem:
+    # cgroup v2 所有子系统共用一个目录，总是创建 cgroup 并加入进程，stats 才能统计资源使用
+    account = True
+    # 子系统对应的控制器，父 cgroup 的 cgroup.subtree_control 中启用了，子 cgroup 才有它的接口文件
+    controller = None
+    # 资源限制 -> 需要写入的接口文件
+    files = {}
+    # 探测 cgroup 中实际存在的接口文件，只探测一次
+    interface_files = None
+
     def __init__(self) -> None:
-        pass
+        # cgroup 目录的 fd，之后的读写都通过 dir_fd 进行，不用每次解析完整路径
+        self.dir_fds = {}
+        # stats 读取的统计文件的 fd
+        self.file_fds = {}
 
     def set(self, cgroup_path, resource_config):
         pass
 
+    def validate(self, resource_config):
+        # 检查当前系统是否支持设置的限制，不支持时返回错误信息
+        options = [
+            key for key in self.files if resource_config.get(key) not in (None, {})
+        ]
+        if not options:
+            return None
+        if self.controller not in Subsystem.enabled_controllers():
+            return (
+                f"{options[0]} requires the {self.controller} cgroup controller, "
+                f"enable it in {cgroup_root}/cgroup.subtree_control"
+            )
+        interface_files = Subsystem.probe_interface_files()
+        if interface_files is None:
+            return None
+        for key in options:
+            for name in self.files[key]:
+                if name not in interface_files:
+                    return f"{name} is not supported by the kernel"
+        return None
+
+    @staticmethod
+    def enabled_controllers():
+        # 容器的 cgroup 直接建在根目录下，能用的控制器就是根 cgroup 的 subtree_control
+        try:
+            with open(os.path.join(cgroup_root, "cgroup.subtree_control")) as f:
+                return f.read().split()
+        except OSError:
+            return []
+
+    @staticmethod
+    def probe_interface_files():
+        # 根 cgroup 没有 cpu.max 这类接口文件，建一个临时的子 cgroup 看内核实际提供了哪些；
+        # 没有权限创建时返回 None，交给 set 在写入时报错
+        if Subsystem.interface_files is None:
+            path = os.path.join(cgroup_root, f"mydocker-probe-{os.getpid()}")
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                pass
+            except OSError:
+                return None
+            try:
+                Subsystem.interface_files = set(os.listdir(path))
+            finally:
+                os.rmdir(path)
+        return Subsystem.interface_files
+
     def apply(self, cgroup_path, pid):
-        path = os.path.join(self.get_cgroup_path(cgroup_path, False), "cgroup.procs")
-        if not os.path.exists(path):
-            return
-        with open(path, "w") as f:
-            f.write(str(pid))
+        # 需要统计资源使用的子系统总是创建 cgroup，其他的只有设置过限制才加入
+        path = self.get_cgroup_path(cgroup_path, self.account)
+        if cgroup_path not in self.dir_fds and not os.path.isdir(path):
+            return False
+        self.write(cgroup_path, "cgroup.procs", pid)
+        return True
 
     def remove(self, cgroup_path):
+        self.close(cgroup_path)
         path = self.get_cgroup_path(cgroup_path, False)
         if os.path.exists(path):
             os.rmdir(path)
 
+    def close(self, cgroup_path):
+        for key in [key for key in self.file_fds if key[0] == cgroup_path]:
+            os.close(self.file_fds.pop(key))
+        if cgroup_path in self.dir_fds:
+            os.close(self.dir_fds.pop(cgroup_path))
+
+    def available(self):
+        return True
+
     def get_cgroup_path(self, cgroup_path, auto_create=True):
-        res_path = os.path.join("/sys/fs/cgroup", cgroup_path)
+        res_path = os.path.join(cgroup_root, cgroup_path)
         if auto_create:
             os.makedirs(res_path, mode=0o755, exist_ok=True)
         return res_path
 
+    def get_cgroup_dir_fd(self, cgroup_path, auto_create=True):
+        if cgroup_path not in self.dir_fds:
+            self.dir_fds[cgroup_path] = os.open(
+                self.get_cgroup_path(cgroup_path, auto_create),
+                os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC,
+            )
+        return self.dir_fds[cgroup_path]
+
+    def write(self, cgroup_path, name, value):
+        fd = os.open(name, os.O_WRONLY, dir_fd=self.get_cgroup_dir_fd(cgroup_path))
+        try:
+            os.write(fd, str(value).encode())
+        finally:
+            os.close(fd)
+
+    def read(self, cgroup_path, name):
+        # 统计文件的 fd 缓存起来，每次采样用 pread 从头读取，不用重新 open；
+        # cgroup 不存在或者已经被删除时返回 None
+        key = (cgroup_path, name)
+        try:
+            if key not in self.file_fds:
+                self.file_fds[key] = os.open(
+                    name,
+                    os.O_RDONLY | os.O_CLOEXEC,
+                    dir_fd=self.get_cgroup_dir_fd(cgroup_path, False),
+                )
+            return os.pread(self.file_fds[key], 65536, 0).decode()
+        except OSError:
+            if key in self.file_fds:
+                os.close(self.file_fds.pop(key))
+            return None
+
+    def stat(self, cgroup_path):
+        return {}
+
+    def pressure(self, cgroup_path, resource):
+        # cpu.pressure 第一行: some avg10=1.23 avg60=0.50 avg300=0.10 total=12345，取 avg10
+        content = self.read(cgroup_path, f"{resource}.pressure")
+        if not content:
+            return {}
+        fields = dict(field.split("=") for field in content.split()[1:])
+        return {f"{resource[:3]}_pressure": float(fields["avg10"])}
+
+    @staticmethod
+    def parse_kv(content):
+        # 解析 cpu.stat、memory.stat 这种每行 "key value" 的文件
+        if content is None:
+            return {}
+        return {
+            key: int(value)
+            for key, value in (line.split() for line in content.splitlines())
+        }
+
 
 class CpuSubsystem(Subsystem):
+    controller = "cpu"
+    files = {
+        "cpu": ["cpu.max"],
+        "cpu_weight": ["cpu.weight"],
+        # cpu.max.burst 需要 5.14 以上的内核
+        "cpu_burst": ["cpu.max.burst"],
+    }
+
     def set(self, cgroup_path, resource_config):
-        if resource_config.get("cpu") is None:
-            return
-        with open(os.path.join(self.get_cgroup_path(cgroup_path), "cpu.max"), "w") as f:
-            f.write(f"{float(resource_config['cpu'])*100000} 100000")
+        if resource_config.get("cpu") is not None:
+            # 配额必须是整数，写入 80000.0 这样的浮点数会被内核拒绝
+            self.write(
+                cgroup_path, "cpu.max", f"{int(resource_config['cpu'] * 100000)} 100000"
+            )
+        if resource_config.get("cpu_weight") is not None:
+            self.write(cgroup_path, "cpu.weight", resource_config["cpu_weight"])
+        if resource_config.get("cpu_burst") is not None:
+            self.write(cgroup_path, "cpu.max.burst", resource_config["cpu_burst"])
+
+    def stat(self, cgroup_path):
+        cpu_stat = Subsystem.parse_kv(self.read(cgroup_path, "cpu.stat"))
+        if "usage_usec" not in cpu_stat:
+            return {}
+        return {
+            "cpu_usage": cpu_stat["usage_usec"] * 1000,
+            **self.pressure(cgroup_path, "cpu"),
+        }
 
 
 class MemorySubsystem(Subsystem):
+    controller = "memory"
+    # 没有开启 swap 记账时没有 memory.swap.max
+    files = {"mem": ["memory.max", "memory.swap.max"], "mem_high": ["memory.high"]}
+
     def set(self, cgroup_path, resource_config):
+        if resource_config.get("mem_high") is not None:
+            # 超过 memory.high 之后进程会被限流并回收内存，但不会被 OOM kill
+            self.write(cgroup_path, "memory.high", resource_config["mem_high"])
         if resource_config.get("mem") is None:
             return
-        path = self.get_cgroup_path(cgroup_path)
-        with open(os.path.join(path, "memory.max"), "w") as f:
-            f.write(resource_config["mem"])
+        self.write(cgroup_path, "memory.max", resource_config["mem"])
         # 由于swap，即使超过了内存限制，也不会杀死进程，只是会将进程的内存交换到swap分区，这里直接简单设置为0
-        with open(os.path.join(path, "memory.swap.max"), "w") as f:
-            f.write("0")
+        self.write(cgroup_path, "memory.swap.max", "0")
+
+    def stat(self, cgroup_path):
+        current = self.read(cgroup_path, "memory.current")
+        if current is None:
+            return {}
+        # 和 docker 一样，内存使用量不计算可以直接回收的 inactive_file 页缓存
+        memory_stat = Subsystem.parse_kv(self.read(cgroup_path, "memory.stat"))
+        stat = {"mem_usage": int(current) - memory_stat.get("inactive_file", 0)}
+        # memory.peak 需要 5.19 以上的内核
+        peak = self.read(cgroup_path, "memory.peak")
+        if peak is not None:
+            stat["mem_peak"] = int(peak)
+        limit = self.read(cgroup_path, "memory.max")
+        if limit is not None and limit.strip() != "max":
+            stat["mem_limit"] = int(limit)
+        memory_events = Subsystem.parse_kv(self.read(cgroup_path, "memory.events"))
+        if "oom_kill" in memory_events:
+            stat["oom_kill"] = memory_events["oom_kill"]
+        stat.update(self.pressure(cgroup_path, "memory"))
+        return stat
 
 
 class CpusetSubSystem(Subsystem):
+    controller = "cpuset"
+    files = {"cpuset": ["cpuset.cpus"], "cpuset_mems": ["cpuset.mems"]}
+
     def set(self, cgroup_path, resource_config):
         if resource_config.get("cpuset") is None:
             return
-        with open(
-            os.path.join(self.get_cgroup_path(cgroup_path), "cpuset.cpus"), "w"
-        ) as f:
-            f.write(resource_config["cpuset"])
+        self.write(cgroup_path, "cpuset.cpus", resource_config["cpuset"])
+        if resource_config.get("cpuset_mems") is not None:
+            self.write(cgroup_path, "cpuset.mems", resource_config["cpuset_mems"])
+
+
+class PidsSubsystem(Subsystem):
+    controller = "pids"
+    files = {"pids": ["pids.max"]}
+
+    def set(self, cgroup_path, resource_config):
+        if resource_config.get("pids") is None:
+            return
+        self.write(cgroup_path, "pids.max", resource_config["pids"])
+
+    def stat(self, cgroup_path):
+        current = self.read(cgroup_path, "pids.current")
+        if current is None:
+            return {}
+        return {"pids": int(current)}
+
+
+class IoSubsystem(Subsystem):
+    controller = "io"
+    files = {"io_weight": ["io.weight"], "io_max": ["io.max"]}
+
+    def set(self, cgroup_path, resource_config):
+        if resource_config.get("io_weight") is not None:
+            self.write(
+                cgroup_path, "io.weight", f"default {resource_config['io_weight']}"
+            )
+        # io.max 每个设备写一行: 8:0 rbps=1048576 wiops=100
+        for device, limits in (resource_config.get("io_max") or {}).items():
+            limits = " ".join(f"{key}={value}" for key, value in limits.items())
+            self.write(cgroup_path, "io.max", f"{device} {limits}")
+
+    def stat(self, cgroup_path):
+        # io.stat 每行一个设备: 8:0 rbytes=1459200 wbytes=314773504 rios=192 wios=353 ...
+        content = self.read(cgroup_path, "io.stat")
+        if content is None:
+            return {}
+        stat = {"io_read": 0, "io_write": 0}
+        for line in content.splitlines():
+            for field in line.split()[1:]:
+                key, value = field.split("=")
+                if key == "rbytes":
+                    stat["io_read"] += int(value)
+                elif key == "wbytes":
+                    stat["io_write"] += int(value)
+        stat.update(self.pressure(cgroup_path, "io"))
+        return stat
 
 
 if __name__ == "__main__":
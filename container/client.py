@@ -0,0 +1,36 @@
+import json
+import os
+import socket
+
+# 只依赖标准库中很轻的模块，main.py 在导入其他模块之前就要用它判断是否转发给 mydockerd
+base_path = os.path.dirname(os.path.dirname(__file__))
+daemon_socket_path = os.path.join(base_path, "mydockerd.sock")
+# 需要和终端交互或者进入容器命名空间的命令在本地执行，不转发给 daemon
+local_commands = ["init", "exec"]
+
+
+def forward(argv, socket_path=daemon_socket_path):
+    # 在 main.py 中调用：daemon 在运行时把命令转发过去，返回退出码；daemon 没有运行时返回 None，在本地执行
+    if os.environ.get("MYDOCKER_NO_DAEMON") or not os.path.exists(socket_path):
+        return None
+    if not argv or argv[0] in local_commands or (argv[0] == "run" and "-it" in argv):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        conn.close()
+        return None
+    with conn:
+        request = {"argv": argv, "env": dict(os.environ), "cwd": os.getcwd()}
+        socket.send_fds(conn, [json.dumps(request).encode()], [0, 1, 2])
+        response = b""
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            response += data
+    if not response:
+        print("mydockerd closed the connection")
+        return 1
+    return json.loads(response)["exit"]
@@ -1,25 +1,43 @@
+import copy
 import json
 import os
+import re
+import resource
+import select
 import shutil
 import signal
+import socket
 import sys
-import tarfile
+import time
+import traceback
 import uuid
+from collections import defaultdict
 from datetime import datetime
 
-from network import *
-from tabulate import tabulate
+from tracing import load_trace, set_output, span, traced
 from utility import *
 
 from .cgroup_manager import CgroupManager
+from .state_store import StateStore
 
 base_path = os.path.dirname(os.path.dirname(__file__))
 info_path = os.path.join(base_path, "info")
 images_path = os.path.join(base_path, "images")
+blobs_path = os.path.join(images_path, "blobs")
 overlay_path = os.path.join(base_path, "overlay")
+# system prune 不清理这段时间内创建的工作目录，它们可能属于还在启动中的容器
+prune_grace = 60
+container_id_pattern = re.compile("[0-9a-f]{10}")
+# 追踪文件不放在 info 下，前台运行的容器退出后删除 info 目录时不会一起删掉
+traces_path = os.path.join(base_path, "traces")
 
 
 class Container:
+    _state_store = None
+    _state_pid = None
+    # mydockerd 中为 true，daemon 和它 fork 出的工作进程启动的容器由 daemon 的事件循环统一监控
+    monitor_in_daemon = False
+
     def __init__(
         self,
         command,
@@ -31,6 +49,10 @@ class Container:
         network=None,
         port_mapping=None,
         tty=False,
+        log_driver="json-file",
+        log_opts=None,
+        upper=None,
+        tmpfs=None,
     ) -> None:
         if command is str:
             command = command.split()
@@ -45,71 +67,540 @@ class Container:
             os.environ.update(envs)
             self.env = envs
         self.tty = tty
-        self.container_id = "".join(str(uuid.uuid4()).split("-"))[:10]
+        self.log_driver = log_driver
+        self.log_opts = log_opts
+        self.upper = upper
+        self.tmpfs = tmpfs
+        self.container_id = Container.new_container_id()
         self.container_name = container_name
+        self.pid = None
+        self.monitor_pid = None
         if container_name is None:
             self.container_name = self.container_id
 
+    @staticmethod
+    def new_container_id():
+        return "".join(str(uuid.uuid4()).split("-"))[:10]
+
     def run(self):
-        f = open("/proc/self/cmdline")
-        cmd = f.read().split("\x00")[:2]
-        f.close()
-        cmd.append("init")
-        cmd.append("--")  # 用于区分命令
-        cmd.extend(self.cmd)
+        # 有预热好的沙箱时直接使用，沙箱的 ID 就是容器的 ID；挂载 volume、tmpfs 需要在 pivot_root 之前，
+        # upper 放在 tmpfs 上时 overlay 的挂载方式也不同，都不能用沙箱
+        sandbox = None
+        if not self.volume and not self.upper and not self.tmpfs:
+            sandbox = Container.take_sandbox(self.image_name, self.network)
+        if sandbox is not None:
+            if self.container_name == self.container_id:
+                self.container_name = sandbox["ID"]
+            self.container_id = sandbox["ID"]
+        set_output(Container.trace_path(self.container_id))
+        if sandbox is not None:
+            try:
+                self.run_in_sandbox(sandbox)
+            except BaseException:
+                Container.discard_placement(self.container_id)
+                if self.pid is None:
+                    Container.discard_sandbox(sandbox)
+                raise
+            return
+        try:
+            log_driver, cgroup_manager = self.prepare()
+            self.new_work_space()
+            container_info = self.start(log_driver, cgroup_manager)
+        except BaseException:
+            Container.discard_placement(self.container_id)
+            raise
+        if not self.tty:
+            return
+        with span("wait"):
+            os.waitpid(self.pid, 0)
+        Container.release_resources(
+            [self.container_id], {self.container_id: cgroup_manager}
+        )
+        Container.delete_work_space(self.container_id, self.volume)
+        self.delete_container_info()
+
+    def start(self, log_driver, cgroup_manager, ip_interface=None, port_mapping=True):
+        # 新的命名空间
+        with span("unshare"):
+            os.unshare(
+                os.CLONE_NEWUTS
+                | os.CLONE_NEWPID
+                | os.CLONE_NEWNS
+                | os.CLONE_NEWNET
+                | os.CLONE_NEWIPC
+                # | os.CLONE_NEWUSER
+            )
+        print(f"container_id: {self.container_id}")
+        if log_driver:
+            log_driver.open()
+        with span("fork"):
+            pid = os.fork()
+        if pid == 0:
+            # 子进程中直接挂载 proc、pivot_root 然后 execve 用户命令，不再重新启动一个 python 解释器执行 init
+            try:
+                if log_driver:
+                    print("not tty")
+                    # 重定向标准输入、标准输出和标准错误
+                    log_driver.redirect()
+                cgroup_manager.set(self.resource_config)
+                cgroup_manager.apply(pid)
+                self.init()
+            except OSError as e:
+                print(f"container init failed: {e}", file=sys.stderr)
+            finally:
+                os._exit(127)
+        else:
+            Container.restore_namespaces()
+            # 子进程 pivot_root 会改变同一个 mount namespace 中父进程的根目录，回到宿主机的命名空间之后才能导入
+            from network import Network
+
+            if log_driver:
+                with span("log_driver.start"):
+                    log_driver.start()
+            self.pid = pid
+            self.start_monitor(cgroup_manager)
+            container_info = self.record_container_info()
+            Network.connect(self.network, container_info, ip_interface, port_mapping)
+            if self.network:
+                # 记录 IP，释放资源和 system prune 时用到
+                Container.set_container_info(
+                    self.container_id, {"IP": str(container_info["IP"])}
+                )
+            return container_info
+
+    @staticmethod
+    def run_replicas(template, count, parallel=None):
+        # 一次启动 count 个相同的容器：镜像层的引用和 IP 在一次加锁中取得，端口映射在一个防火墙事务里提交，
+        # 每个容器的挂载、cgroup 和网络配置在最多 parallel 个工作进程中并发执行
+        from network import IPAM, Network
+
+        from .layer_store import LayerStore
+
+        start_time = time.perf_counter()
+        if template.tty:
+            print("--replicas can not be used with -it")
+            sys.exit(1)
+        network = None
+        if template.network:
+            networks = Network.load()
+            if template.network not in networks:
+                print(f"network {template.network} not found")
+                sys.exit(1)
+            network = networks[template.network]
+        replicas = [template.replica(index) for index in range(count)]
+        container_ids = [replica.container_id for replica in replicas]
+        lower_paths = LayerStore().acquire_many(
+            Container.image_layers(template.image_name), container_ids
+        )
+        ip_interfaces = [None] * count
+        if network:
+            ip_interfaces = IPAM().allocate_many(network["IpRange"], count)
+            if ip_interfaces is None:
+                print(f"not enough ip addresses in network {template.network}")
+                for container_id in container_ids:
+                    LayerStore().release(container_id)
+                sys.exit(1)
+        started, failed = Container.start_replicas(
+            list(zip(replicas, ip_interfaces)),
+            lower_paths,
+            parallel or os.cpu_count() or 1,
+        )
+        if network:
+            Network.config_port_mappings(
+                network,
+                [
+                    {
+                        "ID": replica.container_id,
+                        "IPINTERFACE": ip_interface,
+                        "PORTMAPPING": replica.port_mapping,
+                    }
+                    for replica, ip_interface in started
+                ],
+            )
+        for replica, ip_interface in failed:
+            Container.discard_replica(replica, network, ip_interface)
+        # 工作进程按完成顺序返回，输出时恢复成序号顺序
+        started.sort(key=lambda job: container_ids.index(job[0].container_id))
+        elapsed = time.perf_counter() - start_time
+        print(
+            format_table(
+                [
+                    [
+                        replica.container_id,
+                        replica.container_name,
+                        str(ip_interface.ip) if ip_interface else "",
+                    ]
+                    for replica, ip_interface in started
+                ],
+                ["CONTAINER ID", "NAME", "IP"],
+            )
+        )
+        print(f"started {len(started)}/{count} replicas in {elapsed:.3f}s")
+        if failed:
+            sys.exit(1)
+
+    def replica(self, index):
+        # 名字和宿主机端口按序号区分：-name web -p 8080:80 得到 web-0 8080:80、web-1 8081:80 ...
+        replica = copy.copy(self)
+        replica.container_id = Container.new_container_id()
+        if self.container_name == self.container_id:
+            replica.container_name = replica.container_id
+        else:
+            replica.container_name = f"{self.container_name}-{index}"
+        if self.port_mapping:
+            replica.port_mapping = []
+            for port_mapping in self.port_mapping:
+                host_port, container_port = port_mapping.split(":")
+                replica.port_mapping.append(
+                    f"{int(host_port) + index}:{container_port}"
+                )
+        return replica
+
+    @staticmethod
+    def start_replicas(jobs, lower_paths, parallel):
+        # 每个容器在单独的工作进程中启动，unshare、chdir 等对进程状态的修改不会互相影响；
+        # 工作进程的退出码表示容器是否启动成功，容器进程在工作进程退出后和 run -d 一样交给 init 收养
+        pending = list(jobs)
+        running = {}
+        started, failed = [], []
+        while pending or running:
+            while pending and len(running) < parallel:
+                replica, ip_interface = job = pending.pop(0)
+                sys.stdout.flush()
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        replica.start_replica(lower_paths, ip_interface)
+                        code = 0
+                    except SystemExit as e:
+                        code = e.code if isinstance(e.code, int) else 1
+                    except BaseException:
+                        traceback.print_exc()
+                    finally:
+                        sys.stdout.flush()
+                        os._exit(code)
+                running[pid] = job
+            pid, status = os.wait()
+            if pid not in running:
+                continue
+            job = running.pop(pid)
+            if os.waitstatus_to_exitcode(status) == 0:
+                started.append(job)
+            else:
+                failed.append(job)
+        return started, failed
+
+    def start_replica(self, lower_paths, ip_interface):
+        set_output(Container.trace_path(self.container_id))
+        log_driver, cgroup_manager = self.prepare()
+        self.new_work_space(lower_paths)
+        self.start(log_driver, cgroup_manager, ip_interface, False)
+
+    @staticmethod
+    def discard_replica(replica, network, ip_interface):
+        # 启动失败的容器：已经记录了状态的留给 rm 清理，其余的释放 IP、工作目录和层引用
+        Container.discard_placement(replica.container_id)
+        if Container.state_store().get(replica.container_id):
+            return
+        from network import IPAM
+
+        from .layer_store import LayerStore
+
+        if ip_interface:
+            IPAM().release(network["IpRange"], ip_interface.ip)
+        if os.path.exists(os.path.join(overlay_path, replica.container_id)):
+            Container.delete_work_space(replica.container_id, replica.volume)
+        else:
+            LayerStore().release(replica.container_id)
+
+    @staticmethod
+    def release_resources(container_ids, cgroup_managers=None):
+        # 容器退出后删除 cgroup、清除端口映射并释放 IP，前台运行的 run、mydockerd、stop、rm 和 prune 共用；
+        # 先在状态数据库中标记，同一个容器只会被释放一次
+        released = Container.state_store().mark_released(container_ids)
+        for container_info in released:
+            cgroup_manager = (cgroup_managers or {}).get(container_info["ID"])
+            if cgroup_manager is None:
+                cgroup_manager = CgroupManager(container_info["ID"])
+            try:
+                cgroup_manager.remove()
+            except OSError as e:
+                print(f"failed to remove cgroup of {container_info['ID']}: {e}")
+        # 没有连接网络的容器不用加载网络模块
+        if any(container_info.get("NETWORK") for container_info in released):
+            from network import Network
+
+            Network.disconnect_many(released)
+        return released
+
+    @traced()
+    def prepare(self):
+        # 后台运行时容器的输出交给日志驱动处理
+        log_driver = None
+        if not self.tty:
+            from .logger import log_drivers
+
+            if self.log_driver not in log_drivers:
+                print(f"log driver {self.log_driver} not found")
+                sys.exit(1)
+            log_driver = log_drivers[self.log_driver](
+                Container.log_path(self.container_id), self.log_opts
+            )
+        # 在启动容器之前检查 --upper、--tmpfs 的格式
+        if self.upper:
+            Container.upper_extract(self.upper)
+        for tmpfs in self.tmpfs or []:
+            Container.tmpfs_extract(tmpfs)
         # cgroup限制资源
         cgroup_manager = CgroupManager(self.container_id)
-        self.new_work_space()
-        # 新的命名空间
+        cpuset = self.resource_config.get("cpuset")
+        if cpuset and cpuset.startswith("auto:"):
+            self.place_cpuset(cpuset[len("auto:") :])
+        self.resource_config = cgroup_manager.validate(self.resource_config)
+        return log_driver, cgroup_manager
+
+    @staticmethod
+    @traced()
+    def restore_namespaces():
+        # 还原父进程的命名空间
+        for ns_file in ["ipc", "mnt", "net", "pid", "uts"]:
+            ns_path = os.path.join("/proc/1/ns/", ns_file)
+            fd = os.open(ns_path, os.O_RDONLY)
+            os.setns(fd)
+            os.close(fd)
+
+    @traced()
+    def start_monitor(self, cgroup_manager):
+        # PSI 和 memory.events 只有 cgroup v2 才有；监控进程的 PID 记录在状态中，mydockerd 不会重复监控
+        if cgroup_manager.cgroup_version == 2 and not Container.monitor_in_daemon:
+            from .monitor import EventMonitor
+
+            self.monitor_pid = EventMonitor.start(
+                self.container_id,
+                self.pid,
+                cgroup_manager.subsystems[0].get_cgroup_path(self.container_id, False),
+                Container.events_path(self.container_id),
+            )
+
+    def run_in_sandbox(self, sandbox):
+        import ipaddress
+
+        from network import Network
+
+        from .pool import SandboxPool, exec_in_sandbox
+
+        log_driver, cgroup_manager = self.prepare()
+        print(f"container_id: {self.container_id}")
+        self.layers = sandbox["LAYERS"]
+        # 沙箱进程已经在容器的命名空间里，从外面把它加入 cgroup
+        cgroup_manager.set(self.resource_config)
+        cgroup_manager.apply(sandbox["PID"])
+        fds = [0, 1, 2]
+        if log_driver:
+            log_driver.open()
+            fds = log_driver.stdio()
+        pidfd = os.pidfd_open(sandbox["PID"])
+        socket_path = SandboxPool().socket_path(self.container_id)
+        with span("exec_in_sandbox"):
+            exec_in_sandbox(socket_path, self.cmd, dict(os.environ), fds)
+        os.unlink(socket_path)
+        self.pid = sandbox["PID"]
+        if log_driver:
+            log_driver.start()
+        Container.refill_pool(self.image_name, self.network)
+        self.start_monitor(cgroup_manager)
+        container_info = self.record_container_info()
+        if self.network:
+            # veth 和 IP 在沙箱准备时已经配置好，这里只需要配置端口映射
+            container_info["IP"] = ipaddress.ip_address(sandbox["IP"])
+            Container.set_container_info(self.container_id, {"IP": sandbox["IP"]})
+            Network.config_port_mapping(
+                Network.load()[self.network],
+                {
+                    "ID": self.container_id,
+                    "IPINTERFACE": ipaddress.ip_interface(
+                        f"{sandbox['IP']}/{ipaddress.ip_network(sandbox['SUBNET']).prefixlen}"
+                    ),
+                    "PORTMAPPING": self.port_mapping,
+                },
+            )
+        if not self.tty:
+            return
+        # 沙箱进程不是当前进程的子进程，通过 pidfd 等待它退出
+        with span("wait"):
+            select.select([pidfd], [], [])
+        Container.release_resources(
+            [self.container_id], {self.container_id: cgroup_manager}
+        )
+        Container.delete_work_space(self.container_id, self.volume)
+        self.delete_container_info()
+
+    @staticmethod
+    def create_sandbox(image_name, network):
+        from network import Network
+
+        from .pool import SandboxPool, serve
+
+        con = Container([], image_name, network=network)
+        cwd = os.getcwd()
+        con.new_work_space()
+        socket_path = SandboxPool().socket_path(con.container_id)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        listener.listen(1)
         os.unshare(
             os.CLONE_NEWUTS
             | os.CLONE_NEWPID
             | os.CLONE_NEWNS
             | os.CLONE_NEWNET
             | os.CLONE_NEWIPC
-            # | os.CLONE_NEWUSER
         )
-        print(f"container_id: {self.container_id}")
         pid = os.fork()
         if pid == 0:
-            if not self.tty:
-                print("not tty")
-                fd_path = os.path.join(info_path, self.container_id)
-                os.makedirs(fd_path, exist_ok=True)
-                fd = os.open(
-                    os.path.join(fd_path, self.container_id + "-json.log"),
-                    os.O_RDWR | os.O_CREAT,
-                )
-                os.dup2(fd, 0)  # 重定向标准输入
-                os.dup2(fd, 1)  # 重定向标准输出
-                os.dup2(fd, 2)  # 重定向标准错误
-                os.close(fd)
-            cgroup_manager.set(self.resource_config)
-            cgroup_manager.apply(pid)
-            os.execve(cmd[0], cmd, os.environ)
-        else:
-            # 还原父进程的命名空间
-            for ns_file in ["ipc", "mnt", "net", "pid", "uts"]:
-                ns_path = os.path.join("/proc/1/ns/", ns_file)
-                fd = os.open(ns_path, os.O_RDONLY)
-                os.setns(fd)
-                os.close(fd)
-            self.pid = pid
-            container_info = self.record_container_info()
-            Network.connect(self.network, container_info)
-            if not self.tty:
-                return
+            try:
+                # 沙箱进程不能继承补充池的锁和调用方的连接，等待期间也不占用终端
+                detach_stdio(keep=(listener.fileno(),))
+                con.setUpMount()
+                serve(listener)
+            finally:
+                os._exit(127)
+        Container.restore_namespaces()
+        os.chdir(cwd)
+        listener.close()
+        container_info = {"ID": con.container_id, "PID": pid, "PORTMAPPING": None}
+        Network.connect(network, container_info)
+        return {
+            "ID": con.container_id,
+            "KEY": SandboxPool.key(image_name, network),
+            "PID": pid,
+            "START_TIME": proc_start_time(pid),
+            "LAYERS": con.layers,
+            "NETWORK": network,
+            "IP": str(container_info["IP"]) if network else None,
+            "SUBNET": Network.load()[network]["IpRange"] if network else None,
+        }
+
+    @staticmethod
+    def discard_sandbox(sandbox):
+        from network import IPAM
+
+        from .pool import SandboxPool
+
+        if proc_start_time(sandbox["PID"]) == sandbox["START_TIME"]:
+            os.kill(sandbox["PID"], signal.SIGKILL)
+        # 沙箱的 net namespace 随进程一起销毁，宿主机一端的 veth 也会被删除，这里只需要释放 IP
+        if sandbox["NETWORK"]:
+            IPAM().release(sandbox["SUBNET"], sandbox["IP"])
+        Container.delete_work_space(sandbox["ID"], None)
+        socket_path = SandboxPool().socket_path(sandbox["ID"])
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+    @staticmethod
+    @traced()
+    def take_sandbox(image_name, network):
+        from .pool import SandboxPool
+
+        pool = SandboxPool()
+        if not os.path.exists(pool.meta_path):
+            return None
+        sandbox, dead = pool.take(image_name, network)
+        for dead_sandbox in dead:
+            Container.discard_sandbox(dead_sandbox)
+        return sandbox
+
+    @staticmethod
+    def refill_pool(image_name, network):
+        # 两次 fork，补充进程交给 init 回收，不会在 run 等待容器时留下僵尸进程
+        pid = os.fork()
+        if pid != 0:
             os.waitpid(pid, 0)
-            cgroup_manager.remove()
-            Container.delete_work_space(self.container_id, self.volume)
-            self.delete_container_info()
-            Network.disconnect(container_info)
+            return
+        try:
+            if os.fork() == 0:
+                os.setsid()
+                detach_stdio()
+                Container.pool_fill(image_name, network)
+        finally:
+            os._exit(0)
+
+    @staticmethod
+    def pool_fill(image_name, network, size=None):
+        from .pool import SandboxPool, default_pool_disk, default_pool_memory
+
+        pool = SandboxPool()
+        if size is not None:
+            pool.set_size(image_name, network, size)
+        size = pool.size(image_name, network)
+        memory_budget = parse_size(default_pool_memory)
+        disk_budget = parse_size(default_pool_disk)
+        with pool.fill_lock(image_name, network) as lock_fd:
+            # 已经有其他进程在补充这个池
+            if lock_fd is None:
+                return
+            while len(pool.sandboxes(image_name, network)) < size:
+                sandboxes = pool.sandboxes()
+                memory = SandboxPool.memory_usage(sandboxes)
+                disk = SandboxPool.disk_usage(sandboxes, overlay_path)
+                # 按已有沙箱的平均值估算下一个沙箱的占用
+                count = max(len(sandboxes), 1)
+                if (
+                    memory + memory / count > memory_budget
+                    or disk + disk / count > disk_budget
+                ):
+                    print("pool budget exhausted")
+                    break
+                sandbox = Container.create_sandbox(image_name, network)
+                pool.add(sandbox)
+                print(f"sandbox {sandbox['ID']} ready")
+
+    @staticmethod
+    def pool_drain(image_name, network):
+        from .pool import SandboxPool
+
+        pool = SandboxPool()
+        pool.set_size(image_name, network, 0)
+        while True:
+            sandbox, dead = pool.take(image_name, network)
+            for discarded in dead + ([sandbox] if sandbox else []):
+                Container.discard_sandbox(discarded)
+            if sandbox is None:
+                break
+
+    @staticmethod
+    def pool_status():
+        from .pool import SandboxPool
+
+        pool = SandboxPool()
+        pool.load()
+        data = []
+        for key, info in pool.meta["pools"].items():
+            sandboxes = [
+                sandbox
+                for sandbox in pool.meta["sandboxes"].values()
+                if sandbox["KEY"] == key
+            ]
+            data.append(
+                [
+                    info["image"],
+                    info["network"] or "",
+                    str(info["size"]),
+                    str(len(sandboxes)),
+                    format_size(SandboxPool.memory_usage(sandboxes)),
+                ]
+            )
+        print(format_table(data, ["IMAGE", "NETWORK", "SIZE", "READY", "MEMORY"]))
 
     def init(self):
         self.setUpMount()
+        # 追踪用的环境变量不传给容器中的命令
+        os.environ.pop("MYDOCKER_TRACE", None)
+        os.environ.pop("MYDOCKER_TRACE_FILE", None)
         cmd = self.cmd
         os.execve(cmd[0], cmd, os.environ)
 
+    @traced()
     def setUpMount(self):
         # systemd 加入linux之后, mount namespace 就变成 shared by default, 所以你必须显示
         # 声明你要这个新的mount namespace独立。
@@ -122,7 +613,13 @@ class Container:
         # tmpfs 是基于 件系 使用 RAM、swap 分区来存储。
         # 不挂载 /dev，会导致容器内部无法访问和使用许多设备，这可能导致系统无法正常工作
         mount("tmpfs", "/dev", "tmpfs", MS_NOSUID | MS_STRICTATIME)
+        # --tmpfs 挂载的目录内容只在内存中，容器删除时随挂载一起释放
+        for tmpfs in self.tmpfs or []:
+            path, options = Container.tmpfs_extract(tmpfs)
+            os.makedirs(path, mode=0o755, exist_ok=True)
+            mount("tmpfs", path, "tmpfs", MS_NOSUID | MS_NODEV, options)
 
+    @traced()
     def pivotRoot(self, root):
         # 注意：PivotRoot调用有限制，newRoot和oldRoot不能在同一个文件系统下。
         # 因此，为了使当前root的老root和新root不在同一个文件系统下，这里把root重新mount了一次。
@@ -152,18 +649,50 @@ class Container:
             sys.exit(1)
         return volume_path[0], volume_path[1]
 
-    def new_work_space(self):
+    @staticmethod
+    def upper_extract(upper):
+        # --upper tmpfs 或者 --upper tmpfs:512m，返回 tmpfs 的大小，没有指定时为 None
+        kind, _, size = upper.partition(":")
+        try:
+            if kind != "tmpfs":
+                raise ValueError
+            return parse_size(size) if size else None
+        except ValueError:
+            print(f"invalid --upper {upper}, e.g.: --upper tmpfs:512m")
+            sys.exit(1)
+
+    @staticmethod
+    def tmpfs_extract(tmpfs):
+        # --tmpfs /run 或者 --tmpfs /run:size=64m,mode=1777，返回 (容器中的路径, 挂载选项)
+        path, _, options = tmpfs.partition(":")
+        if not path.startswith("/") or any(
+            "=" not in option for option in options.split(",") if option
+        ):
+            print(f"invalid --tmpfs {tmpfs}, e.g.: --tmpfs /run:size=64m,mode=1777")
+            sys.exit(1)
+        return path, options
+
+    @traced()
+    def new_work_space(self, lower_paths=None):
         root_url = os.path.join(overlay_path, self.container_id)
         if os.path.exists(root_url):
             shutil.rmtree(root_url)
         os.makedirs(root_url, mode=0o777)
-        # create lower
-        image_path = os.path.join(images_path, self.image_name)
-        lower_path = os.path.join(root_url, "lower")
-        if not os.path.exists(lower_path):
-            os.mkdir(lower_path, mode=0o777)
-            with tarfile.open(image_path, "r") as tar:
-                tar.extractall(lower_path)
+        if self.upper:
+            # upper、work 放在 tmpfs 上，容器的写入只在内存中，删除时 umount 一次即可，不需要 rmtree
+            size = Container.upper_extract(self.upper)
+            options = "mode=0755" + (f",size={size}" if size else "")
+            mount("tmpfs", root_url, "tmpfs", 0, options)
+        # lower 使用层缓存中按摘要共享的只读目录，同一个层只解压一次；批量启动时已经由调用者统一取得
+        if lower_paths is None:
+            from .layer_store import LayerStore
+
+            lower_paths = LayerStore().acquire_many(
+                Container.image_layers(self.image_name), [self.container_id]
+            )
+        self.layers = [os.path.basename(lower_path) for lower_path in lower_paths]
+        # overlayfs 的 lowerdir 从上往下排列，最上层在最前面
+        lower_path = ":".join(reversed(lower_paths))
         # create upper、worker
         upper_path = os.path.join(root_url, "upper")
         os.mkdir(upper_path, mode=0o777)
@@ -189,62 +718,269 @@ class Container:
 
     @staticmethod
     def delete_work_space(container_id, volume):
+        from .layer_store import LayerStore
+        from .trash import Trash
+
+        Container.remove_work_space(container_id, volume)
+        # lower 是共享的只读层，这里只解除引用，由层缓存决定何时回收
+        LayerStore().release(container_id)
+        Trash().spawn_reaper()
+
+    @staticmethod
+    def delete_work_spaces(work_spaces):
+        # 多个容器的卸载和移入回收站互不依赖，在线程池中并行执行，层引用在一次加锁中解除，最后只启动一个回收进程
+        if not work_spaces:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+
+        from .layer_store import LayerStore
+        from .trash import Trash
+
+        with ThreadPoolExecutor(max_workers=min(len(work_spaces), 8)) as executor:
+            list(
+                executor.map(
+                    lambda work_space: Container.remove_work_space(*work_space),
+                    work_spaces,
+                )
+            )
+        LayerStore().release_many([container_id for container_id, _ in work_spaces])
+        Trash().spawn_reaper()
+
+    @staticmethod
+    def remove_work_space(container_id, volume):
         root_url = os.path.join(overlay_path, container_id)
         mnt_url = os.path.join(root_url, "merged")
-        # 一定要要先 umount volume ，然后再删除目录，否则由于 bind mount 存在，删除临时目录会导致 volume 目录中的数据丢失
+        # 一定要要先 umount volume ，然后再删除目录，否则由于 bind mount 存在，删除临时目录会导致 volume 目录中的数据丢失；
+        # 这里用 lazy umount，容器中还有进程在使用时也能立即从挂载树上摘掉，MNT_DETACH 会连同下面的挂载一起摘掉
         if volume:
             host_path, container_path = Container.volume_extract(volume)
             container_path = os.path.join(mnt_url, container_path.strip("/"))
-            os.system(f"umount {container_path}")
+            if os.path.ismount(container_path):
+                umount(container_path, MNT_DETACH)
+        if os.path.ismount(root_url):
+            # upper 在 tmpfs 上：一次 lazy umount 连同 overlayfs 一起摘掉，内存随之释放
+            umount(root_url, MNT_DETACH)
+            os.rmdir(root_url)
+            return
         # unmount overlayfs：将../root/merged目录挂载解除
-        os.system(f"umount {mnt_url}")
-        # shutil.rmtree(mnt_url)
-        # # 删除其他目录：删除之前为 overlayfs 准备的 upper、work、merged 目录
-        # upper_path = os.path.join(root_url, "upper")
-        # shutil.rmtree(upper_path)
-        # work_path = os.path.join(root_url, "work")
-        # shutil.rmtree(work_path)
-        shutil.rmtree(root_url)
+        if os.path.ismount(mnt_url):
+            umount(mnt_url, MNT_DETACH)
+        if not os.path.exists(root_url):
+            return
+        # 目录中已经没有挂载，rename 到回收站之后由后台进程删除
+        from .trash import Trash
+
+        Trash().move(root_url)
+
+    @staticmethod
+    def image_layers(image_name):
+        # 镜像有两种格式：
+        # 1. images/<name>.json 清单，按从下到上的顺序记录各层 tar 的摘要，层 tar 存放在 images/blobs 下
+        # 2. images/<name>.tar 单层镜像，例如 busybox.tar
+        manifest_path = os.path.join(images_path, image_name)
+        if not manifest_path.endswith(".json"):
+            manifest_path += ".json"
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            return [
+                os.path.join(blobs_path, f"{digest}.tar")
+                for digest in manifest["Layers"]
+            ]
+        image_path = os.path.join(images_path, image_name)
+        if not os.path.exists(image_path):
+            image_path += ".tar"
+        if not os.path.exists(image_path):
+            print(f"image {image_name} not found")
+            sys.exit(1)
+        return [image_path]
 
     @staticmethod
     def commit(container_id, image_name):
-        mnt_url = os.path.join(overlay_path, container_id, "merged")
-        image_url = os.path.join(images_path, f"{image_name}.tar")
-        with tarfile.open(image_url, "w") as tar:
-            tar.add(mnt_url, arcname=".")
+        # 只把容器的 upper 目录提交为新的一层，镜像清单 = 容器原有的层 + 新层
+        container_id = Container.resolve(container_id)
+        container_info = Container.get_info_by_container_id(container_id)
+        upper_url = os.path.join(overlay_path, container_id, "upper")
+        os.makedirs(blobs_path, exist_ok=True)
+        # 父层的 tar 也要放进 blobs，这样新镜像不依赖原镜像文件是否还在
+        for digest, blob_path in zip(
+            container_info["LAYERS"], Container.image_layers(container_info["IMAGE"])
+        ):
+            layer_blob_path = os.path.join(blobs_path, f"{digest}.tar")
+            if not os.path.exists(layer_blob_path):
+                try:
+                    os.link(blob_path, layer_blob_path)
+                except OSError:
+                    shutil.copyfile(blob_path, layer_blob_path)
+        from .layer_store import LayerStore
+
+        tmp_path = os.path.join(blobs_path, f".tmp-{container_id}.tar")
+        LayerStore.diff(upper_url, tmp_path)
+        digest = LayerStore.file_digest(tmp_path)
+        os.rename(tmp_path, os.path.join(blobs_path, f"{digest}.tar"))
+        with open(os.path.join(images_path, f"{image_name}.json"), "w") as f:
+            json.dump({"Layers": container_info["LAYERS"] + [digest]}, f, indent=4)
+
+    @staticmethod
+    def state_store():
+        # 每个进程复用一个数据库连接，fork 出来的子进程重新打开
+        if Container._state_store is None or Container._state_pid != os.getpid():
+            Container._state_store = StateStore()
+            Container._state_pid = os.getpid()
+        return Container._state_store
+
+    @staticmethod
+    def resolve(name_or_id):
+        return Container.state_store().resolve(name_or_id)
 
     @staticmethod
     def set_container_info(container_id, kv):
-        container_info = Container.get_info_by_container_id(container_id)
-        for k, v in kv.items():
-            container_info[k] = v
-        os.makedirs(os.path.join(info_path, container_id), exist_ok=True)
-        with open(
-            os.path.join(info_path, container_id, "config.json"), "w"
-        ) as json_file:
-            json.dump(container_info, json_file, indent=4)
+        return Container.state_store().update(container_id, kv)
 
+    @traced()
     def record_container_info(self):
         container_info = {
             "ID": self.container_id,
             "PID": self.pid,
+            "START_TIME": proc_start_time(self.pid),
             "COMMAND": " ".join(self.cmd),
             "CREATE_TIME": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "STATUS": "running",
             "NAME": self.container_name,
+            "IMAGE": self.image_name,
+            "LAYERS": self.layers,
             "VOLUME": self.volume,
+            "UPPER": self.upper,
+            "TMPFS": self.tmpfs,
             "NETWORK": self.network,
             "PORTMAPPING": self.port_mapping,
+            "LOG_DRIVER": None if self.tty else self.log_driver,
+            "TTY": self.tty,
+            "MONITOR_PID": self.monitor_pid,
+            "CPUSET": self.resource_config.get("cpuset"),
+            "CPUSET_MEMS": self.resource_config.get("cpuset_mems"),
         }
         Container.set_container_info(self.container_id, container_info)
         return container_info
 
+    @traced()
+    def place_cpuset(self, count):
+        # -cpuset auto:N：在一个 NUMA 节点上选 N 个绑定容器最少的 CPU，内存也只从这个节点分配
+        try:
+            count = int(count)
+        except ValueError:
+            print(f"invalid cpuset auto:{count}, e.g.: -cpuset auto:2")
+            sys.exit(1)
+        from .numa import NumaTopology, format_cpulist, parse_cpulist
+
+        store = Container.state_store()
+        # 先更新已经退出的容器的状态、删除启动进程已经不在了的占位，它们绑定的 CPU 不再计入负载
+        Container.reconcile(store.list("running") + store.list("created"))
+        with store.transaction():
+            load = defaultdict(int)
+            for status in ["running", "created"]:
+                for container_info in store.list(status):
+                    for cpu in parse_cpulist(container_info.get("CPUSET") or ""):
+                        load[cpu] += 1
+            try:
+                cpus, mems = NumaTopology().place(count, load)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+            self.resource_config = dict(
+                self.resource_config,
+                cpuset=format_cpulist(cpus),
+                cpuset_mems=format_cpulist(mems),
+            )
+            # 在同一个事务里先占住这些 CPU，并发启动的容器不会选到同一批 CPU；
+            # 记录启动进程，它被 kill 之后 reconcile 删除这条占位
+            store.put(
+                self.container_id,
+                {
+                    "ID": self.container_id,
+                    "NAME": self.container_name,
+                    "STATUS": "created",
+                    "CPUSET": self.resource_config["cpuset"],
+                    "CPUSET_MEMS": self.resource_config["cpuset_mems"],
+                    "OWNER_PID": os.getpid(),
+                    "OWNER_START_TIME": proc_start_time(os.getpid()),
+                },
+            )
+        print(
+            f"cpuset: {self.resource_config['cpuset']}, mems: {self.resource_config['cpuset_mems']}"
+        )
+
+    @staticmethod
+    def discard_placement(container_id):
+        # place_cpuset 写入的 created 状态会一直占着 CPU，容器没有启动起来时删除；
+        # 已经是 running 的说明容器进程已经启动，留给 rm 清理
+        store = Container.state_store()
+        if store.get(container_id).get("STATUS") == "created":
+            store.delete(container_id)
+
     def delete_container_info(self):
-        path = os.path.join(info_path, self.container_id)
-        shutil.rmtree(path)
+        Container.state_store().delete(self.container_id)
+        shutil.rmtree(os.path.join(info_path, self.container_id), ignore_errors=True)
+
+    @staticmethod
+    def reconcile(containers):
+        # 后台运行的容器退出后没有进程去 waitpid，状态会一直停在 running，
+        # 这里一次性检查所有 running 容器的进程，启动时间对不上说明 PID 已经被复用；
+        # created 状态的占位在启动进程被 kill 之后没有人删除，启动进程不在了就删除，不再返回
+        exited = {}
+        stale = set()
+        for container_info in containers:
+            if container_info["STATUS"] == "created":
+                owner_pid = container_info.get("OWNER_PID")
+                if owner_pid is None or proc_start_time(
+                    owner_pid
+                ) != container_info.get("OWNER_START_TIME"):
+                    stale.add(container_info["ID"])
+                continue
+            if container_info["STATUS"] != "running":
+                continue
+            start_time = None
+            if container_info["PID"]:
+                start_time = proc_start_time(container_info["PID"])
+            if start_time is None or start_time != container_info.get(
+                "START_TIME", start_time
+            ):
+                exited[container_info["ID"]] = {"STATUS": "exited", "PID": ""}
+                container_info.update(exited[container_info["ID"]])
+        if exited:
+            Container.state_store().update_many(exited)
+        if stale:
+            Container.state_store().delete_many(stale)
+            containers = [c for c in containers if c["ID"] not in stale]
+        return containers
 
     @staticmethod
-    def ps():
+    def parse_filters(filters):
+        # --filter status=running --filter name=web，同一个 key 的多个值之间是或的关系
+        result = {}
+        for f in filters or []:
+            key, _, value = f.partition("=")
+            if key not in ["id", "name", "status", "network"]:
+                print(f"unsupported filter: {f}")
+                sys.exit(1)
+            result.setdefault(key, set()).add(value)
+        return result
+
+    @staticmethod
+    def match_filters(container_info, filters):
+        for key, values in filters.items():
+            if key == "id":
+                if not any(container_info["ID"].startswith(v) for v in values):
+                    return False
+            elif key == "name":
+                if not any(v in container_info["NAME"] for v in values):
+                    return False
+            elif str(container_info.get(key.upper())) not in values:
+                return False
+        return True
+
+    @staticmethod
+    def ps(filters=None, fmt=None, quiet=False):
         header = [
             "ID",
             "PID",
@@ -252,38 +988,213 @@ class Container:
             "CREATE_TIME",
             "STATUS",
             "NAME",
+            "LAST_EVENT",
+        ]
+        filters = Container.parse_filters(filters)
+        containers = [
+            container_info
+            for container_info in Container.reconcile(Container.state_store().list())
+            if Container.match_filters(container_info, filters)
         ]
+        if quiet:
+            for container_info in containers:
+                print(container_info["ID"])
+        elif fmt == "json":
+            print(json.dumps(containers, indent=4))
+        elif fmt and fmt != "table":
+            # 自定义格式，例如 --format "{ID} {NAME} {STATUS}"
+            for container_info in containers:
+                print(fmt.format_map(defaultdict(str, container_info)))
+        else:
+            data = [
+                [str(container_info.get(field) or "") for field in header]
+                for container_info in containers
+            ]
+            print(format_table(data, header))
+
+    @staticmethod
+    def log_path(container_id):
+        return os.path.join(info_path, container_id, container_id + "-json.log")
+
+    @staticmethod
+    def events_path(container_id):
+        return os.path.join(info_path, container_id, "events.log")
+
+    @staticmethod
+    def trace_path(container_id):
+        return os.path.join(traces_path, container_id + ".json")
+
+    @staticmethod
+    def trace(container_id):
+        # 容器删除之后追踪文件还在，先按 ID 直接找，找不到再按名字和前缀解析
+        path = Container.trace_path(container_id)
+        if not os.path.exists(path):
+            path = Container.trace_path(Container.resolve(container_id))
+        if not os.path.exists(path):
+            print(
+                f"no trace for container {container_id}, run it with MYDOCKER_TRACE=1"
+            )
+            sys.exit(1)
+        events = load_trace(path)
+        names = {
+            event["pid"]: event["args"]["name"]
+            for event in events
+            if event["ph"] == "M" and event["name"] == "process_name"
+        }
+        spans = sorted(
+            (event for event in events if event["ph"] == "X"),
+            key=lambda event: (event["ts"], -event["dur"]),
+        )
+        if not spans:
+            print(f"trace {path} is empty")
+            return
+        start = spans[0]["ts"]
         data = []
-        for container_id in os.listdir(info_path):
-            with open(
-                os.path.join(info_path, container_id, "config.json")
-            ) as json_file:
-                container_info = json.load(json_file)
-                data.append([str(container_info[field]) for field in header])
-        print(tabulate(data, headers=header))
+        # 按时间包含关系缩进，同一个进程里结束时间在外层 span 之内的算作子 span
+        stacks = defaultdict(list)
+        for event in spans:
+            stack = stacks[event["pid"]]
+            while stack and stack[-1] < event["ts"] + event["dur"]:
+                stack.pop()
+            data.append(
+                [
+                    f"{names.get(event['pid'], '')}({event['pid']})",
+                    "  " * len(stack) + event["name"],
+                    f"{(event['ts'] - start) / 1000:.3f}",
+                    f"{event['dur'] / 1000:.3f}",
+                ]
+            )
+            stack.append(event["ts"] + event["dur"])
+        end = max(event["ts"] + event["dur"] for event in spans)
+        print(format_table(data, ["PROCESS", "SPAN", "START(ms)", "DURATION(ms)"]))
+        print(f"total: {(end - start) / 1000:.3f}ms, chrome trace: {path}")
 
     @staticmethod
-    def logs(container_id):
-        log_path = os.path.join(info_path, container_id, container_id + "-json.log")
+    def logs(
+        container_id, tail=None, follow=False, since=None, until=None, timestamps=False
+    ):
+        container_id = Container.resolve(container_id)
+        log_path = Container.log_path(container_id)
         if not os.path.exists(log_path):
             print("no logs available")
             return
-        with open(log_path) as f:
-            for line in f:
-                print(line, end="")
+
+        def alive():
+            container_info = Container.get_info_by_container_id(container_id)
+            return any(
+                c["STATUS"] == "running" for c in Container.reconcile([container_info])
+            )
+
+        from .logger import LogReader
+
+        LogReader(log_path).print(tail, follow, since, until, timestamps, alive)
+
+    @staticmethod
+    def stats(container_ids=None, stream=True, fmt=None):
+        header = [
+            "ID",
+            "NAME",
+            "CPU %",
+            "MEM USAGE / LIMIT",
+            "MEM PEAK",
+            "PIDS",
+            "BLOCK I/O",
+            "PSI CPU/MEM/IO",
+            "OOM KILLS",
+        ]
+        if container_ids:
+            container_ids = [Container.resolve(c) for c in container_ids]
+        # 每个容器打开的统计文件 fd 在多次采样之间复用，容器多时需要放开 fd 数量限制
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        managers = {}
+        previous = {}
+        # 第一轮只记录 CPU 用量作为基准，CPU% 需要两次采样的差值
+        first = True
+        while True:
+            if container_ids:
+                # 采样期间被删除的容器查不到状态，跳过
+                containers = [
+                    container_info
+                    for container_info in map(
+                        Container.get_info_by_container_id, container_ids
+                    )
+                    if container_info
+                ]
+            else:
+                containers = Container.state_store().list("running")
+            for container_id in set(managers) - {c["ID"] for c in containers}:
+                managers.pop(container_id).close()
+            samples = []
+            for container_info in containers:
+                container_id = container_info["ID"]
+                if container_id not in managers:
+                    managers[container_id] = CgroupManager(container_id)
+                stat = managers[container_id].stat()
+                now = time.monotonic()
+                cpu_percent = 0.0
+                if "cpu_usage" in stat and container_id in previous:
+                    last_usage, last_time = previous[container_id]
+                    cpu_percent = (
+                        (stat["cpu_usage"] - last_usage) / (now - last_time) / 1e7
+                    )
+                if "cpu_usage" in stat:
+                    previous[container_id] = (stat["cpu_usage"], now)
+                stat["cpu_percent"] = round(cpu_percent, 2)
+                samples.append(
+                    {"ID": container_id, "NAME": container_info.get("NAME"), **stat}
+                )
+            if not first:
+                Container.print_stats(samples, header, stream, fmt)
+                if not stream:
+                    break
+            first = False
+            time.sleep(1)
+        for manager in managers.values():
+            manager.close()
+
+    @staticmethod
+    def print_stats(samples, header, stream, fmt):
+        if fmt == "json":
+            # 每行一个 JSON 对象，方便其他程序持续读取
+            for sample in samples:
+                print(json.dumps(sample))
+            sys.stdout.flush()
+            return
+        data = []
+        for sample in samples:
+            limit = sample.get("mem_limit")
+            data.append(
+                [
+                    sample["ID"],
+                    sample["NAME"],
+                    f"{sample['cpu_percent']:.2f}%",
+                    f"{format_size(sample.get('mem_usage', 0))} / "
+                    + (format_size(limit) if limit else "unlimited"),
+                    format_size(sample.get("mem_peak", 0)),
+                    str(sample.get("pids", "--")),
+                    f"{format_size(sample.get('io_read', 0))} / "
+                    f"{format_size(sample.get('io_write', 0))}",
+                    "/".join(
+                        f"{sample[key]:.1f}" if key in sample else "--"
+                        for key in ["cpu_pressure", "mem_pressure", "io_pressure"]
+                    ),
+                    str(sample.get("oom_kill", "--")),
+                ]
+            )
+        if stream:
+            # 清屏后从左上角重新输出
+            print("\033[2J\033[H", end="")
+        print(format_table(data, header), flush=True)
 
     @staticmethod
     def get_info_by_container_id(container_id):
-        container_info = {}
-        config_path = os.path.join(info_path, container_id, "config.json")
-        if not os.path.exists(config_path):
-            return {}
-        with open(config_path) as json_file:
-            container_info = json.load(json_file)
-        return container_info
+        return Container.state_store().get(container_id)
 
     @staticmethod
     def exec(container_id, command):
+        container_id = Container.resolve(container_id)
         pid = Container.get_info_by_container_id(container_id)["PID"]
         with open(f"/proc/{pid}/environ") as f:
             env = f.read().strip("\x00").split("\x00")
@@ -307,22 +1218,196 @@ class Container:
         os.execve(command[0], command, os.environ)
 
     @staticmethod
-    def stop(container_id):
-        container_info = Container.get_info_by_container_id(container_id)
-        pid = container_info["PID"]
-        os.kill(pid, signal.SIGKILL)
-        container_info["PID"] = ""
-        container_info["STATUS"] = "stopped"
-        Container.set_container_info(container_id, container_info)
+    def select(container_ids, filters):
+        # stop、rm 的目标：命令行中的名字或 ID，加上匹配 --filter 的所有容器
+        if not container_ids and not filters:
+            print("requires at least one container or --filter")
+            sys.exit(1)
+        selected = {}
+        for name_or_id in container_ids or []:
+            container_id = Container.resolve(name_or_id)
+            selected[container_id] = Container.get_info_by_container_id(container_id)
+        if filters:
+            filters = Container.parse_filters(filters)
+            for container_info in Container.state_store().list():
+                if Container.match_filters(container_info, filters):
+                    selected[container_info["ID"]] = container_info
+        return Container.reconcile(list(selected.values()))
 
     @staticmethod
-    def rm(container_id, force=False):
-        container_info = Container.get_info_by_container_id(container_id)
-        status = container_info["STATUS"]
-        if status == "running":
-            if not force:
-                print("container is running, please stop it first")
-                return
-            Container.stop(container_id)
-        shutil.rmtree(os.path.join(info_path, container_id))
-        Container.delete_work_space(container_id, container_info["Volume"])
+    def stop(container_ids, filters=None, timeout=10):
+        # 已经停止的容器不用处理，和 docker 一样照常输出
+        containers = Container.select(container_ids, filters)
+        Container.stop_many(
+            [c for c in containers if c["STATUS"] == "running"], timeout
+        )
+        for container_info in containers:
+            print(container_info["ID"])
+
+    @staticmethod
+    def stop_many(containers, timeout):
+        # 先给所有容器发 SIGTERM，在同一个截止时间内等待它们退出，超时的再 SIGKILL，
+        # 停止 N 个容器最多等待一个 timeout；timeout 为 0 时直接 SIGKILL
+        if not containers:
+            return
+        # 先改成 stopped，mydockerd 收到退出事件时不会再改成 exited
+        Container.state_store().update_many(
+            {
+                container_info["ID"]: {"PID": "", "STATUS": "stopped"}
+                for container_info in containers
+            }
+        )
+        pidfds = []
+        for container_info in containers:
+            pid = container_info["PID"]
+            if not pid:
+                continue
+            try:
+                pidfd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                continue
+            # 打开 pidfd 之后再检查启动时间，之后通过 pidfd 发信号不会发给复用了 PID 的进程
+            if proc_start_time(pid) != container_info.get("START_TIME"):
+                os.close(pidfd)
+                continue
+            pidfds.append(pidfd)
+        alive = pidfds
+        if timeout > 0:
+            Container.signal_pidfds(alive, signal.SIGTERM)
+            alive = Container.wait_pidfds(alive, timeout)
+        Container.signal_pidfds(alive, signal.SIGKILL)
+        Container.wait_pidfds(alive, None)
+        for pidfd in pidfds:
+            os.close(pidfd)
+        Container.release_resources(
+            [container_info["ID"] for container_info in containers]
+        )
+
+    @staticmethod
+    def signal_pidfds(pidfds, sig):
+        for pidfd in pidfds:
+            try:
+                signal.pidfd_send_signal(pidfd, sig)
+            except ProcessLookupError:
+                pass
+
+    @staticmethod
+    def wait_pidfds(pidfds, timeout):
+        # 进程退出后 pidfd 变为可读，返回超时后还没有退出的
+        poller = select.poll()
+        for pidfd in pidfds:
+            poller.register(pidfd, select.POLLIN)
+        alive = set(pidfds)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while alive:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+            for pidfd, _ in poller.poll(
+                None if remaining is None else remaining * 1000
+            ):
+                poller.unregister(pidfd)
+                alive.discard(pidfd)
+        return [pidfd for pidfd in pidfds if pidfd in alive]
+
+    @staticmethod
+    def rm(container_ids, filters=None, force=False):
+        containers = Container.select(container_ids, filters)
+        running = [c for c in containers if c["STATUS"] == "running"]
+        if running and not force:
+            for container_info in running:
+                print(
+                    f"container {container_info['NAME']} is running, please stop it first"
+                )
+            containers = [c for c in containers if c["STATUS"] != "running"]
+        elif running:
+            Container.stop_many(running, 0)
+        ids = [container_info["ID"] for container_info in containers]
+        Container.release_resources(ids)
+        Container.delete_work_spaces(
+            [
+                (container_info["ID"], container_info["VOLUME"])
+                for container_info in containers
+            ]
+        )
+        Container.state_store().delete_many(ids)
+        for container_id in ids:
+            shutil.rmtree(os.path.join(info_path, container_id), ignore_errors=True)
+            print(container_id)
+
+    @staticmethod
+    def prune():
+        # 扫描 overlay 目录、cgroup、网桥上的 veth、NAT 表和 IPAM，和状态数据库对比，一次回收没有容器引用的资源
+        from network import Network
+
+        from .layer_store import LayerStore
+        from .pool import SandboxPool
+        from .trash import Trash
+
+        store = Container.state_store()
+        # 没有 mydockerd 时后台容器退出后没有人释放资源，先补上
+        Container.release_resources(
+            [
+                container_info["ID"]
+                for container_info in Container.reconcile(store.list())
+                if container_info["STATUS"] != "running"
+            ]
+        )
+        containers = store.list()
+        sandboxes = SandboxPool().sandboxes()
+        # 刚创建的工作目录可能属于还在启动中、还没有记录状态的 run 或者正在补充的沙箱，留到下次再清理
+        work_spaces = []
+        if os.path.exists(overlay_path):
+            work_spaces = [
+                entry
+                for entry in os.scandir(overlay_path)
+                if entry.is_dir() and not entry.name.startswith(".")
+            ]
+        sandbox_ids = {sandbox["ID"] for sandbox in sandboxes}
+        recorded_ids = {c["ID"] for c in containers} | sandbox_ids
+        starting = {
+            entry.name
+            for entry in work_spaces
+            if entry.name not in recorded_ids
+            and time.time() - entry.stat().st_mtime < prune_grace
+        }
+        known_ids = recorded_ids | starting
+        active = [c for c in containers if not c.get("RELEASED")]
+        active_ids = {c["ID"] for c in active} | sandbox_ids | starting
+        active_ips = {c["IP"] for c in active if c.get("IP")} | {
+            sandbox["IP"] for sandbox in sandboxes if sandbox["IP"]
+        }
+        # 旧版本的容器没有记录 IP，有这样的容器或者有容器正在启动时不回收 IP
+        reclaim_ips = not starting and all(
+            c.get("IP") or not c.get("NETWORK") for c in active
+        )
+        reclaimed = []
+        orphans = [entry.name for entry in work_spaces if entry.name not in known_ids]
+        Container.delete_work_spaces([(container_id, None) for container_id in orphans])
+        # 回收站中还有没删完的目录时继续删除
+        Trash().spawn_reaper()
+        reclaimed.extend(("overlay", container_id) for container_id in orphans)
+        reclaimed.extend(
+            ("layer ref", f"{container_id} -> {digest[:12]}")
+            for container_id, digest in LayerStore().prune_refs(known_ids)
+        )
+        for name in sorted(CgroupManager.list_cgroups()):
+            if not container_id_pattern.fullmatch(name) or name in active_ids:
+                continue
+            try:
+                CgroupManager(name).remove()
+                reclaimed.append(("cgroup", name))
+            except OSError as e:
+                print(f"failed to remove cgroup {name}: {e}")
+        reclaimed.extend(Network.prune(active_ids, active_ips, reclaim_ips))
+        if not reclaim_ips:
+            print(
+                "skip reclaiming ip addresses: containers are starting or have no ip recorded"
+            )
+        if reclaimed:
+            print(
+                format_table([list(item) for item in reclaimed], ["TYPE", "RESOURCE"])
+            )
+        print(f"reclaimed {len(reclaimed)} resources")
@@ -0,0 +1,274 @@
+import asyncio
+import json
+import os
+import resource
+import select
+import signal
+import socket
+import sys
+import traceback
+
+from utility import proc_start_time, set_child_subreaper
+
+from .cgroup_manager import CgroupManager
+from .client import daemon_socket_path
+from .container import Container
+from .monitor import EventMonitor
+from .trash import Trash
+
+
+class Daemon:
+    # 常驻的 mydockerd：命令通过 unix socket 转发过来，daemon fork 出工作进程执行，不用每次重新启动解释器；
+    # daemon 设置了 PR_SET_CHILD_SUBREAPER，工作进程启动的后台容器在工作进程退出后由 daemon 收养，
+    # 每个容器一个 pidfd 注册到 asyncio 事件循环中，容器退出时删除 cgroup、清除端口映射并记录退出码；
+    # cgroup v2 下容器的 PSI 触发器和 memory.events 也在这里监控，不用每个容器一个监控进程
+    def __init__(self, handler, socket_path=daemon_socket_path) -> None:
+        # handler 为 main.py 中的 main(argv)
+        self.handler = handler
+        self.socket_path = socket_path
+        # 容器 ID -> (PID, pidfd)
+        self.containers = {}
+        self.workers = set()
+        # 容器 ID -> EventMonitor，以及所有监控 fd -> EventMonitor
+        self.monitors = {}
+        self.monitor_fds = {}
+
+    def serve(self):
+        set_child_subreaper()
+        # 工作进程启动的容器交给 daemon 监控，每个容器要占用 pidfd、PSI 和 inotify 等多个 fd
+        Container.monitor_in_daemon = True
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        # 继续删除上次没有删完的回收站
+        Trash().spawn_reaper()
+        asyncio.run(self.main())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        listener = self.listen()
+        stopped = loop.create_future()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, stopped.set_result, None)
+        loop.add_signal_handler(signal.SIGCHLD, self.reap)
+        # PSI 触发器只产生 POLLPRI，asyncio 只等待可读，所以监控 fd 放在一个单独的 epoll 里，
+        # 再把这个 epoll 注册到事件循环
+        self.monitor_epoll = select.epoll()
+        loop.add_reader(self.monitor_epoll.fileno(), self.monitor_ready)
+        # daemon 启动前就在运行的后台容器也接管过来
+        self.sync()
+        loop.add_reader(listener.fileno(), self.accept, listener)
+        print(f"mydockerd listening on {self.socket_path}", flush=True)
+        try:
+            await stopped
+        finally:
+            loop.remove_reader(listener.fileno())
+            listener.close()
+            os.unlink(self.socket_path)
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            # 能连上说明已经有一个 daemon 在运行，连不上就是上次异常退出留下的 socket 文件
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                try:
+                    conn.connect(self.socket_path)
+                    print("mydockerd is already running")
+                    sys.exit(1)
+                except ConnectionRefusedError:
+                    os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        listener.listen(128)
+        listener.setblocking(False)
+        return listener
+
+    def accept(self, listener):
+        try:
+            conn, _ = listener.accept()
+        except BlockingIOError:
+            return
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # 工作进程不使用事件循环，恢复默认的信号处理
+                signal.set_wakeup_fd(-1)
+                for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGCHLD]:
+                    signal.signal(sig, signal.SIG_DFL)
+                listener.close()
+                conn.setblocking(True)
+                self.handle(conn)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        conn.close()
+        self.workers.add(pid)
+
+    def handle(self, conn):
+        # 在工作进程中执行：标准输入输出换成客户端的，执行命令，最后把退出码发回去
+        message, fds, _, _ = socket.recv_fds(conn, 1 << 20, 3)
+        request = json.loads(message)
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.chdir(request["cwd"])
+        code = 0
+        try:
+            self.handler(request["argv"])
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(json.dumps({"exit": code}).encode())
+
+    def sync(self):
+        # 把状态数据库中还没有接管的后台容器注册到事件循环；前台运行的容器由 run 自己等待和清理
+        for container_info in Container.state_store().list("running"):
+            container_id = container_info["ID"]
+            if container_id in self.containers or container_info.get("TTY"):
+                continue
+            pid = container_info["PID"]
+            if not pid or proc_start_time(pid) != container_info.get("START_TIME"):
+                self.exited(container_id, None, container_info)
+                continue
+            try:
+                pidfd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                self.exited(container_id, None, container_info)
+                continue
+            self.containers[container_id] = (pid, pidfd)
+            self.loop.add_reader(pidfd, self.pidfd_ready, container_id)
+            self.watch_events(container_id, container_info)
+
+    def watch_events(self, container_id, container_info):
+        # 在 daemon 之外启动的容器已经有自己的监控进程
+        monitor_pid = container_info.get("MONITOR_PID")
+        if monitor_pid and proc_start_time(monitor_pid) is not None:
+            return
+        cgroup_manager = CgroupManager(container_id)
+        if cgroup_manager.cgroup_version != 2:
+            return
+        monitor = EventMonitor(
+            container_id,
+            container_info["PID"],
+            cgroup_manager.subsystems[0].get_cgroup_path(container_id, False),
+            Container.events_path(container_id),
+        )
+        try:
+            dir_fd = os.open(
+                monitor.cgroup_path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+            )
+        except OSError:
+            return
+        try:
+            fds = monitor.open(dir_fd)
+        except OSError:
+            os.close(dir_fd)
+            traceback.print_exc()
+            return
+        for fd, events in fds.items():
+            self.monitor_epoll.register(fd, events)
+            self.monitor_fds[fd] = monitor
+        self.monitors[container_id] = monitor
+
+    def unwatch_events(self, container_id):
+        monitor = self.monitors.pop(container_id, None)
+        if monitor is None:
+            return
+        for fd in monitor.fds:
+            self.monitor_epoll.unregister(fd)
+            self.monitor_fds.pop(fd)
+        monitor.close()
+
+    def monitor_ready(self):
+        for fd, event in self.monitor_epoll.poll(0):
+            monitor = self.monitor_fds.get(fd)
+            if monitor is None:
+                continue
+            try:
+                if event & select.EPOLLERR:
+                    # cgroup 已经被删除，剩下的清理在容器退出时做
+                    self.monitor_epoll.unregister(fd)
+                    self.monitor_fds.pop(fd)
+                    monitor.fds.pop(fd)
+                    continue
+                monitor.handle(fd)
+            except Exception:
+                traceback.print_exc()
+
+    def pidfd_ready(self, container_id):
+        if container_id not in self.containers:
+            return
+        _, pidfd = self.containers[container_id]
+        code = None
+        try:
+            result = os.waitid(os.P_PIDFD, pidfd, os.WEXITED | os.WNOHANG)
+            if result is not None:
+                code = Daemon.exit_code(result.si_code, result.si_status)
+        except ChildProcessError:
+            # daemon 启动前就在运行的容器不是 daemon 的子进程，拿不到退出码
+            pass
+        self.exited(container_id, code)
+
+    def reap(self):
+        # SIGCHLD：回收工作进程，以及收养的日志 shim、事件监控等进程；容器进程在这里被回收时也要清理
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self.workers:
+                self.workers.discard(pid)
+                # 工作进程可能启动了新的容器
+                self.sync()
+                continue
+            for container_id, (container_pid, _) in list(self.containers.items()):
+                if container_pid == pid:
+                    code = os.waitstatus_to_exitcode(status)
+                    self.exited(container_id, code if code >= 0 else 128 - code)
+
+    @staticmethod
+    def exit_code(si_code, si_status):
+        # 和 shell 一样，被信号杀死时退出码为 128 + 信号值
+        if si_code == os.CLD_EXITED:
+            return si_status
+        return 128 + si_status
+
+    def exited(self, container_id, code, container_info=None):
+        if container_id in self.containers:
+            _, pidfd = self.containers.pop(container_id)
+            self.loop.remove_reader(pidfd)
+            os.close(pidfd)
+        try:
+            # 要在删除 cgroup 之前，最后一次检查 memory.events
+            self.unwatch_events(container_id)
+            if container_info is None:
+                container_info = Container.state_store().get(container_id)
+            # 已经被 rm 删除的容器不用再处理
+            if not container_info:
+                return
+            Container.release_resources([container_id])
+            # stop 已经把状态改成了 stopped，这里只更新还是 running 的
+            if container_info["STATUS"] == "running":
+                Container.set_container_info(
+                    container_id, {"STATUS": "exited", "PID": "", "EXIT_CODE": code}
+                )
+        except Exception:
+            # 一个容器清理失败不能影响 daemon 继续运行
+            traceback.print_exc()
@@ -0,0 +1,306 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import stat
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+WHITEOUT_PREFIX = ".wh."
+WHITEOUT_OPAQUE = ".wh..wh..opq"
+OPAQUE_XATTR = "trusted.overlay.opaque"
+# 小于这个大小的文件读进内存后交给线程池写，更大的文件直接在主线程流式写，避免占用过多内存
+SMALL_FILE_SIZE = 4 << 20
+CHUNK_SIZE = 1 << 20
+BATCH_FILES = 64
+
+
+class DecompressReader:
+    # 在单独的线程里读取并解压镜像，通过有界队列把数据块交给 tar 解析，解压和写文件可以同时进行
+    def __init__(self, path) -> None:
+        self.queue = queue.Queue(maxsize=16)
+        self.chunk = b""
+        self.chunk_start = 0
+        self.pos = 0
+        self.eof = False
+        self.error = None
+        self.thread = threading.Thread(target=self.produce, args=(path,), daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def opener(path):
+        with open(path, "rb") as f:
+            magic = f.read(6)
+        if magic.startswith(b"\x1f\x8b"):
+            return gzip.open(path, "rb")
+        if magic.startswith(b"\xfd7zXZ\x00"):
+            return lzma.open(path, "rb")
+        if magic.startswith(b"BZh"):
+            return bz2.open(path, "rb")
+        return open(path, "rb")
+
+    def produce(self, path):
+        try:
+            with DecompressReader.opener(path) as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    self.queue.put(chunk)
+        except Exception as e:
+            self.error = e
+        self.queue.put(None)
+
+    def next_chunk(self):
+        if self.eof:
+            return False
+        chunk = self.queue.get()
+        if chunk is None:
+            self.eof = True
+            if self.error is not None:
+                raise self.error
+            return False
+        self.chunk_start += len(self.chunk)
+        self.chunk, self.pos = chunk, 0
+        return True
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self.pos >= len(self.chunk):
+                if not self.next_chunk():
+                    break
+                continue
+            end = len(self.chunk) if size < 0 else self.pos + size
+            piece = self.chunk[self.pos : end]
+            self.pos += len(piece)
+            if size > 0:
+                size -= len(piece)
+            pieces.append(piece)
+        return b"".join(pieces)
+
+    def tell(self):
+        return self.chunk_start + self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # 解压后的数据只能向前读，tarfile 按顺序处理成员时只会在当前块内或向前 seek
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        if offset < self.chunk_start or whence == os.SEEK_END:
+            raise io.UnsupportedOperation("DecompressReader can only seek forward")
+        while offset > self.chunk_start + len(self.chunk):
+            if not self.next_chunk():
+                self.pos = len(self.chunk)
+                return self.tell()
+        self.pos = offset - self.chunk_start
+        return offset
+
+
+class Extractor:
+    # 流式解压 tar：目录、符号链接、设备文件在主线程按顺序创建，普通文件的内容交给线程池写，
+    # 硬链接等所有文件写完后按顺序创建，最后统一设置 owner、权限和时间
+    def __init__(self, dest, workers=None, whiteouts=False) -> None:
+        self.dest = os.path.realpath(dest)
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        # 为 true 时把 .wh. 文件转换成 overlayfs 的 whiteout
+        self.whiteouts = whiteouts
+        self.safe_dirs = {self.dest}
+        self.created = set()
+
+    def safe_path(self, name):
+        # 过滤掉绝对路径、.. 以及通过符号链接逃出目标目录的路径
+        parts = [p for p in name.split("/") if p not in ("", ".")]
+        if not parts or ".." in parts:
+            return None
+        path = os.path.join(self.dest, *parts)
+        parent = os.path.dirname(path)
+        if parent not in self.safe_dirs:
+            real_parent = os.path.realpath(parent)
+            if not self.inside(real_parent):
+                return None
+            # 父目录可能是指向还不存在的目录的符号链接，按真实路径创建
+            os.makedirs(real_parent, mode=0o755, exist_ok=True)
+            self.safe_dirs.add(parent)
+        return path
+
+    def inside(self, real_path):
+        return real_path == self.dest or real_path.startswith(self.dest + os.sep)
+
+    @staticmethod
+    def write_files(batch):
+        for path, data in batch:
+            fd = os.open(
+                path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600
+            )
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view) :]
+            finally:
+                os.close(fd)
+
+    def flush(self):
+        # 小文件攒成一批再提交给线程池，减少每个文件一次 submit 的开销
+        if not self.batch:
+            return
+        self.slots.acquire()
+        future = self.pool.submit(Extractor.write_files, self.batch)
+        future.add_done_callback(lambda _: self.slots.release())
+        for path, _ in self.batch:
+            self.pending[path] = future
+        self.batch = []
+        self.batch_size = 0
+
+    def wait(self, path):
+        # 同一个路径在 tar 中出现多次时，后面的要覆盖前面的，需要先等前一次写完
+        if path not in self.pending:
+            return
+        if self.pending[path] is None:
+            self.flush()
+        self.pending.pop(path).result()
+
+    def drain(self):
+        # 等待所有还没写完的文件
+        self.flush()
+        for future in set(self.pending.values()):
+            future.result()
+        self.pending = {}
+
+    @staticmethod
+    def write_stream(path, fileobj, size):
+        # 全零的块直接跳过，最后 ftruncate 到原大小，这样稀疏文件在磁盘上仍然是稀疏的
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+        try:
+            offset = 0
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+                if chunk.count(0) != len(chunk):
+                    os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    def remove(self, path):
+        # 目标目录应该是空的，只有同一个 tar 里前面已经创建过的路径才需要先删除，省掉每个文件一次 lstat
+        if path in self.created and (os.path.islink(path) or not os.path.isdir(path)):
+            os.unlink(path)
+        self.created.add(path)
+
+    def extract(self, tar_path):
+        os.makedirs(self.dest, exist_ok=True)
+        # 路径 -> 成员，同一个路径在 tar 中出现多次时只保留最后一个，前面的成员已经被替换掉了
+        metadata = {}
+        hardlinks = {}
+        opaque_dirs = []
+        self.pending = {}
+        self.batch = []
+        self.batch_size = 0
+        # 限制还没写完的批次数，避免解压比写盘快时内存无限增长
+        self.slots = threading.BoundedSemaphore(self.workers * 2)
+        reader = DecompressReader(tar_path)
+        with ThreadPoolExecutor(max_workers=self.workers) as self.pool, tarfile.open(
+            fileobj=reader, mode="r:"
+        ) as tar:
+            for member in tar:
+                path = self.safe_path(member.name)
+                if path is None:
+                    print(f"skip unsafe path in image: {member.name}")
+                    continue
+                name = os.path.basename(path)
+                if self.whiteouts and name.startswith(WHITEOUT_PREFIX):
+                    if name == WHITEOUT_OPAQUE:
+                        opaque_dirs.append(os.path.dirname(path))
+                    else:
+                        target = os.path.join(
+                            os.path.dirname(path), name[len(WHITEOUT_PREFIX) :]
+                        )
+                        self.remove(target)
+                        os.mknod(target, 0o600 | stat.S_IFCHR, os.makedev(0, 0))
+                        metadata.pop(target, None)
+                        hardlinks.pop(target, None)
+                    continue
+                self.wait(path)
+                metadata.pop(path, None)
+                hardlinks.pop(path, None)
+                if member.isdir():
+                    os.makedirs(path, mode=0o700, exist_ok=True)
+                elif member.islnk():
+                    target = self.safe_path(member.linkname)
+                    if target is None:
+                        print(f"skip unsafe hardlink in image: {member.name}")
+                        continue
+                    hardlinks[path] = target
+                    continue
+                elif member.issym():
+                    if path in self.created:
+                        # 替换已有的符号链接前先等线程池写完，否则排队中的文件会经过新的符号链接写到目标目录外
+                        self.drain()
+                    self.remove(path)
+                    os.symlink(member.linkname, path)
+                    # 新的符号链接可能改变已校验过的目录的真实路径
+                    self.safe_dirs = {self.dest}
+                elif member.ischr() or member.isblk() or member.isfifo():
+                    self.remove(path)
+                    mode = stat.S_IFIFO
+                    if member.ischr():
+                        mode = stat.S_IFCHR
+                    elif member.isblk():
+                        mode = stat.S_IFBLK
+                    os.mknod(
+                        path, 0o600 | mode, os.makedev(member.devmajor, member.devminor)
+                    )
+                elif member.isreg():
+                    self.remove(path)
+                    fileobj = tar.extractfile(member)
+                    if member.issparse() or member.size > SMALL_FILE_SIZE:
+                        Extractor.write_stream(path, fileobj, member.size)
+                    else:
+                        data = fileobj.read()
+                        self.batch.append((path, data))
+                        self.batch_size += len(data)
+                        self.pending[path] = None
+                        if (
+                            len(self.batch) >= BATCH_FILES
+                            or self.batch_size >= CHUNK_SIZE
+                        ):
+                            self.flush()
+                else:
+                    continue
+                metadata[path] = member
+            self.drain()
+        for path, target in hardlinks.items():
+            # 和 apply_metadata 一样，父目录可能已经被换成了指向目标目录外的符号链接
+            if not self.inside(
+                os.path.realpath(os.path.dirname(target))
+            ) or not self.inside(os.path.realpath(os.path.dirname(path))):
+                print(f"skip unsafe hardlink in image: {path}")
+                continue
+            self.remove(path)
+            os.link(target, path)
+        for path in opaque_dirs:
+            os.setxattr(path, OPAQUE_XATTR, b"y")
+        self.apply_metadata(metadata)
+
+    def apply_metadata(self, metadata):
+        # 目录要最后按从深到浅的顺序处理，否则在目录里创建文件会改掉目录的 mtime
+        is_root = os.geteuid() == 0
+        files = [(path, m) for path, m in metadata.items() if not m.isdir()]
+        dirs = [(path, m) for path, m in metadata.items() if m.isdir()]
+        for path, member in files + dirs[::-1]:
+            # 解压过程中父目录可能被后面的成员换成了符号链接，重新检查真实路径；
+            # Linux 上 chmod 不支持 follow_symlinks=False，路径本身是符号链接时不能 chmod
+            if not self.inside(os.path.realpath(os.path.dirname(path))):
+                print(f"skip unsafe path in image: {path}")
+                continue
+            st = os.lstat(path)
+            if is_root:
+                os.lchown(path, member.uid, member.gid)
+            if not stat.S_ISLNK(st.st_mode):
+                os.chmod(path, member.mode & 0o7777)
+            os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
+
+
+if __name__ == "__main__":
+    import sys
+
+    Extractor(sys.argv[2]).extract(sys.argv[1])
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import time
+
+from utility import file_lock, parse_size
+
+base_path = os.path.dirname(os.path.dirname(__file__))
+layers_path = os.path.join(base_path, "layers")
+# 只读层缓存的磁盘预算，超过之后按 LRU 淘汰没有容器引用的层
+default_layer_budget = os.environ.get("MYDOCKER_LAYER_BUDGET", "10g")
+
+
+class LayerStore:
+    def __init__(self, root=layers_path, budget=default_layer_budget) -> None:
+        self.root = root
+        self.budget = parse_size(budget)
+        self.meta_path = os.path.join(root, "layers.json")
+        self.lock_path = os.path.join(root, "layers.lock")
+
+    def load(self):
+        if not os.path.exists(self.meta_path):
+            self.meta = {"images": {}, "layers": {}}
+            return
+        with open(self.meta_path, "r") as f:
+            self.meta = json.load(f)
+
+    def dump(self):
+        # 先写临时文件再 rename，保证 layers.json 不会被写坏
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, indent=4)
+        os.replace(tmp_path, self.meta_path)
+
+    def layer_path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def digest(self, image_path):
+        # 计算镜像 tar 的 sha256，用 (size, mtime) 缓存结果，避免每次 run 都重新读整个 tar
+        st = os.stat(image_path)
+        image_path = os.path.abspath(image_path)
+        cached = self.meta["images"].get(image_path)
+        if (
+            cached
+            and cached["size"] == st.st_size
+            and cached["mtime_ns"] == st.st_mtime_ns
+        ):
+            return cached["digest"]
+        digest = LayerStore.file_digest(image_path)
+        self.meta["images"][image_path] = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "digest": digest,
+        }
+        return digest
+
+    @staticmethod
+    def file_digest(path):
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def extract(self, image_path, digest):
+        # 先解压到临时目录，完成后再原子 rename 成正式的层目录
+        tmp_path = self.layer_path(f".tmp-{digest}")
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path, mode=0o755)
+        # 解压和打包用到的 tarfile、线程池只在第一次使用镜像和 commit 时才导入
+        from .extractor import Extractor
+
+        Extractor(tmp_path, whiteouts=True).extract(image_path)
+        os.rename(tmp_path, self.layer_path(digest))
+        return LayerStore.disk_usage(self.layer_path(digest))
+
+    @staticmethod
+    def diff(upper_path, tar_path):
+        # 只打包容器的 upper 目录，并把 overlayfs 的 whiteout 转换成可移植的 .wh. 文件
+        import tarfile
+
+        from .extractor import WHITEOUT_OPAQUE, WHITEOUT_PREFIX
+
+        with tarfile.open(tar_path, "w") as tar:
+            for root, dirs, files in os.walk(upper_path):
+                dirs.sort()
+                for name in sorted(dirs + files):
+                    path = os.path.join(root, name)
+                    arcname = os.path.relpath(path, upper_path)
+                    st = os.lstat(path)
+                    if stat.S_ISCHR(st.st_mode) and st.st_rdev == os.makedev(0, 0):
+                        whiteout = os.path.join(
+                            os.path.dirname(arcname), WHITEOUT_PREFIX + name
+                        )
+                        tar.addfile(tarfile.TarInfo(whiteout))
+                        continue
+                    tar.add(path, arcname=arcname, recursive=False)
+                    if stat.S_ISDIR(st.st_mode) and LayerStore.is_opaque(path):
+                        opaque = tarfile.TarInfo(os.path.join(arcname, WHITEOUT_OPAQUE))
+                        tar.addfile(opaque)
+
+    @staticmethod
+    def is_opaque(path):
+        from .extractor import OPAQUE_XATTR
+
+        try:
+            return os.getxattr(path, OPAQUE_XATTR, follow_symlinks=False) == b"y"
+        except OSError:
+            return False
+
+    @staticmethod
+    def disk_usage(path):
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+        return total
+
+    def acquire(self, image_path, container_id):
+        # 返回镜像对应的只读层目录，并记录容器对该层的引用
+        return self.acquire_many([image_path], [container_id])[0]
+
+    def acquire_many(self, image_paths, container_ids):
+        # 在一次加锁中取得镜像的所有层，并记录每个容器对这些层的引用，--replicas 批量启动时共用
+        lower_paths = []
+        with file_lock(self.lock_path):
+            self.load()
+            layers = self.meta["layers"]
+            for image_path in image_paths:
+                digest = self.digest(image_path)
+                if digest not in layers or not os.path.exists(self.layer_path(digest)):
+                    layers[digest] = {
+                        "size": self.extract(image_path, digest),
+                        "refs": [],
+                    }
+                layer = layers[digest]
+                for container_id in container_ids:
+                    if container_id not in layer["refs"]:
+                        layer["refs"].append(container_id)
+                layer["last_used"] = time.time()
+                lower_paths.append(self.layer_path(digest))
+            self.evict()
+            self.dump()
+        return lower_paths
+
+    def release(self, container_id):
+        self.release_many([container_id])
+
+    def release_many(self, container_ids):
+        # 容器删除后解除它对所有层的引用，没有引用的层留在缓存里等待 LRU 淘汰
+        container_ids = set(container_ids)
+        with file_lock(self.lock_path):
+            self.load()
+            for layer in self.meta["layers"].values():
+                refs = [ref for ref in layer["refs"] if ref not in container_ids]
+                if len(refs) != len(layer["refs"]):
+                    layer["refs"] = refs
+                    layer["last_used"] = time.time()
+            self.evict()
+            self.dump()
+
+    def prune_refs(self, known_ids):
+        # 解除已经不存在的容器对层的引用，返回解除的引用 [(容器 ID, 层)]
+        if not os.path.exists(self.meta_path):
+            return []
+        removed = []
+        with file_lock(self.lock_path):
+            self.load()
+            for digest, layer in self.meta["layers"].items():
+                stale = [ref for ref in layer["refs"] if ref not in known_ids]
+                if stale:
+                    layer["refs"] = [ref for ref in layer["refs"] if ref in known_ids]
+                    layer["last_used"] = time.time()
+                    removed.extend((ref, digest) for ref in stale)
+            if removed:
+                self.evict()
+                self.dump()
+        return removed
+
+    def evict(self):
+        layers = self.meta["layers"]
+        total = sum(layer["size"] for layer in layers.values())
+        unused = sorted(
+            (digest for digest, layer in layers.items() if not layer["refs"]),
+            key=lambda digest: layers[digest]["last_used"],
+        )
+        for digest in unused:
+            if total <= self.budget:
+                break
+            shutil.rmtree(self.layer_path(digest), ignore_errors=True)
+            total -= layers[digest]["size"]
+            del layers[digest]
+        for image_path, image in list(self.meta["images"].items()):
+            if image["digest"] not in layers:
+                del self.meta["images"][image_path]
+
+
+if __name__ == "__main__":
+    import sys
+
+    store = LayerStore()
+    print(store.acquire(sys.argv[1], "testcontainer"))
+    store.release("testcontainer")
@@ -0,0 +1,428 @@
+import gzip
+import io
+import json
+import os
+import re
+import select
+import selectors
+import shutil
+import sys
+from datetime import datetime, timedelta, timezone
+
+from utility import (
+    IN_CREATE,
+    IN_MODIFY,
+    IN_MOVED_TO,
+    detach_stdio,
+    inotify_add_watch,
+    inotify_init,
+    parse_size,
+)
+
+BLOCK_SIZE = 64 << 10
+
+
+class LogShim:
+    # 容器的 stdout/stderr 通过管道交给 shim 进程，shim 给每一行加上时间戳后按 json 行写入日志文件：
+    # {"log": "hello\n", "stream": "stdout", "time": "2024-01-01T00:00:00.000000+00:00"}
+    # 设置了 max_size 时，日志超过大小后轮转为 <log>.1、<log>.2 ...，最多保留 max_file 个文件
+    def __init__(
+        self, log_path, streams, max_size=None, max_file=1, compress=False
+    ) -> None:
+        self.log_path = log_path
+        # {fd: "stdout" | "stderr"}
+        self.streams = streams
+        self.buffers = {fd: b"" for fd in streams}
+        self.max_size = max_size
+        self.max_file = max_file
+        self.compress = compress
+        # 压缩在后台线程里做，同一时间只压缩一个分段；线程池只在 shim 进程中用到，这里才导入
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.compressor = ThreadPoolExecutor(max_workers=1)
+        self.compressing = None
+
+    @staticmethod
+    def start(log_path, streams, **opts):
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        try:
+            # 脱离 mydocker 进程的会话，mydocker 退出后 shim 继续运行，直到容器关闭管道；
+            # 只保留容器输出的管道，否则 run -d | cat 要等到容器退出才能读到 EOF
+            os.setsid()
+            detach_stdio(keep=streams)
+            LogShim(log_path, streams, **opts).run()
+        finally:
+            os._exit(0)
+
+    def open(self):
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(fd).st_size
+        return os.fdopen(fd, "wb", buffering=0)
+
+    def run(self):
+        log_file = self.open()
+        selector = selectors.DefaultSelector()
+        for stream_fd in self.streams:
+            selector.register(stream_fd, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, BLOCK_SIZE)
+                if not data:
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                data = self.format(key.fd, data, eof=not data)
+                if (
+                    self.max_size
+                    and self.size > 0
+                    and self.size + len(data) > self.max_size
+                ):
+                    log_file.close()
+                    self.rotate()
+                    log_file = self.open()
+                log_file.write(data)
+                self.size += len(data)
+        log_file.close()
+        self.compressor.shutdown(wait=True)
+
+    def rotate(self):
+        # 轮转前要等上一个分段压缩完，否则改名时压缩线程还在读写 <log>.1
+        if self.compressing is not None:
+            self.compressing.result()
+            self.compressing = None
+        for i in range(self.max_file - 1, 0, -1):
+            for suffix in ["", ".gz"]:
+                src = f"{self.log_path}.{i}{suffix}"
+                if not os.path.exists(src):
+                    continue
+                if i == self.max_file - 1:
+                    os.remove(src)
+                else:
+                    os.replace(src, f"{self.log_path}.{i + 1}{suffix}")
+        if self.max_file <= 1:
+            os.remove(self.log_path)
+            return
+        os.replace(self.log_path, f"{self.log_path}.1")
+        if self.compress:
+            self.compressing = self.compressor.submit(
+                LogShim.gzip, f"{self.log_path}.1"
+            )
+
+    @staticmethod
+    def gzip(path):
+        with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst, BLOCK_SIZE)
+        os.replace(path + ".gz.tmp", path + ".gz")
+        os.remove(path)
+
+    def format(self, fd, data, eof=False):
+        # 只输出完整的行，剩下的半行留到下次读到换行或者管道关闭时再输出
+        data = self.buffers[fd] + data
+        lines = data.splitlines(keepends=True)
+        self.buffers[fd] = b""
+        if lines and not lines[-1].endswith(b"\n") and not eof:
+            self.buffers[fd] = lines.pop()
+        now = datetime.now(timezone.utc).isoformat()
+        return b"".join(
+            json.dumps(
+                {
+                    "log": line.decode(errors="replace"),
+                    "stream": self.streams[fd],
+                    "time": now,
+                }
+            ).encode()
+            + b"\n"
+            for line in lines
+        )
+
+
+class LogDriver:
+    name = None
+    options = []
+
+    def __init__(self, log_path, opts=None) -> None:
+        self.log_path = log_path
+        self.opts = {}
+        for opt in opts or []:
+            key, _, value = opt.partition("=")
+            if key not in self.options:
+                print(f"log driver {self.name} does not support option {key}")
+                sys.exit(1)
+            self.opts[key] = value
+
+    def open(self):
+        # 在 fork 之前准备好容器的 stdout/stderr
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+
+    def stdio(self):
+        # 容器的 stdin、stdout、stderr，stdin 为 /dev/null
+        return [os.open(os.devnull, os.O_RDONLY)]
+
+    def redirect(self):
+        # 在容器进程中重定向标准输入输出
+        for i, fd in enumerate(self.stdio()):
+            os.dup2(fd, i)
+
+    def start(self):
+        # fork 之后在 mydocker 进程中调用
+        pass
+
+
+class RawLogDriver(LogDriver):
+    # 容器的输出直接写入日志文件，没有时间戳，也不会轮转
+    name = "raw"
+
+    def open(self):
+        super().open()
+        self.fd = os.open(
+            self.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644
+        )
+
+    def stdio(self):
+        return super().stdio() + [self.fd, self.fd]
+
+    def start(self):
+        os.close(self.fd)
+
+
+class JsonFileLogDriver(LogDriver):
+    # 通过 shim 写 json 行日志，支持 max-size、max-file、compress 选项，
+    # 例如 --log-opt max-size=10m --log-opt max-file=3 --log-opt compress=true
+    name = "json-file"
+    options = ["max-size", "max-file", "compress"]
+
+    def __init__(self, log_path, opts=None) -> None:
+        super().__init__(log_path, opts)
+        self.shim_opts = {
+            "max_size": (
+                parse_size(self.opts["max-size"]) if "max-size" in self.opts else None
+            ),
+            "max_file": int(self.opts.get("max-file", 1)),
+            "compress": self.opts.get("compress", "false").lower() in ["true", "1"],
+        }
+        if self.shim_opts["max_file"] < 1:
+            print("max-file must be at least 1")
+            sys.exit(1)
+
+    def open(self):
+        super().open()
+        self.stdout_r, self.stdout_w = os.pipe()
+        self.stderr_r, self.stderr_w = os.pipe()
+
+    def stdio(self):
+        return super().stdio() + [self.stdout_w, self.stderr_w]
+
+    def start(self):
+        # 先关闭写端，这样容器退出后 shim 才能读到 EOF
+        os.close(self.stdout_w)
+        os.close(self.stderr_w)
+        LogShim.start(
+            self.log_path,
+            {self.stdout_r: "stdout", self.stderr_r: "stderr"},
+            **self.shim_opts,
+        )
+        os.close(self.stdout_r)
+        os.close(self.stderr_r)
+
+
+log_drivers = {driver.name: driver for driver in [RawLogDriver, JsonFileLogDriver]}
+
+
+class LogReader:
+    def __init__(self, log_path) -> None:
+        self.log_path = log_path
+
+    @staticmethod
+    def parse_time(value):
+        # 支持 RFC3339 时间，或者 10s、5m、2h、1d 这样相对当前时间的时长
+        if value is None:
+            return None
+        m = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+        if m:
+            unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+            delta = timedelta(**{unit[m.group(2)]: float(m.group(1))})
+            return datetime.now(timezone.utc) - delta
+        t = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if t.tzinfo is None:
+            t = t.astimezone()
+        return t
+
+    @staticmethod
+    def parse_line(line):
+        # 返回 (time, stream, log)，兼容旧版本直接写入的原始日志
+        try:
+            entry = json.loads(line)
+            return datetime.fromisoformat(entry["time"]), entry["stream"], entry["log"]
+        except (ValueError, KeyError, TypeError):
+            return None, "stdout", line.decode(errors="replace")
+
+    @staticmethod
+    def tail_offset(f, n):
+        # 从文件末尾按块往前找第 n 个换行，不需要读完整个文件
+        # 返回 (offset, 还差的行数)，文件不够 n 行时 offset 为 0
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        if end > 0:
+            f.seek(end - 1)
+            if f.read(1) == b"\n":
+                pos = end - 1
+        needed = n
+        if needed <= 0:
+            return end, 0
+        while pos > 0:
+            size = min(BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            block = f.read(size)
+            idx = len(block)
+            while True:
+                idx = block.rfind(b"\n", 0, idx)
+                if idx < 0:
+                    break
+                needed -= 1
+                if needed == 0:
+                    return pos + idx + 1, 0
+        # 文件开头的一行前面没有换行
+        return 0, max(needed - (1 if end > 0 else 0), 0)
+
+    @staticmethod
+    def since_offset(f, since):
+        # 日志按时间顺序追加，二分查找第一条不早于 since 的日志所在的位置
+        lo, hi = 0, f.seek(0, os.SEEK_END)
+        while hi - lo > BLOCK_SIZE:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            f.readline()
+            t, _, _ = LogReader.parse_line(f.readline())
+            if t is None or t < since:
+                lo = mid
+            else:
+                hi = mid
+        if lo > 0:
+            f.seek(lo)
+            f.readline()
+            return f.tell()
+        return 0
+
+    def read(self, f, since=None, until=None, timestamps=False):
+        # 输出 f 当前位置之后的完整行，返回是否已经超过 until
+        for line in f:
+            if not line.endswith(b"\n"):
+                # 还没有写完的半行，等下次再读
+                f.seek(-len(line), os.SEEK_CUR)
+                break
+            t, _, log = LogReader.parse_line(line)
+            if since and t and t < since:
+                continue
+            if until and t and t > until:
+                return True
+            if timestamps and t:
+                log = f"{t.isoformat()} {log}"
+            sys.stdout.write(log)
+        sys.stdout.flush()
+        return False
+
+    def segments(self):
+        # 轮转后的日志从旧到新依次为 <log>.N[.gz] ... <log>.1[.gz]、<log>
+        segments = []
+        i = 1
+        while True:
+            path = f"{self.log_path}.{i}"
+            if os.path.exists(path):
+                segments.append(path)
+            elif os.path.exists(path + ".gz"):
+                segments.append(path + ".gz")
+            else:
+                break
+            i += 1
+        return segments[::-1] + [self.log_path]
+
+    @staticmethod
+    def open(path):
+        # 压缩的分段大小受 max-size 限制，直接解压到内存里，和普通文件一样可以 seek
+        if path.endswith(".gz"):
+            with gzip.open(path, "rb") as f:
+                return io.BytesIO(f.read())
+        return open(path, "rb")
+
+    def print(
+        self,
+        tail=None,
+        follow=False,
+        since=None,
+        until=None,
+        timestamps=False,
+        alive=None,
+    ):
+        since = LogReader.parse_time(since)
+        until = LogReader.parse_time(until)
+        segments = self.segments()
+        # 计算从哪个分段的哪个位置开始输出
+        start = 0
+        offsets = {}
+        if tail is not None:
+            remaining = tail
+            for i in range(len(segments) - 1, -1, -1):
+                with LogReader.open(segments[i]) as f:
+                    offsets[i], remaining = LogReader.tail_offset(f, remaining)
+                start = i
+                if remaining == 0:
+                    break
+        if since:
+            # 从新到旧找到第一条日志不晚于 since 的分段，since 之前的分段都不用读
+            for i in range(len(segments) - 1, start - 1, -1):
+                with LogReader.open(segments[i]) as f:
+                    t, _, _ = LogReader.parse_line(f.readline())
+                    if t is None or t <= since or i == start:
+                        offsets[i] = max(
+                            offsets.get(i, 0), LogReader.since_offset(f, since)
+                        )
+                        start = i
+                        break
+        for i in range(start, len(segments) - 1):
+            with LogReader.open(segments[i]) as f:
+                f.seek(offsets.get(i, 0))
+                if self.read(f, since, until, timestamps):
+                    return
+        f = open(self.log_path, "rb")
+        try:
+            f.seek(offsets.get(len(segments) - 1, 0))
+            if self.read(f, since, until, timestamps) or not follow:
+                return
+            # --follow：用 inotify 监听日志目录，等待日志被写入或者轮转，容器退出后结束
+            inotify_fd = inotify_init()
+            try:
+                inotify_add_watch(
+                    inotify_fd,
+                    os.path.dirname(self.log_path),
+                    IN_MODIFY | IN_CREATE | IN_MOVED_TO,
+                )
+                while True:
+                    ready, _, _ = select.select([inotify_fd], [], [], 1)
+                    if ready:
+                        while True:
+                            try:
+                                os.read(inotify_fd, 4096)
+                            except BlockingIOError:
+                                break
+                    if self.read(f, since, until, timestamps):
+                        return
+                    # 日志文件被轮转后重新打开新的文件
+                    try:
+                        rotated = (
+                            os.stat(self.log_path).st_ino != os.fstat(f.fileno()).st_ino
+                        )
+                    except FileNotFoundError:
+                        rotated = False
+                    if rotated:
+                        f.close()
+                        f = open(self.log_path, "rb")
+                        if self.read(f, since, until, timestamps):
+                            return
+                    elif not ready and alive is not None and not alive():
+                        return
+            finally:
+                os.close(inotify_fd)
+        finally:
+            f.close()
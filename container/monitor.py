@@ -0,0 +1,164 @@
+import json
+import os
+import select
+from datetime import datetime, timezone
+
+from utility import IN_MODIFY, detach_stdio, inotify_add_watch, inotify_init
+
+from .state_store import StateStore
+
+# PSI 触发条件：1s 的窗口内有 100ms 以上的时间至少有一个任务因为资源不足而停顿
+PSI_TRIGGER = "some 100000 1000000"
+PSI_RESOURCES = ["cpu", "memory", "io"]
+# memory.events 中需要记录的计数器，high 表示超过 memory.high 被限流，max 表示达到 memory.max
+MEMORY_EVENTS = ["high", "max", "oom", "oom_kill", "oom_group_kill"]
+
+
+class EventMonitor:
+    # 通过 PSI 触发器和 inotify 等待事件，不做轮询：cpu/memory/io.pressure 写入触发条件后等 POLLPRI，
+    # memory.events 变化时 inotify 通知，事件以 json 行写入事件日志，计数和最后一个事件记录到状态数据库中，
+    # ps/stats 可以直接显示。mydockerd 在运行时所有容器的 fd 都注册到它的事件循环里，
+    # 否则每个容器 fork 一个监控进程
+    def __init__(self, container_id, pid, cgroup_path, events_path) -> None:
+        self.container_id = container_id
+        self.pid = pid
+        self.cgroup_path = cgroup_path
+        self.events_path = events_path
+        self.counters = {}
+        self.memory_events = {}
+
+    @staticmethod
+    def start(container_id, pid, cgroup_path, events_path):
+        monitor_pid = os.fork()
+        if monitor_pid != 0:
+            return monitor_pid
+        try:
+            # 和日志 shim 一样脱离 mydocker 进程的会话和继承的 fd，容器退出后自己结束
+            os.setsid()
+            detach_stdio()
+            EventMonitor(container_id, pid, cgroup_path, events_path).run()
+        finally:
+            os._exit(0)
+
+    def open_cgroup(self, pidfd):
+        # 容器进程 fork 之后才创建 cgroup，这里等待 cgroup 出现
+        while True:
+            try:
+                return os.open(
+                    self.cgroup_path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+                )
+            except FileNotFoundError:
+                if select.select([pidfd], [], [], 0.05)[0]:
+                    return None
+
+    def open(self, dir_fd):
+        # 打开 PSI 触发器和 memory.events 的 inotify，返回需要等待的 {fd: poll 事件}
+        self.dir_fd = dir_fd
+        self.pressure_fds = {}
+        self.fds = {}
+        for resource in PSI_RESOURCES:
+            try:
+                fd = os.open(
+                    f"{resource}.pressure",
+                    os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC,
+                    dir_fd=dir_fd,
+                )
+            except OSError:
+                # 内核没有开启 PSI 或者没有启用对应的控制器
+                continue
+            try:
+                os.write(fd, PSI_TRIGGER.encode())
+            except OSError:
+                os.close(fd)
+                continue
+            self.pressure_fds[fd] = resource
+            self.fds[fd] = select.POLLPRI
+        self.inotify_fd = inotify_init()
+        self.events_fd = None
+        try:
+            self.events_fd = os.open(
+                "memory.events", os.O_RDONLY | os.O_CLOEXEC, dir_fd=dir_fd
+            )
+            inotify_add_watch(
+                self.inotify_fd, f"{self.cgroup_path}/memory.events", IN_MODIFY
+            )
+            self.fds[self.inotify_fd] = select.POLLIN
+            self.memory_events = self.read_memory_events(self.events_fd)
+        except OSError:
+            pass
+        return self.fds
+
+    def handle(self, fd):
+        if fd == self.inotify_fd:
+            os.read(self.inotify_fd, 4096)
+            self.check_memory_events(self.events_fd)
+        elif fd in self.pressure_fds:
+            self.record(
+                f"{self.pressure_fds[fd]}_pressure",
+                os.pread(fd, 4096, 0).decode().splitlines()[0],
+            )
+
+    def close(self):
+        # 容器退出或者 cgroup 被删除，最后检查一次 memory.events，OOM kill 常常就是退出的原因
+        if self.events_fd is not None:
+            self.check_memory_events(self.events_fd)
+            os.close(self.events_fd)
+        for fd in list(self.pressure_fds) + [self.inotify_fd, self.dir_fd]:
+            os.close(fd)
+
+    def run(self):
+        pidfd = os.pidfd_open(self.pid)
+        dir_fd = self.open_cgroup(pidfd)
+        if dir_fd is None:
+            return
+        poller = select.poll()
+        # 容器进程退出时 pidfd 可读
+        poller.register(pidfd, select.POLLIN)
+        for fd, events in self.open(dir_fd).items():
+            poller.register(fd, events)
+        try:
+            while True:
+                for fd, event in poller.poll():
+                    if fd == pidfd or event & select.POLLERR:
+                        return
+                    self.handle(fd)
+        finally:
+            self.close()
+
+    @staticmethod
+    def read_memory_events(fd):
+        events = {}
+        for line in os.pread(fd, 4096, 0).decode().splitlines():
+            key, value = line.split()
+            events[key] = int(value)
+        return events
+
+    def check_memory_events(self, fd):
+        try:
+            events = EventMonitor.read_memory_events(fd)
+        except OSError:
+            return
+        for key in MEMORY_EVENTS:
+            count = events.get(key, 0) - self.memory_events.get(key, 0)
+            if count > 0:
+                self.record(f"memory_{key}", f"{key} {events[key]}", count)
+        self.memory_events = events
+
+    def record(self, event, detail, count=1):
+        now = datetime.now(timezone.utc)
+        os.makedirs(os.path.dirname(self.events_path), exist_ok=True)
+        with open(self.events_path, "a") as f:
+            f.write(
+                json.dumps({"event": event, "detail": detail, "time": now.isoformat()})
+                + "\n"
+            )
+        self.counters[event] = self.counters.get(event, 0) + count
+        store = StateStore()
+        with store.transaction():
+            # 容器已经被删除时不再写入，避免重新创建出一条记录
+            container_info = store.get(self.container_id)
+            if container_info:
+                container_info["EVENTS"] = dict(self.counters)
+                container_info["LAST_EVENT"] = f"{event} {now.strftime('%H:%M:%S')}"
+                store.put(self.container_id, container_info)
+        store.conn.close()
@@ -0,0 +1,71 @@
+import os
+import re
+
+node_path = "/sys/devices/system/node"
+cpu_path = "/sys/devices/system/cpu"
+
+
+def parse_cpulist(cpulist):
+    # 将 0-3,8,10-11 这样的 cpulist 转换成 [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    # parse_cpulist 的逆操作，连续的编号合并成区间
+    parts = []
+    cpus = sorted(set(cpus))
+    start = None
+    for i, cpu in enumerate(cpus):
+        if start is None:
+            start = cpu
+        if i + 1 == len(cpus) or cpus[i + 1] != cpu + 1:
+            parts.append(str(start) if start == cpu else f"{start}-{cpu}")
+            start = None
+    return ",".join(parts)
+
+
+class NumaTopology:
+    # 从 sysfs 读取每个 NUMA 节点上在线的 CPU，没有 NUMA 信息时所有 CPU 都算在节点 0 上
+    def __init__(self, node_path=node_path, cpu_path=cpu_path) -> None:
+        with open(os.path.join(cpu_path, "online")) as f:
+            online = set(parse_cpulist(f.read()))
+        self.nodes = {}
+        if os.path.isdir(node_path):
+            for entry in os.listdir(node_path):
+                match = re.fullmatch(r"node(\d+)", entry)
+                if match is None:
+                    continue
+                with open(os.path.join(node_path, entry, "cpulist")) as f:
+                    cpus = sorted(set(parse_cpulist(f.read())) & online)
+                # 只有内存没有 CPU 的节点不参与分配
+                if cpus:
+                    self.nodes[int(match.group(1))] = cpus
+        if not self.nodes:
+            self.nodes = {0: sorted(online)}
+
+    def place(self, count, load):
+        # 在一个节点上选 count 个负载最低的 CPU，load 为 {cpu: 绑定在上面的容器数}，
+        # 返回 (cpus, mems)；选择 count 个 CPU 负载之和最小的节点，相同时选编号小的
+        if count <= 0:
+            raise ValueError("cpu count must be greater than 0")
+        candidates = []
+        for node, cpus in self.nodes.items():
+            if len(cpus) < count:
+                continue
+            cpus = sorted(cpus, key=lambda cpu: (load.get(cpu, 0), cpu))[:count]
+            candidates.append((sum(load.get(cpu, 0) for cpu in cpus), node, cpus))
+        if candidates:
+            _, node, cpus = min(candidates)
+            return sorted(cpus), [node]
+        # 单个节点的 CPU 不够时只能跨节点，内存允许从用到的所有节点分配
+        all_cpus = {cpu: node for node, cpus in self.nodes.items() for cpu in cpus}
+        if len(all_cpus) < count:
+            raise ValueError(f"only {len(all_cpus)} cpus online, {count} requested")
+        cpus = sorted(all_cpus, key=lambda cpu: (load.get(cpu, 0), cpu))[:count]
+        return sorted(cpus), sorted({all_cpus[cpu] for cpu in cpus})
@@ -0,0 +1,176 @@
+import fcntl
+import json
+import os
+import socket
+import sys
+from contextlib import contextmanager
+
+from utility import file_lock, proc_start_time
+
+base_path = os.path.dirname(os.path.dirname(__file__))
+pool_path = os.path.join(base_path, "pool")
+# 预热容器池的内存（按 PSS 统计）和磁盘（upper 目录）预算，超过后不再补充
+default_pool_memory = os.environ.get("MYDOCKER_POOL_MEMORY", "1g")
+default_pool_disk = os.environ.get("MYDOCKER_POOL_DISK", "1g")
+
+
+class SandboxPool:
+    # 按 镜像@网络 预先准备好的沙箱：overlay 已经挂载、命名空间已经创建、pivot_root 已经完成、
+    # veth 和 IP 已经配置好，沙箱进程阻塞在一个 unix socket 上，run 只需要把命令和标准输入输出
+    # 通过 SCM_RIGHTS 发过去，沙箱进程直接 execve
+    # pool.json: {"pools": {key: {"image", "network", "size"}}, "sandboxes": {id: {...}}}
+    def __init__(self, root=pool_path) -> None:
+        self.root = root
+        self.meta_path = os.path.join(root, "pool.json")
+        self.lock_path = os.path.join(root, "pool.lock")
+
+    def load(self):
+        self.meta = {"pools": {}, "sandboxes": {}}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+
+    def dump(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, indent=4)
+        os.replace(tmp_path, self.meta_path)
+
+    @staticmethod
+    def key(image_name, network):
+        return f"{image_name}@{network or ''}"
+
+    def socket_path(self, sandbox_id):
+        return os.path.join(self.root, f"{sandbox_id}.sock")
+
+    def set_size(self, image_name, network, size):
+        with file_lock(self.lock_path):
+            self.load()
+            key = SandboxPool.key(image_name, network)
+            if size:
+                self.meta["pools"][key] = {
+                    "image": image_name,
+                    "network": network,
+                    "size": size,
+                }
+            else:
+                self.meta["pools"].pop(key, None)
+            self.dump()
+
+    def size(self, image_name, network):
+        self.load()
+        pool = self.meta["pools"].get(SandboxPool.key(image_name, network))
+        return pool["size"] if pool else 0
+
+    def add(self, sandbox):
+        with file_lock(self.lock_path):
+            self.load()
+            self.meta["sandboxes"][sandbox["ID"]] = sandbox
+            self.dump()
+
+    def sandboxes(self, image_name=None, network=None):
+        self.load()
+        return [
+            sandbox
+            for sandbox in self.meta["sandboxes"].values()
+            if image_name is None
+            or sandbox["KEY"] == SandboxPool.key(image_name, network)
+        ]
+
+    def take(self, image_name, network):
+        # 取出一个沙箱，已经退出的沙箱一并取出交给调用方清理，返回 (sandbox, dead)
+        key = SandboxPool.key(image_name, network)
+        dead = []
+        with file_lock(self.lock_path):
+            self.load()
+            sandbox = None
+            for sandbox_id, candidate in list(self.meta["sandboxes"].items()):
+                if candidate["KEY"] != key:
+                    continue
+                del self.meta["sandboxes"][sandbox_id]
+                if proc_start_time(candidate["PID"]) != candidate["START_TIME"]:
+                    dead.append(candidate)
+                    continue
+                sandbox = candidate
+                break
+            if sandbox is not None or dead:
+                self.dump()
+        return sandbox, dead
+
+    @contextmanager
+    def fill_lock(self, image_name, network):
+        # 同一个池同一时间只有一个进程在补充，拿不到锁时返回 None
+        os.makedirs(self.root, exist_ok=True)
+        key = SandboxPool.key(image_name, network).replace("/", "_")
+        fd = os.open(
+            os.path.join(self.root, f"{key}.fill.lock"), os.O_RDWR | os.O_CREAT, 0o644
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            yield None
+            return
+        try:
+            yield fd
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def memory_usage(sandboxes):
+        # 沙箱进程都是 fork 出来的，按 PSS 统计，共享的页面按比例分摊
+        total = 0
+        for sandbox in sandboxes:
+            try:
+                with open(f"/proc/{sandbox['PID']}/smaps_rollup") as f:
+                    for line in f:
+                        if line.startswith("Pss:"):
+                            total += int(line.split()[1]) * 1024
+                            break
+            except OSError:
+                continue
+        return total
+
+    @staticmethod
+    def disk_usage(sandboxes, overlay_root):
+        # 只统计沙箱自己写入的 upper 和 work 目录，merged 是 overlay 挂载点，遍历它会把共享的只读层也算进去
+        from .layer_store import LayerStore
+
+        return sum(
+            LayerStore.disk_usage(os.path.join(overlay_root, sandbox["ID"], name))
+            for sandbox in sandboxes
+            for name in ("upper", "work")
+        )
+
+
+def serve(listener):
+    # 在沙箱进程中调用：等待 run 连接，收到命令和标准输入输出之后 execve，
+    # 连接是 close-on-exec 的，execve 成功后 run 一端读到 EOF，失败时发回错误信息
+    conn, _ = listener.accept()
+    listener.close()
+    message, fds, _, _ = socket.recv_fds(conn, 1 << 20, 3)
+    request = json.loads(message)
+    for i, fd in enumerate(fds):
+        os.dup2(fd, i)
+        os.close(fd)
+    try:
+        os.execve(request["cmd"][0], request["cmd"], request["env"])
+    except OSError as e:
+        conn.sendall(f"exec {request['cmd'][0]} failed: {e.strerror}".encode())
+    sys.exit(127)
+
+
+def exec_in_sandbox(socket_path, cmd, env, fds):
+    # 在 run 中调用：把命令、环境变量和 stdin/stdout/stderr 交给沙箱进程
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        socket.send_fds(conn, [json.dumps({"cmd": cmd, "env": env}).encode()], fds)
+        error = b""
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            error += data
+    if error:
+        print(error.decode())
+        sys.exit(1)
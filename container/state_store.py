@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+import sys
+from contextlib import contextmanager
+
+base_path = os.path.dirname(os.path.dirname(__file__))
+info_path = os.path.join(base_path, "info")
+state_db_path = os.path.join(info_path, "state.db")
+
+
+class StateStore:
+    # 所有容器的状态保存在 info/state.db 一个 sqlite 数据库里，WAL 模式下读写互不阻塞，
+    # 按 ID、NAME、STATUS 建索引，ps 不用再逐个打开每个容器的 config.json
+    def __init__(self, path=state_db_path) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            self.init_schema()
+
+    def init_schema(self):
+        with self.transaction():
+            # 其他进程可能已经完成了初始化
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] != 0:
+                return
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS containers (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    info TEXT NOT NULL
+                )""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS containers_name ON containers (name)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS containers_status ON containers (status)"
+            )
+            migrated = self.migrate()
+            self.conn.execute("PRAGMA user_version = 1")
+        # 事务提交之后再删除旧的 config.json
+        for config_path in migrated:
+            os.remove(config_path)
+
+    def migrate(self):
+        # 把旧版本的 info/<id>/config.json 导入数据库
+        migrated = []
+        info_dir = os.path.dirname(self.path)
+        for container_id in os.listdir(info_dir):
+            config_path = os.path.join(info_dir, container_id, "config.json")
+            if not os.path.isfile(config_path):
+                continue
+            with open(config_path) as json_file:
+                container_info = json.load(json_file)
+            self.put(container_info.get("ID", container_id), container_info)
+            migrated.append(config_path)
+        return migrated
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE 一开始就拿到写锁，避免并发的 run/stop 读-改-写时互相覆盖
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def put(self, container_id, container_info):
+        # INSERT OR REPLACE 会先删除旧行，rowid 跟着变，list 就变成按最后更新时间排序了；
+        # 用 UPSERT 原地更新，rowid 保持插入时的顺序
+        self.conn.execute(
+            """INSERT INTO containers (id, name, status, info) VALUES (?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                name = excluded.name, status = excluded.status, info = excluded.info""",
+            (
+                container_id,
+                container_info.get("NAME") or container_id,
+                container_info.get("STATUS") or "",
+                json.dumps(container_info),
+            ),
+        )
+
+    def get(self, container_id):
+        row = self.conn.execute(
+            "SELECT info FROM containers WHERE id = ?", (container_id,)
+        ).fetchone()
+        if row is None:
+            return {}
+        return json.loads(row[0])
+
+    def update(self, container_id, kv):
+        with self.transaction():
+            container_info = self.get(container_id)
+            container_info.update(kv)
+            self.put(container_id, container_info)
+        return container_info
+
+    def update_many(self, updates):
+        # 在一个事务里更新多个容器，updates 为 {container_id: kv}
+        with self.transaction():
+            for container_id, kv in updates.items():
+                container_info = self.get(container_id)
+                container_info.update(kv)
+                self.put(container_id, container_info)
+
+    def mark_released(self, container_ids):
+        # 在一个事务里把容器标记为已释放 cgroup、端口映射和 IP，返回这次才标记的容器；
+        # daemon、stop、rm 和 prune 可能同时处理同一个容器，只有标记成功的一方去释放
+        released = []
+        with self.transaction():
+            for container_id in container_ids:
+                container_info = self.get(container_id)
+                if not container_info or container_info.get("RELEASED"):
+                    continue
+                container_info["RELEASED"] = True
+                self.put(container_id, container_info)
+                released.append(container_info)
+        return released
+
+    def delete(self, container_id):
+        self.delete_many([container_id])
+
+    def delete_many(self, container_ids):
+        with self.transaction():
+            self.conn.executemany(
+                "DELETE FROM containers WHERE id = ?",
+                [(container_id,) for container_id in container_ids],
+            )
+
+    def list(self, status=None):
+        if status is None:
+            rows = self.conn.execute("SELECT info FROM containers ORDER BY rowid")
+        else:
+            rows = self.conn.execute(
+                "SELECT info FROM containers WHERE status = ? ORDER BY rowid",
+                (status,),
+            )
+        return [json.loads(row[0]) for row in rows]
+
+    def resolve(self, name_or_id):
+        # 依次按完整 ID、完整名字、ID 前缀、名字前缀查找，前缀匹配到多个容器时报错
+        for sql in [
+            "SELECT id FROM containers WHERE id = ?",
+            "SELECT id FROM containers WHERE name = ?",
+            "SELECT id FROM containers WHERE id GLOB ? || '*'",
+            "SELECT id FROM containers WHERE name GLOB ? || '*'",
+        ]:
+            pattern = name_or_id
+            if "GLOB" in sql:
+                # 转义 GLOB 的通配符，只做字面量前缀匹配
+                pattern = "".join(f"[{c}]" if c in "*?[" else c for c in name_or_id)
+            ids = [row[0] for row in self.conn.execute(sql, (pattern,))]
+            if len(ids) == 1:
+                return ids[0]
+            if len(ids) > 1:
+                print(f"container {name_or_id} is ambiguous: {', '.join(ids)}")
+                sys.exit(1)
+        print(f"container {name_or_id} not found")
+        sys.exit(1)
@@ -0,0 +1,66 @@
+import fcntl
+import os
+import shutil
+import uuid
+
+from utility import detach_stdio, set_idle_io_priority
+
+base_path = os.path.dirname(os.path.dirname(__file__))
+trash_path = os.path.join(base_path, "overlay", ".trash")
+
+
+class Trash:
+    # 删除容器的工作目录时只把它原子地 rename 到 overlay/.trash，rm 和前台 run 退出时不用等待 rmtree；
+    # 后台的回收进程以 idle IO 优先级删除，回收进程中途退出时剩下的目录由下一个回收进程继续删除
+    def __init__(self, root=trash_path) -> None:
+        self.root = root
+        self.lock_path = os.path.join(root, ".lock")
+
+    def move(self, path):
+        # 和 overlay/<ID> 在同一个文件系统中，rename 是原子的；加上随机后缀，同一个 ID 可以多次进入回收站
+        os.makedirs(self.root, exist_ok=True)
+        name = f"{os.path.basename(path)}-{uuid.uuid4().hex[:8]}"
+        os.rename(path, os.path.join(self.root, name))
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [name for name in os.listdir(self.root) if not name.startswith(".")]
+
+    def spawn_reaper(self):
+        # 两次 fork，回收进程交给 init（或者 mydockerd）收养，调用方直接返回
+        if not self.entries():
+            return
+        pid = os.fork()
+        if pid != 0:
+            os.waitpid(pid, 0)
+            return
+        try:
+            if os.fork() == 0:
+                os.setsid()
+                detach_stdio()
+                self.reap()
+        finally:
+            os._exit(0)
+
+    def reap(self):
+        set_idle_io_priority()
+        os.nice(19)
+        # 删除失败的目录不再重试，避免一直循环；删除过程中新放进来的目录继续删除
+        attempted = set()
+        while True:
+            pending = [name for name in self.entries() if name not in attempted]
+            if not pending:
+                return
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+            try:
+                # 同一时间只有一个回收进程，拿不到锁说明已经有进程在删除，新放进来的目录由它处理
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                for name in pending:
+                    shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                    attempted.add(name)
+            finally:
+                os.close(fd)
@@ -1,165 +1,433 @@
-import argparse
-
-from container import *
-from network import *
-
-parser = argparse.ArgumentParser(
-    # prog="mydocker",
-    description="A simple docker implementation based on python3"
-)
-subparsers = parser.add_subparsers(dest="subcommand")
-run_parser = subparsers.add_parser(
-    "run",
-    help="Create a container with namespace and cgroups limit",
-)
-run_group = run_parser.add_mutually_exclusive_group()
-run_group.add_argument(
-    # 简单起见，这里把 -i 和 -t 参数合并成一个
-    "-it",
-    action="store_true",
-    help="enable tty",
-)
-run_group.add_argument(
-    # 后台运行容器
-    "-d",
-    action="store_true",
-    help="detach container",
-)
-run_parser.add_argument(
-    # 限制进程内存使用量
-    "-mem",
-    default=None,
-    help="memory limit, at least greater than 6m, e.g.: -mem 100m",
-)
-run_parser.add_argument(
-    # 限制进程 cpu 使用率
-    "-cpu",
-    type=float,
-    default=None,
-    help="cpu quota,e.g.: -cpu 0.8",
-)
-run_parser.add_argument(
-    # 限制进程 cpu 使用率
-    "-cpuset",
-    default=None,
-    help="cpuset limit,e.g.: -cpuset 2,4",
-)
-run_parser.add_argument(
-    # 数据卷
-    "-v",
-    default=None,
-    help="volume,e.g.: -v /ect/conf:/etc/conf",
-)
-run_parser.add_argument(
-    "-name",
-    default=None,
-    help="container name",
-)
-run_parser.add_argument(
-    "image_name",
-    help="image name,e.g.: busybox.tar",
-)
-run_parser.add_argument(
-    "-e",
-    action="append",
-    help="set environment,e.g. -e name=mydocker",
-)
-run_parser.add_argument(
-    "-net",
-    default=None,
-    help="container network, e.g. -net testbr",
-)
-run_parser.add_argument(
-    "-p",
-    action="append",
-    help="port mapping,e.g. -p 8080:80 -p 30336:3306",
-)
-run_parser.add_argument(
-    "command",
-    nargs="+",
-    help="Command to run in the container",
-)
-
-init_parser = subparsers.add_parser(
-    "init",
-    help="Init container process run user's process in container. Do not call it outside",
-)
-init_parser.add_argument(
-    "command",
-    nargs="+",
-    help="Command to run in the container",
-)
-
-commit_parser = subparsers.add_parser("commit", help="commit container to image")
-commit_parser.add_argument("container_id")
-commit_parser.add_argument("image_name")
-
-ps_parser = subparsers.add_parser("ps", help="list all the containers")
-
-logs_parser = subparsers.add_parser("logs", help="print logs of a container")
-logs_parser.add_argument("container_id")
-
-exec_parser = subparsers.add_parser("exec", help="exec a command into container")
-exec_parser.add_argument("container_id")
-exec_parser.add_argument("command", nargs="+")
-
-stop_parser = subparsers.add_parser("stop", help="stop a container")
-stop_parser.add_argument("container_id")
-
-rm_parser = subparsers.add_parser("rm", help="remove unused containers")
-rm_parser.add_argument("-f", action="store_true", help="force delete running container")
-rm_parser.add_argument("container_id")
-
-network_parser = subparsers.add_parser("network", help="container network commands")
-network_subparsers = network_parser.add_subparsers(dest="subcommand")
-
-create_parser = network_subparsers.add_parser(
-    "create", help="create a container network"
-)
-create_parser.add_argument(
-    "--driver", required=True, help="network driver, e.g.: bridge"
-)
-create_parser.add_argument("--subnet", required=True, help="subnet cidr")
-create_parser.add_argument("name", help="network name")
-
-list_parser = network_subparsers.add_parser("list", help="list container network")
-
-remove_parser = network_subparsers.add_parser("remove", help="remove container network")
-remove_parser.add_argument("network_name", help="network name")
-
-args = parser.parse_args()
-print(args)
-if args.subcommand == "run":
-    con = Container(
-        args.command,
-        args.image_name,
-        args.name,
-        args.v,
-        args.e,
-        {"cpu": args.cpu, "cpuset": args.cpuset, "mem": args.mem},
-        args.net,
-        args.p,
-        args.it,
-    )
-    con.run()
-elif args.subcommand == "init":
-    con = Container(args.command)
-    con.init()
-elif args.subcommand == "commit":
-    Container.commit(args.container_id, args.image_name)
-elif args.subcommand == "ps":
-    Container.ps()
-elif args.subcommand == "logs":
-    Container.logs(args.container_id)
-elif args.subcommand == "exec":
-    Container.exec(args.container_id, args.command)
-elif args.subcommand == "stop":
-    Container.stop(args.container_id)
-elif args.subcommand == "rm":
-    Container.rm(args.container_id, args.f)
-elif args.subcommand == "create":
-    Network.create(args.name, args.subnet, args.driver)
-elif args.subcommand == "list":
-    Network.list()
-elif args.subcommand == "remove":
-    Network.remove(args.network_name)
+import sys
+
+from container.client import forward
+
+
+class LogDriverChoices:
+    # --log-driver 的可选值就是日志驱动的注册表；只在校验 run 的参数、打印帮助时才导入 container.logger，
+    # ps、stop 这些命令构建解析器时不用加载日志模块
+    def __contains__(self, name):
+        return name in LogDriverChoices.names()
+
+    def __iter__(self):
+        return iter(LogDriverChoices.names())
+
+    @staticmethod
+    def names():
+        from container.logger import log_drivers
+
+        return sorted(log_drivers)
+
+
+def build_parser():
+    # argparse 本身导入就要十几毫秒，转发给 mydockerd 的命令用不到
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        # prog="mydocker",
+        description="A simple docker implementation based on python3"
+    )
+    subparsers = parser.add_subparsers(dest="subcommand")
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Create a container with namespace and cgroups limit",
+    )
+    run_group = run_parser.add_mutually_exclusive_group()
+    run_group.add_argument(
+        # 简单起见，这里把 -i 和 -t 参数合并成一个
+        "-it",
+        action="store_true",
+        help="enable tty",
+    )
+    run_group.add_argument(
+        # 后台运行容器
+        "-d",
+        action="store_true",
+        help="detach container",
+    )
+    run_parser.add_argument(
+        # 限制进程内存使用量
+        "-mem",
+        default=None,
+        help="memory limit, at least greater than 6m, e.g.: -mem 100m",
+    )
+    run_parser.add_argument(
+        # 限制进程 cpu 使用率
+        "-cpu",
+        type=float,
+        default=None,
+        help="cpu quota,e.g.: -cpu 0.8",
+    )
+    run_parser.add_argument(
+        # 限制进程 cpu 使用率
+        "-cpuset",
+        default=None,
+        help="cpuset limit,e.g.: -cpuset 2,4, or auto:N to pin N least-loaded cpus on one NUMA node, e.g.: -cpuset auto:2",
+    )
+    run_parser.add_argument(
+        # 内存软限制，超过之后进程会被限流回收内存，但不会被 OOM kill
+        "-mem-high",
+        default=None,
+        help="memory soft limit (memory.high), e.g.: -mem-high 80m",
+    )
+    run_parser.add_argument(
+        # 按比例分配 cpu 时间
+        "-cpu-weight",
+        type=int,
+        default=None,
+        help="relative cpu weight 1~10000 (cpu.weight, default 100), e.g.: -cpu-weight 200",
+    )
+    run_parser.add_argument(
+        "-cpu-burst",
+        type=int,
+        default=None,
+        help="cpu quota that may be accumulated and used in bursts, in microseconds (cpu.max.burst)",
+    )
+    run_parser.add_argument(
+        # 限制容器中的进程数
+        "-pids-limit",
+        type=int,
+        default=None,
+        help="maximum number of processes (pids.max), e.g.: -pids-limit 100",
+    )
+    run_parser.add_argument(
+        # 按比例分配块设备 IO
+        "-io-weight",
+        type=int,
+        default=None,
+        help="relative block io weight 1~10000 (io.weight), e.g.: -io-weight 500",
+    )
+    for name, unit in [
+        ("device-read-bps", "10m"),
+        ("device-write-bps", "10m"),
+        ("device-read-iops", "1000"),
+        ("device-write-iops", "1000"),
+    ]:
+        # 限制块设备 IO (io.max)
+        run_parser.add_argument(
+            f"-{name}",
+            action="append",
+            help=f"limit {name.split('-', 1)[1].replace('-', ' ')} of a device, e.g.: -{name} /dev/sda:{unit}",
+        )
+    run_parser.add_argument(
+        # 数据卷
+        "-v",
+        default=None,
+        help="volume,e.g.: -v /ect/conf:/etc/conf",
+    )
+    run_parser.add_argument(
+        # 容器的可写层放在内存中
+        "--upper",
+        default=None,
+        help="put the writable layer on a tmpfs, e.g.: --upper tmpfs:512m",
+    )
+    run_parser.add_argument(
+        "--tmpfs",
+        action="append",
+        help="mount a tmpfs in the container, e.g.: --tmpfs /run:size=64m,mode=1777",
+    )
+    run_parser.add_argument(
+        "-name",
+        default=None,
+        help="container name",
+    )
+    run_parser.add_argument(
+        # 一次启动多个相同的容器，名字和宿主机端口按序号递增
+        "--replicas",
+        type=int,
+        default=1,
+        help="number of containers to start, e.g.: --replicas 10 -name web -p 8080:80 starts web-0..web-9 on ports 8080..8089",
+    )
+    run_parser.add_argument(
+        "--parallel",
+        type=int,
+        default=None,
+        help="maximum number of replicas set up concurrently, default the number of cpus",
+    )
+    run_parser.add_argument(
+        "image_name",
+        help="image name,e.g.: busybox.tar",
+    )
+    run_parser.add_argument(
+        "-e",
+        action="append",
+        help="set environment,e.g. -e name=mydocker",
+    )
+    run_parser.add_argument(
+        "-net",
+        default=None,
+        help="container network, e.g. -net testbr",
+    )
+    run_parser.add_argument(
+        "-p",
+        action="append",
+        help="port mapping,e.g. -p 8080:80 -p 30336:3306",
+    )
+    run_parser.add_argument(
+        "--log-driver",
+        default="json-file",
+        choices=LogDriverChoices(),
+        # 指定了 metavar，argparse 构建解析器时不会遍历 choices
+        metavar="DRIVER",
+        help="logging driver for detached container: %(choices)s",
+    )
+    run_parser.add_argument(
+        "--log-opt",
+        action="append",
+        help="log driver options, e.g.: --log-opt max-size=10m --log-opt max-file=3 --log-opt compress=true",
+    )
+    run_parser.add_argument(
+        "command",
+        nargs="+",
+        help="Command to run in the container",
+    )
+
+    init_parser = subparsers.add_parser(
+        "init",
+        help="Init container process run user's process in container. Do not call it outside",
+    )
+    init_parser.add_argument(
+        "command",
+        nargs="+",
+        help="Command to run in the container",
+    )
+
+    commit_parser = subparsers.add_parser("commit", help="commit container to image")
+    commit_parser.add_argument("container_id")
+    commit_parser.add_argument("image_name")
+
+    ps_parser = subparsers.add_parser("ps", help="list all the containers")
+    ps_parser.add_argument(
+        "--filter",
+        action="append",
+        help="filter output, e.g.: --filter status=running --filter name=web --filter network=testbr",
+    )
+    ps_parser.add_argument(
+        "--format",
+        default=None,
+        help='output format: table, json or a template, e.g.: --format "{ID} {NAME}"',
+    )
+    ps_parser.add_argument("-q", action="store_true", help="only display container IDs")
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="display resource usage statistics of containers"
+    )
+    stats_parser.add_argument(
+        "container_ids", nargs="*", help="containers to show, default all running"
+    )
+    stats_parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="print a single sample instead of refreshing every second",
+    )
+    stats_parser.add_argument(
+        "--format",
+        default=None,
+        help="output format: table or json (one object per line)",
+    )
+
+    logs_parser = subparsers.add_parser("logs", help="print logs of a container")
+    logs_parser.add_argument("container_id")
+    logs_parser.add_argument(
+        "-f", "--follow", action="store_true", help="follow log output"
+    )
+    logs_parser.add_argument(
+        "--tail", type=int, default=None, help="number of lines to show from the end"
+    )
+    logs_parser.add_argument(
+        "--since",
+        default=None,
+        help="show logs since timestamp or relative, e.g.: 2024-01-01T00:00:00Z or 10m",
+    )
+    logs_parser.add_argument(
+        "--until",
+        default=None,
+        help="show logs before timestamp or relative, e.g.: 2024-01-01T00:00:00Z or 10m",
+    )
+    logs_parser.add_argument(
+        "-t", "--timestamps", action="store_true", help="show timestamps"
+    )
+
+    exec_parser = subparsers.add_parser("exec", help="exec a command into container")
+    exec_parser.add_argument("container_id")
+    exec_parser.add_argument("command", nargs="+")
+
+    stop_parser = subparsers.add_parser("stop", help="stop containers")
+    stop_parser.add_argument("container_ids", nargs="*")
+    stop_parser.add_argument(
+        "--filter",
+        action="append",
+        help="stop all matching containers, e.g.: --filter name=web --filter network=testbr",
+    )
+    stop_parser.add_argument(
+        "-t",
+        "--time",
+        type=float,
+        default=10,
+        help="seconds to wait after SIGTERM before SIGKILL, default 10",
+    )
+
+    rm_parser = subparsers.add_parser("rm", help="remove unused containers")
+    rm_parser.add_argument(
+        "-f", action="store_true", help="force delete running container"
+    )
+    rm_parser.add_argument("container_ids", nargs="*")
+    rm_parser.add_argument(
+        "--filter",
+        action="append",
+        help="remove all matching containers, e.g.: --filter status=exited",
+    )
+
+    trace_parser = subparsers.add_parser(
+        "trace", help="show the startup trace of a container run with MYDOCKER_TRACE=1"
+    )
+    trace_parser.add_argument("container_id")
+
+    network_parser = subparsers.add_parser("network", help="container network commands")
+    network_subparsers = network_parser.add_subparsers(dest="subcommand")
+
+    create_parser = network_subparsers.add_parser(
+        "create", help="create a container network"
+    )
+    create_parser.add_argument(
+        "--driver", required=True, help="network driver, e.g.: bridge"
+    )
+    create_parser.add_argument("--subnet", required=True, help="subnet cidr")
+    create_parser.add_argument(
+        "--firewall",
+        default="iptables",
+        choices=["iptables", "nftables"],
+        help="firewall backend for port mappings and SNAT, default iptables",
+    )
+    create_parser.add_argument("name", help="network name")
+
+    list_parser = network_subparsers.add_parser("list", help="list container network")
+
+    remove_parser = network_subparsers.add_parser(
+        "remove", help="remove container network"
+    )
+    remove_parser.add_argument("network_name", help="network name")
+
+    pool_parser = subparsers.add_parser(
+        "pool", help="pre-warmed container pool commands"
+    )
+    pool_subparsers = pool_parser.add_subparsers(dest="subcommand")
+
+    fill_parser = pool_subparsers.add_parser(
+        "fill", help="keep pre-warmed containers of an image ready for run"
+    )
+    fill_parser.add_argument("image_name", help="image name")
+    fill_parser.add_argument("-net", help="network the containers are connected to")
+    fill_parser.add_argument(
+        "-size", type=int, default=1, help="number of pre-warmed containers, default 1"
+    )
+
+    drain_parser = pool_subparsers.add_parser(
+        "drain", help="remove the pre-warmed containers of an image"
+    )
+    drain_parser.add_argument("image_name", help="image name")
+    drain_parser.add_argument("-net", help="network the containers are connected to")
+
+    status_parser = pool_subparsers.add_parser(
+        "status", help="list pre-warmed container pools"
+    )
+
+    system_parser = subparsers.add_parser("system", help="system commands")
+    system_subparsers = system_parser.add_subparsers(dest="subcommand")
+
+    prune_parser = system_subparsers.add_parser(
+        "prune",
+        help="reclaim overlay directories, cgroups, veths, port mappings and ip addresses leaked by removed containers",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    print(args)
+    # 只导入这个子命令用到的模块
+    if args.subcommand in ["create", "list", "remove"]:
+        from network import Network
+    else:
+        from container import Container
+    if args.subcommand == "run":
+        con = Container(
+            args.command,
+            args.image_name,
+            args.name,
+            args.v,
+            args.e,
+            {
+                "cpu": args.cpu,
+                "cpuset": args.cpuset,
+                "mem": args.mem,
+                "mem_high": args.mem_high,
+                "cpu_weight": args.cpu_weight,
+                "cpu_burst": args.cpu_burst,
+                "pids": args.pids_limit,
+                "io_weight": args.io_weight,
+                "device_read_bps": args.device_read_bps,
+                "device_write_bps": args.device_write_bps,
+                "device_read_iops": args.device_read_iops,
+                "device_write_iops": args.device_write_iops,
+            },
+            args.net,
+            args.p,
+            args.it,
+            args.log_driver,
+            args.log_opt,
+            args.upper,
+            args.tmpfs,
+        )
+        if args.replicas > 1:
+            Container.run_replicas(con, args.replicas, args.parallel)
+        else:
+            con.run()
+    elif args.subcommand == "init":
+        con = Container(args.command)
+        con.init()
+    elif args.subcommand == "commit":
+        Container.commit(args.container_id, args.image_name)
+    elif args.subcommand == "ps":
+        Container.ps(args.filter, args.format, args.q)
+    elif args.subcommand == "stats":
+        Container.stats(args.container_ids, not args.no_stream, args.format)
+    elif args.subcommand == "logs":
+        Container.logs(
+            args.container_id,
+            args.tail,
+            args.follow,
+            args.since,
+            args.until,
+            args.timestamps,
+        )
+    elif args.subcommand == "exec":
+        Container.exec(args.container_id, args.command)
+    elif args.subcommand == "stop":
+        Container.stop(args.container_ids, args.filter, args.time)
+    elif args.subcommand == "rm":
+        Container.rm(args.container_ids, args.filter, args.f)
+    elif args.subcommand == "trace":
+        Container.trace(args.container_id)
+    elif args.subcommand == "create":
+        Network.create(args.name, args.subnet, args.driver, args.firewall)
+    elif args.subcommand == "list":
+        Network.list()
+    elif args.subcommand == "remove":
+        Network.remove(args.network_name)
+    elif args.subcommand == "fill":
+        Container.pool_fill(args.image_name, args.net, args.size)
+    elif args.subcommand == "drain":
+        Container.pool_drain(args.image_name, args.net)
+    elif args.subcommand == "status":
+        Container.pool_status()
+    elif args.subcommand == "prune":
+        Container.prune()
+
+
+if __name__ == "__main__":
+    # mydockerd 在运行时交给 daemon 执行
+    code = forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+    main()
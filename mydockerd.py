@@ -0,0 +1,8 @@
+# mydocker 的守护进程，启动之后 main.py 的命令会通过 unix socket 转发给它执行，
+# 后台运行的容器退出后由它回收并清理 cgroup 和端口映射
+# python3 mydockerd.py
+from container.daemon import Daemon
+from main import main
+
+if __name__ == "__main__":
+    Daemon(main).serve()
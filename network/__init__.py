@@ -1,2 +1,13 @@
-from .ipam import IPAM
-from .network import Network
+import importlib
+
+# 按需导入，只有网络相关的命令才加载网络模块
+lazy_imports = {
+    "IPAM": ".ipam",
+    "Network": ".network",
+}
+
+
+def __getattr__(name):
+    if name in lazy_imports:
+        return getattr(importlib.import_module(lazy_imports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,7 +1,7 @@
-import subprocess
-import sys
+import ipaddress
+import os
 
-from utility import shell
+from .netlink import link_backend
 
 
 class BridgeNetworkDriver:
@@ -10,28 +10,28 @@ class BridgeNetworkDriver:
     @staticmethod
     # 创建 Bridge 设备
     def create(subnet, ip, name):
-        # 1）创建 Bridge 虚拟设备
-        command = f"ip link add {name} type bridge"
-        shell(command)
-        # 2）设置 Bridge 设备地址和路由
-        command = f"ip addr add {ip} dev {name}"
-        shell(command)
-        # 3）启动 Bridge 设备
-        command = f"ip link set dev {name} up"
-        shell(command)
-        # 4）设置 iptables SNAT 规则
-        command = "sysctl -w net.ipv4.ip_forward=1"
-        shell(command)
-        command = (
-            f"iptables -t nat -A POSTROUTING -s {subnet} ! -o {name} -j MASQUERADE"
-        )
-        shell(command)
+        link = link_backend()
+        try:
+            # 1）创建 Bridge 虚拟设备
+            link.link_add_bridge(name)
+            # 2）设置 Bridge 设备地址和路由
+            link.addr_add(name, ip)
+            # 3）启动 Bridge 设备
+            link.link_set_up(name)
+        finally:
+            link.close()
+        # 4）开启转发，SNAT 规则由 Network 通过防火墙后端设置
+        with open("/proc/sys/net/ipv4/ip_forward", "w") as f:
+            f.write("1")
 
     @staticmethod
     # 删除 Bridge 设备
     def delete(name):
-        command = f"ip link delete dev {name}"
-        shell(command, exit_if_error=False)
+        link = link_backend()
+        try:
+            link.link_delete(name, ignore_errors=True)
+        finally:
+            link.close()
 
     @staticmethod
     # 将 veth 关联到网桥
@@ -40,31 +40,52 @@ class BridgeNetworkDriver:
         # 创建 Veth 接口
         veth_name = endpoint["ID"][:5]
         peer_veth_name = "cif-" + veth_name
-        command = f"ip link add {veth_name} type veth peer name {peer_veth_name}"
         endpoint["PEERNAME"] = peer_veth_name
-        shell(command)
-        # 将 Veth 接口挂载到 Bridge 设备
-        command = f"ip link set {veth_name} master {bridge_name}"
-        shell(command)
-        # 启动 Veth
-        command = f"ip link set dev {veth_name} up"
-        shell(command)
+        link = link_backend()
+        try:
+            link.link_add_veth(veth_name, peer_veth_name)
+            # 将 Veth 接口挂载到 Bridge 设备
+            link.link_set_master(veth_name, bridge_name)
+            # 启动 Veth
+            link.link_set_up(veth_name)
+        finally:
+            link.close()
 
     @staticmethod
     # 将 veth 从网桥解绑
     def disconnect(network, endpoint):
         veth_name = endpoint["ID"][:5]
-        # 从 Bridge 设备解绑 Veth 接口
-        command = f"ip link set {veth_name} nomaster"
-        shell(command)
-        # 删除 Veth 接口
-        command = f"ip link delete dev {veth_name}"
-        shell(command)
+        link = link_backend()
+        try:
+            # 从 Bridge 设备解绑 Veth 接口
+            link.link_set_master(veth_name, None)
+            # 删除 Veth 接口
+            link.link_delete(veth_name)
+        finally:
+            link.close()
+
+    @staticmethod
+    # 挂在网桥上的 veth
+    def ports(network):
+        brif_path = os.path.join("/sys/class/net", network["NAME"], "brif")
+        if not os.path.isdir(brif_path):
+            return []
+        return os.listdir(brif_path)
+
+    @staticmethod
+    def delete_port(veth_name):
+        link = link_backend()
+        try:
+            link.link_delete(veth_name, ignore_errors=True)
+        finally:
+            link.close()
 
 
 if __name__ == "__main__":
     bridge_name = "testbridge"
-    BridgeNetworkDriver.create("10.0.0.0/24", "10.0.0.1", bridge_name)
+    BridgeNetworkDriver.create(
+        "10.0.0.0/24", ipaddress.ip_interface("10.0.0.1/24"), bridge_name
+    )
     network = {"NAME": bridge_name}
     endpoint = {"ID": "testcontainer"}
     BridgeNetworkDriver.connect(network, endpoint)
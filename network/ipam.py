@@ -1,13 +1,95 @@
+import base64
 import ipaddress
 import json
 import os
+import re
+
+from utility import file_lock
 
 ipam_default_allocator_path = os.path.join(os.path.dirname(__file__), "subnet.json")
+# 第一个不是 0xff 的字节，即包含空闲地址的字节
+free_byte = re.compile(b"[^\xff]")
+
+
+class SubnetBitmap:
+    # 每个子网用一个位图记录地址分配情况，第 i 位对应子网中偏移为 i 的地址，
+    # 网络地址和广播地址一开始就置位；next 记录下一次开始查找的位置
+    def __init__(self, subnet, data=None) -> None:
+        self.subnet = subnet
+        size = subnet.num_addresses
+        if data is None:
+            self.bitmap = bytearray((size + 7) // 8)
+            # 位图末尾多出来的位和不可用的地址都标记为已分配
+            for offset in range(size, len(self.bitmap) * 8):
+                self.set(offset)
+            if size > 2:
+                self.set(0)
+                self.set(size - 1)
+            self.next = 0
+        elif isinstance(data, list):
+            # 兼容旧版本的格式：已分配 IP 的列表
+            self.__init__(subnet)
+            for ip in data:
+                self.set(self.offset(ip))
+        else:
+            self.bitmap = bytearray(base64.b64decode(data["bitmap"]))
+            self.next = data["next"]
+
+    def dump(self):
+        return {"bitmap": base64.b64encode(self.bitmap).decode(), "next": self.next}
+
+    def offset(self, ip):
+        return int(ipaddress.ip_address(ip)) - int(self.subnet.network_address)
+
+    def set(self, offset):
+        self.bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    def clear(self, offset):
+        self.bitmap[offset >> 3] &= ~(1 << (offset & 7))
+
+    def test(self, offset):
+        return bool(self.bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def allocate(self):
+        # 从 next 开始找第一个有空闲位的字节，找不到再从头找，查找由正则引擎在 C 里完成
+        match = free_byte.search(self.bitmap, self.next >> 3) or free_byte.search(
+            self.bitmap, 0, self.next >> 3
+        )
+        if match is None:
+            return None
+        index = match.start()
+        byte = self.bitmap[index]
+        # 最低的 0 位
+        offset = index * 8 + (~byte & (byte + 1)).bit_length() - 1
+        self.set(offset)
+        self.next = offset + 1
+        return self.subnet.network_address + offset
+
+    def allocated(self):
+        # 已分配的地址，不包括网络地址和广播地址
+        size = self.subnet.num_addresses
+        offsets = range(1, size - 1) if size > 2 else range(size)
+        return [
+            self.subnet.network_address + offset
+            for offset in offsets
+            if self.test(offset)
+        ]
+
+    def release(self, ip):
+        # 网络地址和广播地址一直保留，不能被释放
+        offset = self.offset(ip)
+        size = self.subnet.num_addresses
+        first, last = (1, size - 2) if size > 2 else (0, size - 1)
+        if not first <= offset <= last or not self.test(offset):
+            return False
+        self.clear(offset)
+        return True
 
 
 class IPAM:
     def __init__(self, subnet_allocator_path=ipam_default_allocator_path) -> None:
         self.subnet_allocator_path = subnet_allocator_path
+        self.lock_path = subnet_allocator_path + ".lock"
 
     def load(self):
         if not os.path.exists(self.subnet_allocator_path):
@@ -17,34 +99,57 @@ class IPAM:
             self.subnets = json.load(f)
 
     def dump(self):
-        with open(self.subnet_allocator_path, "w") as f:
-            json.dump(self.subnets, f, indent=4)
+        # 先写临时文件再 rename，中途失败不会留下写了一半的文件
+        tmp_path = self.subnet_allocator_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.subnets, f)
+        os.replace(tmp_path, self.subnet_allocator_path)
+
+    def bitmap(self, subnet):
+        return SubnetBitmap(subnet, self.subnets.get(subnet.with_prefixlen))
 
     def allocate(self, subnet):
-        self.load()
+        ip_interfaces = self.allocate_many(subnet, 1)
+        return ip_interfaces[0] if ip_interfaces else None
+
+    def allocate_many(self, subnet, count):
+        # 一次加锁、一次写文件分配 count 个地址，地址不够时一个都不分配
         subnet = ipaddress.ip_network(subnet, strict=True)
-        if subnet.with_prefixlen not in self.subnets:
-            self.subnets[subnet.with_prefixlen] = []
-        for ip in subnet.hosts():
-            if str(ip) not in self.subnets[subnet.with_prefixlen]:
-                self.subnets[subnet.with_prefixlen].append(str(ip))
-                self.dump()
-                return ipaddress.ip_interface(str(ip) + "/" + str(subnet.prefixlen))
-        else:
-            return None
+        with file_lock(self.lock_path):
+            self.load()
+            bitmap = self.bitmap(subnet)
+            ips = []
+            for _ in range(count):
+                ip = bitmap.allocate()
+                if ip is None:
+                    return None
+                ips.append(ip)
+            self.subnets[subnet.with_prefixlen] = bitmap.dump()
+            self.dump()
+        return [ipaddress.ip_interface(f"{ip}/{subnet.prefixlen}") for ip in ips]
 
     def release(self, subnet, ip):
-        self.load()
+        return self.release_many(subnet, [ip]) == 1
+
+    def release_many(self, subnet, ips):
+        # 一次加锁、一次写文件释放多个地址，返回实际释放的个数
         subnet = ipaddress.ip_network(subnet, strict=True)
-        if (
-            subnet.with_prefixlen in self.subnets
-            and ip in self.subnets[subnet.with_prefixlen]
-        ):
-            self.subnets[subnet.with_prefixlen].remove(ip)
-            self.dump()
-            return True
-        else:
-            return False
+        with file_lock(self.lock_path):
+            self.load()
+            if subnet.with_prefixlen not in self.subnets:
+                return 0
+            bitmap = self.bitmap(subnet)
+            released = sum(1 for ip in ips if bitmap.release(ip))
+            if released:
+                self.subnets[subnet.with_prefixlen] = bitmap.dump()
+                self.dump()
+        return released
+
+    def allocated(self, subnet):
+        subnet = ipaddress.ip_network(subnet, strict=True)
+        with file_lock(self.lock_path):
+            self.load()
+            return self.bitmap(subnet).allocated()
 
 
 if __name__ == "__main__":
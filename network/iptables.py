@@ -0,0 +1,159 @@
+import subprocess
+import sys
+
+PREROUTING_CHAIN = "MYDOCKER-PREROUTING"
+POSTROUTING_CHAIN = "MYDOCKER-POSTROUTING"
+
+
+class IptablesFirewall:
+    # 收集一批规则变更，最后通过 iptables-restore --noflush 在一个事务中提交，
+    # 只需要拿一次 xtables 锁、加载一次规则表。
+    # 规则都放在 MYDOCKER-* 链中：每个容器的端口映射单独一条链，删除容器时清空并删除这条链即可
+    name = "iptables"
+
+    def __init__(self) -> None:
+        self.chains = {"nat": [], "filter": []}
+        self.rules = {"nat": [], "filter": []}
+        # 旧版本直接加在内置链中的规则，MYDOCKER-* 链中删除失败时再逐条删除
+        self.legacy_rules = []
+
+    @staticmethod
+    def container_chain(container_id):
+        return f"MYDOCKER-DNAT-{container_id}"
+
+    def declare(self, table, chain, policy="-"):
+        # 对 --noflush 来说，声明一条已经存在的自定义链会清空它；一个事务里有多个容器时同一条链只声明一次
+        declaration = f":{chain} {policy} [0:0]"
+        if declaration not in self.chains[table]:
+            self.chains[table].append(declaration)
+
+    def add(self, table, rule):
+        self.rules[table].append(rule)
+
+    def render(self):
+        lines = []
+        for table in ["nat", "filter"]:
+            if not self.chains[table] and not self.rules[table]:
+                continue
+            lines.append(f"*{table}")
+            lines.extend(self.chains[table])
+            lines.extend(self.rules[table])
+            lines.append("COMMIT")
+        return "\n".join(lines) + "\n"
+
+    def commit(self, exit_if_error=True):
+        if not any(self.chains.values()) and not any(self.rules.values()):
+            return True
+        rules = self.render()
+        result = IptablesFirewall.restore(rules)
+        if result.returncode != 0 and IptablesFirewall.ensure_base_chains():
+            # MYDOCKER-* 链不存在（例如宿主机重启后规则被清空），创建后重试一次
+            result = IptablesFirewall.restore(rules)
+        legacy_rules = self.legacy_rules
+        self.chains = {"nat": [], "filter": []}
+        self.rules = {"nat": [], "filter": []}
+        self.legacy_rules = []
+        if result.returncode != 0:
+            # 规则是旧版本创建的，不在 MYDOCKER-* 链中；从内置链中全部删除成功时不报错，
+            # 但事务仍然被拒绝了，返回 False 让调用方逐个重试其他规则
+            if legacy_rules and IptablesFirewall.delete_legacy(legacy_rules):
+                return False
+            print(result.stderr)
+            if exit_if_error:
+                sys.exit(1)
+            return False
+        return True
+
+    @staticmethod
+    def restore(rules):
+        return subprocess.run(
+            ["iptables-restore", "--noflush", "--wait"],
+            input=rules,
+            capture_output=True,
+            text=True,
+        )
+
+    @staticmethod
+    def delete_legacy(rules):
+        # 每条规则单独执行 iptables -D，已经不存在的规则删除失败时忽略，返回是否全部删除成功
+        deleted = True
+        for rule in rules:
+            result = subprocess.run(
+                ["iptables", "--wait", "-t", "nat", *rule.split()], capture_output=True
+            )
+            deleted = deleted and result.returncode == 0
+        return deleted
+
+    @staticmethod
+    def ensure_base_chains():
+        # 创建 MYDOCKER-PREROUTING、MYDOCKER-POSTROUTING 链，并从内置链跳转过去，返回是否有新建
+        existing = subprocess.run(
+            ["iptables-save", "-t", "nat"], capture_output=True, text=True
+        ).stdout
+        firewall = IptablesFirewall()
+        for chain, builtin in [
+            (PREROUTING_CHAIN, "PREROUTING"),
+            (POSTROUTING_CHAIN, "POSTROUTING"),
+        ]:
+            if f":{chain} " in existing:
+                continue
+            firewall.declare("nat", chain)
+            firewall.add("nat", f"-A {builtin} -j {chain}")
+        if not firewall.chains["nat"]:
+            return False
+        return IptablesFirewall.restore(firewall.render()).returncode == 0
+
+    def prune_port_mappings(self, active_ids, active_ips):
+        # 每个容器一条 MYDOCKER-DNAT-<ID> 链，容器不在 active_ids 中的链整条删除，返回删除的链
+        existing = subprocess.run(
+            ["iptables-save", "-t", "nat"], capture_output=True, text=True
+        ).stdout
+        prefix = ":" + IptablesFirewall.container_chain("")
+        removed = []
+        for line in existing.splitlines():
+            if not line.startswith(prefix):
+                continue
+            container_id = line[len(prefix) :].split()[0]
+            if container_id in active_ids:
+                continue
+            self.remove_port_mappings(None, container_id, None, [])
+            removed.append(IptablesFirewall.container_chain(container_id))
+        return removed
+
+    def setup_network(self, network):
+        IptablesFirewall.ensure_base_chains()
+        # 设置 SNAT 规则，容器访问外部网络时做 MASQUERADE
+        self.add(
+            "nat",
+            f"-A {POSTROUTING_CHAIN} -s {network['IpRange']} ! -o {network['NAME']} -j MASQUERADE",
+        )
+
+    def teardown_network(self, network):
+        rule = f"-s {network['IpRange']} ! -o {network['NAME']} -j MASQUERADE"
+        self.add("nat", f"-D {POSTROUTING_CHAIN} {rule}")
+        self.legacy_rules.append(f"-D POSTROUTING {rule}")
+
+    def add_port_mappings(self, network, container_id, ip, port_mappings):
+        # iptables -t filter -L 一般缺省策略都是 ACCEPT，如果缺省策略是DROP，需要设置为ACCEPT
+        self.declare("filter", "FORWARD", "ACCEPT")
+        chain = IptablesFirewall.container_chain(container_id)
+        self.declare("nat", chain)
+        self.add("nat", f"-A {PREROUTING_CHAIN} -j {chain}")
+        for port_mapping in port_mappings:
+            host_port, container_port = port_mapping.split(":")
+            self.add(
+                "nat",
+                f"-A {chain} -p tcp -m tcp --dport {host_port} -j DNAT --to-destination {ip}:{container_port}",
+            )
+
+    def remove_port_mappings(self, network, container_id, ip, port_mappings):
+        # 删除跳转规则后清空并删除容器的链，不需要逐条 -D
+        chain = IptablesFirewall.container_chain(container_id)
+        self.add("nat", f"-D {PREROUTING_CHAIN} -j {chain}")
+        self.add("nat", f"-F {chain}")
+        self.add("nat", f"-X {chain}")
+        for port_mapping in port_mappings:
+            host_port, container_port = port_mapping.split(":")
+            self.legacy_rules.append(
+                f"-D PREROUTING -p tcp -m tcp --dport {host_port} -j DNAT --to-destination {ip}:{container_port}"
+            )
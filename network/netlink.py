@@ -0,0 +1,255 @@
+import errno
+import os
+import socket
+import struct
+
+from utility import shell
+
+# 见 <linux/netlink.h>、<linux/rtnetlink.h>、<linux/if_link.h>
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_NEWROUTE = 24
+IFLA_IFNAME = 3
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_NET_NS_FD = 28
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_GATEWAY = 5
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+IFF_UP = 0x1
+# struct ifinfomsg、ifaddrmsg、rtmsg、nlmsghdr
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTMSG = struct.Struct("=BBBBBBBBI")
+NLMSGHDR = struct.Struct("=IHHII")
+
+
+def rtattr(attr_type, payload):
+    # struct rtattr { unsigned short rta_len; unsigned short rta_type; } + payload，按 4 字节对齐
+    if isinstance(payload, str):
+        payload = payload.encode() + b"\x00"
+    data = struct.pack("=HH", 4 + len(payload), attr_type) + payload
+    return data + b"\x00" * (-len(data) % 4)
+
+
+class NetlinkBackend:
+    # 通过 AF_NETLINK 套接字在进程内直接配置网络设备，不再为每一步 fork 一个 ip 进程
+    name = "netlink"
+
+    def __init__(self, pid=None) -> None:
+        self.seq = 0
+        if pid is None:
+            self.sock = NetlinkBackend.open_socket()
+            return
+        # 在容器的 net namespace 中创建 socket，之后通过这个 socket 的操作都作用在容器的网络上，
+        # 创建完之后马上切回原来的 namespace，不再需要 nsenter
+        self_ns = os.open("/proc/self/ns/net", os.O_RDONLY)
+        target_ns = os.open(f"/proc/{pid}/ns/net", os.O_RDONLY)
+        try:
+            os.setns(target_ns, os.CLONE_NEWNET)
+            try:
+                self.sock = NetlinkBackend.open_socket()
+            finally:
+                os.setns(self_ns, os.CLONE_NEWNET)
+        finally:
+            os.close(self_ns)
+            os.close(target_ns)
+
+    @staticmethod
+    def open_socket():
+        sock = socket.socket(
+            socket.AF_NETLINK,
+            socket.SOCK_RAW | socket.SOCK_CLOEXEC,
+            socket.NETLINK_ROUTE,
+        )
+        sock.bind((0, 0))
+        return sock
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, msg_type, flags, body, ignore_errors=False):
+        self.seq += 1
+        header = NLMSGHDR.pack(
+            NLMSGHDR.size + len(body), msg_type, NLM_F_REQUEST | flags, self.seq, 0
+        )
+        self.sock.send(header + body)
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, reply_type, _, seq, _ = NLMSGHDR.unpack_from(data, offset)
+                payload = data[offset + NLMSGHDR.size : offset + length]
+                offset += (length + 3) & ~3
+                if seq != self.seq:
+                    continue
+                if reply_type == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", payload)[0]
+                    if error and not ignore_errors:
+                        raise OSError(error, f"netlink: {os.strerror(error)}")
+                    return None
+                return payload
+
+    def link_index(self, name):
+        body = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + rtattr(IFLA_IFNAME, name)
+        payload = self.request(RTM_GETLINK, 0, body)
+        return IFINFOMSG.unpack_from(payload)[2]
+
+    def new_link(self, name, kind, info_data=b""):
+        linkinfo = rtattr(IFLA_INFO_KIND, kind)
+        if info_data:
+            linkinfo += rtattr(IFLA_INFO_DATA, info_data)
+        body = (
+            IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+            + rtattr(IFLA_IFNAME, name)
+            + rtattr(IFLA_LINKINFO, linkinfo)
+        )
+        self.request(RTM_NEWLINK, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, body)
+
+    def set_link(self, name, flags=0, change=0, attrs=b""):
+        body = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, flags, change) + rtattr(
+            IFLA_IFNAME, name
+        )
+        self.request(RTM_NEWLINK, NLM_F_ACK, body + attrs)
+
+    # ip link add {name} type bridge
+    def link_add_bridge(self, name):
+        self.new_link(name, "bridge")
+
+    # ip link add {name} type veth peer name {peer}
+    def link_add_veth(self, name, peer):
+        peer_info = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + rtattr(
+            IFLA_IFNAME, peer
+        )
+        self.new_link(name, "veth", rtattr(VETH_INFO_PEER, peer_info))
+
+    # ip link delete dev {name}
+    def link_delete(self, name, ignore_errors=False):
+        body = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + rtattr(IFLA_IFNAME, name)
+        self.request(RTM_DELLINK, NLM_F_ACK, body, ignore_errors)
+
+    # ip link set {name} master {master} / ip link set {name} nomaster
+    def link_set_master(self, name, master):
+        index = self.link_index(master) if master else 0
+        self.set_link(name, attrs=rtattr(IFLA_MASTER, struct.pack("=I", index)))
+
+    # ip link set dev {name} up
+    def link_set_up(self, name):
+        self.set_link(name, IFF_UP, IFF_UP)
+
+    # ip link set {name} netns {pid}
+    def link_set_netns(self, name, pid):
+        ns_fd = os.open(f"/proc/{pid}/ns/net", os.O_RDONLY)
+        try:
+            self.set_link(name, attrs=rtattr(IFLA_NET_NS_FD, struct.pack("=I", ns_fd)))
+        finally:
+            os.close(ns_fd)
+
+    # ip addr add {ip_interface} dev {name}
+    def addr_add(self, name, ip_interface):
+        address = ip_interface.ip.packed
+        body = IFADDRMSG.pack(
+            socket.AF_INET,
+            ip_interface.network.prefixlen,
+            0,
+            RT_SCOPE_UNIVERSE,
+            self.link_index(name),
+        )
+        body += rtattr(IFA_LOCAL, address) + rtattr(IFA_ADDRESS, address)
+        self.request(RTM_NEWADDR, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, body)
+
+    # ip route add default via {gateway}
+    def route_add_default(self, gateway):
+        body = RTMSG.pack(
+            socket.AF_INET,
+            0,
+            0,
+            0,
+            RT_TABLE_MAIN,
+            RTPROT_BOOT,
+            RT_SCOPE_UNIVERSE,
+            RTN_UNICAST,
+            0,
+        )
+        body += rtattr(RTA_GATEWAY, gateway.packed)
+        self.request(RTM_NEWROUTE, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, body)
+
+
+class IpCommandBackend:
+    # 调用 ip 命令配置网络设备，容器内的操作通过 nsenter 进入容器的 net namespace
+    name = "ip"
+
+    def __init__(self, pid=None) -> None:
+        self.prefix = "" if pid is None else f"nsenter -t {pid} -n -- "
+
+    def close(self):
+        pass
+
+    def ip(self, args, exit_if_error=True):
+        shell(f"{self.prefix}ip {args}", exit_if_error)
+
+    def link_add_bridge(self, name):
+        self.ip(f"link add {name} type bridge")
+
+    def link_add_veth(self, name, peer):
+        self.ip(f"link add {name} type veth peer name {peer}")
+
+    def link_delete(self, name, ignore_errors=False):
+        self.ip(f"link delete dev {name}", not ignore_errors)
+
+    def link_set_master(self, name, master):
+        self.ip(
+            f"link set {name} master {master}"
+            if master
+            else f"link set {name} nomaster"
+        )
+
+    def link_set_up(self, name):
+        self.ip(f"link set dev {name} up")
+
+    def link_set_netns(self, name, pid):
+        self.ip(f"link set {name} netns {pid}")
+
+    def addr_add(self, name, ip_interface):
+        self.ip(f"addr add {ip_interface} dev {name}")
+
+    def route_add_default(self, gateway):
+        self.ip(f"route add default via {gateway}")
+
+
+link_backends = {
+    backend.name: backend for backend in [NetlinkBackend, IpCommandBackend]
+}
+
+
+def link_backend(pid=None):
+    # 默认使用 netlink，可以通过 MYDOCKER_NET_BACKEND=ip 切换回 ip 命令；
+    # netlink 不可用时（例如内核或者容器环境不支持 AF_NETLINK）自动回退到 ip 命令
+    name = os.environ.get("MYDOCKER_NET_BACKEND", NetlinkBackend.name)
+    if name not in link_backends:
+        raise Exception(f"Network backend {name} not found")
+    try:
+        return link_backends[name](pid)
+    except OSError as e:
+        if name != NetlinkBackend.name or e.errno not in [
+            errno.EAFNOSUPPORT,
+            errno.EPROTONOSUPPORT,
+            errno.EPERM,
+            errno.EACCES,
+        ]:
+            raise
+        return IpCommandBackend(pid)
@@ -2,11 +2,14 @@ import ipaddress
 import json
 import os
 
-from tabulate import tabulate
-from utility import shell
+from tracing import traced
+from utility import format_table
 
 from .bridge_network_driver import BridgeNetworkDriver
+from .iptables import IptablesFirewall
 from .ipam import IPAM
+from .netlink import link_backend
+from .nftables import NftablesFirewall
 
 default_network_path = os.path.join(os.path.dirname(__file__), "networks.json")
 
@@ -16,6 +19,21 @@ class Network:
     def init():
         return {BridgeNetworkDriver.name: BridgeNetworkDriver}
 
+    @staticmethod
+    def firewalls():
+        return {
+            firewall.name: firewall for firewall in [IptablesFirewall, NftablesFirewall]
+        }
+
+    @staticmethod
+    def firewall(network):
+        # 旧版本创建的网络没有记录 Firewall，默认使用 iptables
+        name = network.get("Firewall", IptablesFirewall.name)
+        firewalls = Network.firewalls()
+        if name not in firewalls:
+            raise Exception(f"Firewall {name} not found")
+        return firewalls[name]()
+
     @staticmethod
     def load(path=default_network_path):
         if not os.path.exists(path):
@@ -34,26 +52,32 @@ class Network:
             json.dump(networks, f, indent=4)
 
     @staticmethod
-    def create(name, subnet, driver):
+    def create(name, subnet, driver, firewall=IptablesFirewall.name):
         drivers = Network.init()
         if driver not in drivers:
             raise Exception(f"Driver {driver} not found")
+        if firewall not in Network.firewalls():
+            raise Exception(f"Firewall {firewall} not found")
         subnet = ipaddress.ip_network(subnet, strict=True)
         ip_interface = IPAM().allocate(subnet)
         drivers[driver].create(subnet, ip_interface, name)
-        Network.dump(
-            default_network_path,
-            name,
-            {
-                "NAME": name,
-                "IpRange": str(subnet),
-                "IP": str(ip_interface.ip),
-                "Driver": driver,
-            },
-        )
+        network = {
+            "NAME": name,
+            "IpRange": str(subnet),
+            "IP": str(ip_interface.ip),
+            "Driver": driver,
+            "Firewall": firewall,
+        }
+        # 设置 SNAT 规则
+        firewall = Network.firewall(network)
+        firewall.setup_network(network)
+        firewall.commit()
+        Network.dump(default_network_path, name, network)
 
     @staticmethod
-    def connect(network_name, container_info):
+    @traced()
+    def connect(network_name, container_info, ip_interface=None, port_mapping=True):
+        # --replicas 批量启动时 IP 已经一次分配好，端口映射也由调用者在一个事务里统一提交
         if network_name is None:
             return
         drivers = Network.init()
@@ -63,7 +87,8 @@ class Network:
             raise Exception(f"Network {network_name} not found")
         network = networks[network_name]
         # 分配容器IP地址
-        ip_interface = IPAM().allocate(network["IpRange"])
+        if ip_interface is None:
+            ip_interface = IPAM().allocate(network["IpRange"])
         # 创建网络端点
         endpoint = {
             "ID": container_info["ID"],
@@ -76,38 +101,51 @@ class Network:
         # 到容器的namespace配置容器网络设备IP地址
         Network.config_endpoint_ip_address_and_route(network, endpoint, container_info)
         # 配置端口映射信息，例如 mydocker run -p 8080:80
-        Network.config_port_mapping(endpoint)
+        if port_mapping:
+            Network.config_port_mapping(network, endpoint)
 
     @staticmethod
     def config_endpoint_ip_address_and_route(network, endpoint, container_info):
         peer_veth_name = endpoint["PEERNAME"]
         # 将容器的网络端点加入到容器的网络空间中
-        command = f"ip link set {peer_veth_name} netns {container_info['PID']}"
-        shell(command)
-        # 设置容器端口IP地址
-        command = f"nsenter -t {container_info['PID']} -n -- ip addr add {endpoint['IPINTERFACE']} dev {peer_veth_name}"
-        shell(command)
-        # 启动容器端口
-        command = f"nsenter -t {container_info['PID']} -n -- ip link set dev {peer_veth_name} up"
-        shell(command)
-        # 启动lo
-        command = f"nsenter -t {container_info['PID']} -n -- ip link set lo up"
-        shell(command)
-        # 设置容器端口默认路由
-        command = f"nsenter -t {container_info['PID']} -n -- ip route add default via {network['IP']}"
-        shell(command)
-
-    @staticmethod
-    def config_port_mapping(endpoint):
-        if endpoint["PORTMAPPING"] is None:
+        link = link_backend()
+        try:
+            link.link_set_netns(peer_veth_name, container_info["PID"])
+        finally:
+            link.close()
+        # 之后的操作都在容器的 net namespace 中进行
+        link = link_backend(container_info["PID"])
+        try:
+            # 设置容器端口IP地址
+            link.addr_add(peer_veth_name, endpoint["IPINTERFACE"])
+            # 启动容器端口
+            link.link_set_up(peer_veth_name)
+            # 启动lo
+            link.link_set_up("lo")
+            # 设置容器端口默认路由
+            link.route_add_default(ipaddress.ip_address(network["IP"]))
+        finally:
+            link.close()
+
+    @staticmethod
+    def config_port_mapping(network, endpoint):
+        Network.config_port_mappings(network, [endpoint])
+
+    @staticmethod
+    def config_port_mappings(network, endpoints):
+        endpoints = [endpoint for endpoint in endpoints if endpoint["PORTMAPPING"]]
+        if not endpoints:
             return
-        # iptables -t filter -L 一般缺省策略都是 ACCEPT，不需要改动，如果如果缺省策略是DROP，需要设置为ACCEPT：
-        shell("iptables -t filter -P FORWARD ACCEPT")
-        for port_mapping in endpoint["PORTMAPPING"]:
-            host_port, container_port = port_mapping.split(":")
-            endpoint_ip = endpoint["IPINTERFACE"].ip
-            command = f"iptables -t nat -A PREROUTING -p tcp -m tcp --dport {host_port} -j DNAT --to-destination {endpoint_ip}:{container_port}"
-            shell(command)
+        # 防火墙后端在 commit 之前只累积规则，多个容器的所有端口映射在一个事务里提交
+        firewall = Network.firewall(network)
+        for endpoint in endpoints:
+            firewall.add_port_mappings(
+                network,
+                endpoint["ID"],
+                endpoint["IPINTERFACE"].ip,
+                endpoint["PORTMAPPING"],
+            )
+        firewall.commit()
 
     @staticmethod
     def list():
@@ -115,7 +153,7 @@ class Network:
         table = []
         for name, info in networks.items():
             table.append([name, info["IpRange"], info["Driver"]])
-        print(tabulate(table, headers=["NAME", "IPRANGE", "DRIVER"]))
+        print(format_table(table, ["NAME", "IPRANGE", "DRIVER"]))
 
     @staticmethod
     def remove(network_name):
@@ -123,9 +161,10 @@ class Network:
         if network_name not in networks:
             raise Exception(f"Network {network_name} not found")
         network = networks[network_name]
-        # 清除 iptables 规则
-        command = f"iptables -t nat -D POSTROUTING -s {network['IpRange']} ! -o {network_name} -j MASQUERADE"
-        shell(command)
+        # 清除 SNAT 规则
+        firewall = Network.firewall(network)
+        firewall.teardown_network(network)
+        firewall.commit(exit_if_error=False)
         # 删除网桥
         drivers = Network.init()
         driver = network["Driver"]
@@ -137,11 +176,77 @@ class Network:
 
     @staticmethod
     def disconnect(container_info):
-        # 清除 iptables 规则
-        if container_info["PORTMAPPING"] is None:
-            return
-        for port_mapping in container_info["PORTMAPPING"]:
-            host_port, container_port = port_mapping.split(":")
-            endpoint_ip = container_info["IP"]
-            command = f"iptables -t nat -D PREROUTING -p tcp -m tcp --dport {host_port} -j DNAT --to-destination {endpoint_ip}:{container_port}"
-            shell(command)
+        Network.disconnect_many([container_info])
+
+    @staticmethod
+    def disconnect_many(container_infos):
+        # 清除端口映射规则并释放 IP，同一个网络的所有容器只提交一次防火墙事务、加一次 IPAM 锁
+        networks = Network.load()
+        grouped = {}
+        for container_info in container_infos:
+            if container_info.get("NETWORK") in networks:
+                grouped.setdefault(container_info["NETWORK"], []).append(container_info)
+        for network_name, infos in grouped.items():
+            network = networks[network_name]
+            firewall = Network.firewall(network)
+            mapped = [info for info in infos if info.get("PORTMAPPING")]
+            for container_info in mapped:
+                Network.remove_port_mapping(firewall, network, container_info)
+            if not firewall.commit(exit_if_error=False) and len(mapped) > 1:
+                # 某个容器的规则已经不在了（例如宿主机重启后被清空）会让整个事务被拒绝，
+                # 这时逐个容器重试，其他容器的规则不会遗留
+                for container_info in mapped:
+                    Network.remove_port_mapping(firewall, network, container_info)
+                    firewall.commit(exit_if_error=False)
+            ips = [str(info["IP"]) for info in infos if info.get("IP")]
+            if ips:
+                IPAM().release_many(network["IpRange"], ips)
+
+    @staticmethod
+    def remove_port_mapping(firewall, network, container_info):
+        firewall.remove_port_mappings(
+            network,
+            container_info["ID"],
+            container_info.get("IP"),
+            container_info["PORTMAPPING"],
+        )
+
+    @staticmethod
+    def prune(active_ids, active_ips, reclaim_ips=True):
+        # system prune 调用：回收不属于任何活跃容器的 veth、端口映射和 IP，返回 [(类型, 资源)]；
+        # 端口映射对每种防火墙后端只提交一次事务
+        reclaimed = []
+        networks = Network.load()
+        drivers = Network.init()
+        firewalls = {}
+        for network in networks.values():
+            driver = drivers.get(network["Driver"])
+            if driver is not None:
+                # 宿主机一端的 veth 名字是容器 ID 的前 5 位
+                for veth_name in driver.ports(network):
+                    if any(
+                        container_id.startswith(veth_name)
+                        for container_id in active_ids
+                    ):
+                        continue
+                    driver.delete_port(veth_name)
+                    reclaimed.append(("veth", veth_name))
+            firewall = Network.firewall(network)
+            firewalls.setdefault(firewall.name, firewall)
+        for firewall in firewalls.values():
+            removed = firewall.prune_port_mappings(active_ids, active_ips)
+            if removed and firewall.commit(exit_if_error=False):
+                reclaimed.extend(("port mapping", rule) for rule in removed)
+        if not reclaim_ips:
+            return reclaimed
+        ipam = IPAM()
+        for network in networks.values():
+            stale = [
+                str(ip)
+                for ip in ipam.allocated(network["IpRange"])
+                if str(ip) not in active_ips and str(ip) != network["IP"]
+            ]
+            if stale:
+                ipam.release_many(network["IpRange"], stale)
+                reclaimed.extend(("ip", ip) for ip in stale)
+        return reclaimed
@@ -0,0 +1,109 @@
+import re
+import subprocess
+import sys
+
+TABLE = "ip mydocker"
+# nft list map 输出中的元素: 8080 : 172.18.0.2 . 80
+port_mapping_element = re.compile(r"(\d+) : ([\d.]+) \. (\d+)")
+
+
+class NftablesFirewall:
+    # 所有网络共用 ip mydocker 表：端口映射保存在 dport -> ip . port 的 map 里，
+    # 需要 MASQUERADE 的子网和网桥保存在 set 里，数据包只做一次哈希查找，
+    # 增删端口映射也只是增删一个元素，规则数不会随着映射数增长
+    name = "nftables"
+
+    def __init__(self) -> None:
+        self.commands = []
+
+    def add(self, command):
+        self.commands.append(command)
+
+    def render(self):
+        return "\n".join(self.commands) + "\n"
+
+    def commit(self, exit_if_error=True):
+        if not self.commands:
+            return True
+        commands = self.render()
+        result = NftablesFirewall.apply(commands)
+        if result.returncode != 0 and NftablesFirewall.ensure_table():
+            # 表不存在（例如宿主机重启后规则被清空），创建后重试一次
+            result = NftablesFirewall.apply(commands)
+        self.commands = []
+        if result.returncode != 0:
+            print(result.stderr)
+            if exit_if_error:
+                sys.exit(1)
+            return False
+        return True
+
+    @staticmethod
+    def apply(commands):
+        # nft -f 中的所有命令在一个事务里原子提交
+        return subprocess.run(
+            ["nft", "-f", "-"], input=commands, capture_output=True, text=True
+        )
+
+    @staticmethod
+    def ensure_table():
+        # add 对已经存在的表、链、集合是幂等的，已有的元素不受影响；
+        # 链中的规则先 flush 再添加，保证重复执行不会产生重复规则
+        commands = [
+            f"add table {TABLE}",
+            f"add set {TABLE} masquerade_subnets {{ type ipv4_addr; flags interval; }}",
+            f"add set {TABLE} bridges {{ type ifname; }}",
+            f"add map {TABLE} port_mappings {{ type inet_service : ipv4_addr . inet_service; }}",
+            f"add chain {TABLE} prerouting {{ type nat hook prerouting priority dstnat; policy accept; }}",
+            f"add chain {TABLE} postrouting {{ type nat hook postrouting priority srcnat; policy accept; }}",
+            f"flush chain {TABLE} prerouting",
+            f"flush chain {TABLE} postrouting",
+            f"add rule {TABLE} prerouting meta l4proto tcp dnat ip addr . port to tcp dport map @port_mappings",
+            f"add rule {TABLE} postrouting ip saddr @masquerade_subnets oifname != @bridges masquerade",
+        ]
+        return NftablesFirewall.apply("\n".join(commands) + "\n").returncode == 0
+
+    def prune_port_mappings(self, active_ids, active_ips):
+        # map 的元素是 宿主机端口 : 容器IP . 容器端口，容器 IP 不在 active_ips 中的元素删除，返回删除的元素
+        result = subprocess.run(
+            ["nft", "list", "map", *TABLE.split(), "port_mappings"],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            return []
+        removed = [
+            match.group(0)
+            for match in port_mapping_element.finditer(result.stdout)
+            if match.group(2) not in active_ips
+        ]
+        if removed:
+            host_ports = [element.split(":")[0].strip() for element in removed]
+            self.add(
+                f"delete element {TABLE} port_mappings {{ {', '.join(host_ports)} }}"
+            )
+        return removed
+
+    def setup_network(self, network):
+        NftablesFirewall.ensure_table()
+        # 设置 SNAT 规则，容器访问外部网络时做 MASQUERADE
+        self.add(f"add element {TABLE} masquerade_subnets {{ {network['IpRange']} }}")
+        self.add(f'add element {TABLE} bridges {{ "{network["NAME"]}" }}')
+
+    def teardown_network(self, network):
+        self.add(
+            f"delete element {TABLE} masquerade_subnets {{ {network['IpRange']} }}"
+        )
+        self.add(f'delete element {TABLE} bridges {{ "{network["NAME"]}" }}')
+
+    def add_port_mappings(self, network, container_id, ip, port_mappings):
+        elements = []
+        for port_mapping in port_mappings:
+            host_port, container_port = port_mapping.split(":")
+            elements.append(f"{host_port} : {ip} . {container_port}")
+        self.add(f"add element {TABLE} port_mappings {{ {', '.join(elements)} }}")
+
+    def remove_port_mappings(self, network, container_id, ip, port_mappings):
+        # map 以宿主机端口为键，删除时不需要容器 IP
+        host_ports = [port_mapping.split(":")[0] for port_mapping in port_mappings]
+        self.add(f"delete element {TABLE} port_mappings {{ {', '.join(host_ports)} }}")
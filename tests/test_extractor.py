@@ -0,0 +1,151 @@
+import io
+import os
+import stat
+import tarfile
+
+import pytest
+
+from container.extractor import OPAQUE_XATTR, Extractor
+
+requires_root = pytest.mark.skipif(os.geteuid() != 0, reason="mknod requires root")
+
+
+def make_tar(path, members):
+    # members: (name, type, 内容/链接目标, mode)
+    with tarfile.open(path, "w") as tar:
+        for name, kind, value, mode in members:
+            info = tarfile.TarInfo(name)
+            info.mode = mode
+            data = None
+            if kind == "dir":
+                info.type = tarfile.DIRTYPE
+            elif kind == "sym":
+                info.type = tarfile.SYMTYPE
+                info.linkname = value
+            elif kind == "lnk":
+                info.type = tarfile.LNKTYPE
+                info.linkname = value
+            else:
+                data = io.BytesIO(value)
+                info.size = len(value)
+            tar.addfile(info, data)
+    return str(path)
+
+
+def test_safe_path(tmp_path):
+    dest = tmp_path / "root"
+    outside = tmp_path / "outside"
+    dest.mkdir()
+    outside.mkdir()
+    os.symlink(str(outside), dest / "escape")
+    os.symlink("sub", dest / "inner")
+    extractor = Extractor(str(dest))
+    assert extractor.safe_path("a/b") == str(dest / "a" / "b")
+    # 绝对路径按相对于目标目录处理
+    assert extractor.safe_path("/etc/passwd") == str(dest / "etc" / "passwd")
+    assert extractor.safe_path("./a//b/") == str(dest / "a" / "b")
+    assert extractor.safe_path("../a") is None
+    assert extractor.safe_path("a/../../b") is None
+    assert extractor.safe_path(".") is None
+    assert extractor.safe_path("escape/x") is None
+    assert extractor.safe_path("inner/x") == str(dest / "inner" / "x")
+    assert (dest / "sub").is_dir()
+
+
+def test_extract(tmp_path):
+    dest = tmp_path / "root"
+    tar_path = make_tar(
+        tmp_path / "layer.tar",
+        [
+            ("bin", "dir", None, 0o755),
+            ("bin/sh", "file", b"#!", 0o755),
+            ("bin/ash", "lnk", "bin/sh", 0o755),
+            ("etc/motd", "file", b"old", 0o644),
+            ("etc/motd", "file", b"new", 0o600),
+            ("etc/link", "sym", "motd", 0o777),
+        ],
+    )
+    Extractor(str(dest)).extract(tar_path)
+    assert (dest / "bin" / "sh").read_bytes() == b"#!"
+    assert stat.S_IMODE(os.stat(dest / "bin" / "sh").st_mode) == 0o755
+    assert os.stat(dest / "bin" / "ash").st_ino == os.stat(dest / "bin" / "sh").st_ino
+    # 同一个路径出现多次时以最后一个为准
+    assert (dest / "etc" / "motd").read_bytes() == b"new"
+    assert stat.S_IMODE(os.stat(dest / "etc" / "motd").st_mode) == 0o600
+    assert os.readlink(dest / "etc" / "link") == "motd"
+
+
+def test_extract_through_symlink(tmp_path):
+    dest = tmp_path / "root"
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    tar_path = make_tar(
+        tmp_path / "layer.tar",
+        [
+            ("escape", "sym", str(outside), 0o777),
+            ("escape/file", "file", b"x", 0o644),
+            ("link", "lnk", "escape/file", 0o644),
+        ],
+    )
+    Extractor(str(dest)).extract(tar_path)
+    assert os.listdir(outside) == []
+    assert not os.path.lexists(dest / "link")
+
+
+def test_replaced_symlink_parent(tmp_path):
+    # 先通过指向内部目录的符号链接写文件，再把符号链接换成指向外部：排队中的写入和 chmod 都不能跟过去
+    dest = tmp_path / "root"
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    tar_path = make_tar(
+        tmp_path / "layer.tar",
+        [
+            ("sub", "dir", None, 0o755),
+            ("d", "sym", "sub", 0o777),
+            ("d/f", "file", b"x", 0o777),
+            ("d", "sym", str(outside), 0o777),
+        ],
+    )
+    Extractor(str(dest)).extract(tar_path)
+    assert os.listdir(outside) == []
+    assert (dest / "sub" / "f").read_bytes() == b"x"
+    assert stat.S_IMODE(os.stat(dest / "sub" / "f").st_mode) == 0o600
+
+
+def test_metadata_not_applied_through_replacing_symlink(tmp_path):
+    dest = tmp_path / "root"
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    target = outside / "target"
+    target.write_bytes(b"host")
+    os.chmod(target, 0o600)
+    tar_path = make_tar(
+        tmp_path / "layer.tar",
+        [
+            ("f", "file", b"x", 0o777),
+            ("f", "sym", str(target), 0o777),
+        ],
+    )
+    Extractor(str(dest)).extract(tar_path)
+    assert os.readlink(dest / "f") == str(target)
+    assert target.read_bytes() == b"host"
+    assert stat.S_IMODE(os.stat(target).st_mode) == 0o600
+
+
+@requires_root
+def test_whiteouts(tmp_path):
+    dest = tmp_path / "root"
+    tar_path = make_tar(
+        tmp_path / "layer.tar",
+        [
+            ("etc/.wh.motd", "file", b"", 0o644),
+            ("var", "dir", None, 0o755),
+            ("var/.wh..wh..opq", "file", b"", 0o644),
+        ],
+    )
+    Extractor(str(dest), whiteouts=True).extract(tar_path)
+    st = os.lstat(dest / "etc" / "motd")
+    assert stat.S_ISCHR(st.st_mode) and st.st_rdev == os.makedev(0, 0)
+    assert not os.path.lexists(dest / "etc" / ".wh.motd")
+    assert os.getxattr(dest / "var", OPAQUE_XATTR) == b"y"
+    assert os.listdir(dest / "var") == []
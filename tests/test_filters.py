@@ -0,0 +1,49 @@
+import pytest
+
+from container.container import Container
+
+container_info = {
+    "ID": "3f4373675e",
+    "NAME": "web-1",
+    "STATUS": "running",
+    "NETWORK": "testnet",
+}
+
+
+def test_parse_filters():
+    assert Container.parse_filters(None) == {}
+    assert Container.parse_filters(
+        ["status=running", "name=web", "status=exited", "network=a=b"]
+    ) == {"status": {"running", "exited"}, "name": {"web"}, "network": {"a=b"}}
+
+
+def test_parse_filters_unsupported(capsys):
+    with pytest.raises(SystemExit):
+        Container.parse_filters(["label=x"])
+    assert "unsupported filter: label=x" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "filters, matched",
+    [
+        ([], True),
+        (["id=3f43"], True),
+        (["id=43"], False),
+        (["name=web"], True),
+        (["name=db"], False),
+        (["name=db", "name=web"], True),
+        (["status=running"], True),
+        (["status=exited"], False),
+        (["status=exited", "status=running"], True),
+        (["network=testnet"], True),
+        (["network=other"], False),
+        # 不同 key 之间是与的关系
+        (["status=running", "name=db"], False),
+        (["status=running", "id=3f", "network=testnet"], True),
+    ],
+)
+def test_match_filters(filters, matched):
+    assert (
+        Container.match_filters(container_info, Container.parse_filters(filters))
+        is matched
+    )
@@ -0,0 +1,16 @@
+import pytest
+
+import import_bench
+
+
+@pytest.mark.parametrize(
+    "command, modules",
+    import_bench.commands,
+    ids=[" ".join(command) for command, _ in import_bench.commands],
+)
+def test_command_imports(command, modules):
+    # ps、stop 这些命令不能加载网络、镜像层、日志这些只有 run 才用到的模块
+    imported = import_bench.imported_modules(command)
+    # 子进程没有输出模块列表说明命令本身出错了
+    assert imported
+    assert [module for module in modules if module in imported] == []
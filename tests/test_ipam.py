@@ -0,0 +1,54 @@
+import ipaddress
+
+from network.ipam import IPAM, SubnetBitmap
+
+
+def ips(*offsets):
+    return [ipaddress.ip_address(f"10.0.0.{offset}") for offset in offsets]
+
+
+def test_allocate_and_release():
+    bitmap = SubnetBitmap(ipaddress.ip_network("10.0.0.0/29"))
+    # 网络地址和广播地址不分配
+    assert [bitmap.allocate() for _ in range(7)] == ips(1, 2, 3, 4, 5, 6) + [None]
+    assert bitmap.release("10.0.0.3")
+    assert not bitmap.release("10.0.0.3")
+    assert not bitmap.release("10.0.1.3")
+    assert not bitmap.release("10.0.0.0")
+    assert not bitmap.release("10.0.0.7")
+    # 从上次分配的位置往后找，到末尾后从头开始
+    assert bitmap.allocate() == ips(3)[0]
+    assert bitmap.allocated() == ips(1, 2, 3, 4, 5, 6)
+
+
+def test_dump_and_load():
+    subnet = ipaddress.ip_network("10.0.0.0/24")
+    bitmap = SubnetBitmap(subnet)
+    for _ in range(3):
+        bitmap.allocate()
+    bitmap.release("10.0.0.2")
+    loaded = SubnetBitmap(subnet, bitmap.dump())
+    assert loaded.allocated() == ips(1, 3)
+    # next 按字节查找，同一个字节里释放的地址会先被重新分配
+    assert [loaded.allocate() for _ in range(2)] == ips(2, 4)
+
+
+def test_migrate_from_list():
+    # 旧版本的 subnet.json 里每个子网是已分配 IP 的列表
+    bitmap = SubnetBitmap(ipaddress.ip_network("10.0.0.0/24"), ["10.0.0.2", "10.0.0.5"])
+    assert bitmap.allocated() == ips(2, 5)
+    assert [bitmap.allocate() for _ in range(3)] == ips(1, 3, 4)
+
+
+def test_ipam_allocate_many(tmp_path):
+    ipam = IPAM(str(tmp_path / "subnet.json"))
+    subnet = "10.0.0.0/29"
+    assert [str(i) for i in ipam.allocate_many(subnet, 4)] == [
+        f"10.0.0.{offset}/29" for offset in [1, 2, 3, 4]
+    ]
+    # 地址不够时一个都不分配
+    assert ipam.allocate_many(subnet, 3) is None
+    assert ipam.allocated(subnet) == ips(1, 2, 3, 4)
+    assert ipam.release_many(subnet, ["10.0.0.1", "10.0.0.3", "10.0.0.6"]) == 2
+    assert ipam.allocated(subnet) == ips(2, 4)
+    assert str(ipam.allocate(subnet)) == "10.0.0.1/29"
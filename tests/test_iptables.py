@@ -0,0 +1,53 @@
+import subprocess
+
+from network import iptables
+from network.iptables import IptablesFirewall
+
+NETWORK = {"NAME": "testbr", "IpRange": "192.168.10.0/24"}
+
+
+def fake_iptables(monkeypatch, legacy):
+    # legacy: 旧版本加在内置链中、还没有删除的规则
+    commands = []
+
+    def run(args, input=None, **kwargs):
+        commands.append(args)
+        if args[0] == "iptables-save":
+            return subprocess.CompletedProcess(
+                args, 0, ":MYDOCKER-POSTROUTING - [0:0]\n"
+            )
+        if args[0] == "iptables-restore":
+            # MYDOCKER-* 链中没有这些规则，整个事务被拒绝
+            return subprocess.CompletedProcess(args, 1, "", "line 2 failed")
+        rule = " ".join(args[args.index("nat") + 1 :])
+        if rule in legacy:
+            legacy.remove(rule)
+            return subprocess.CompletedProcess(args, 0)
+        return subprocess.CompletedProcess(args, 1)
+
+    monkeypatch.setattr(iptables.subprocess, "run", run)
+    return commands
+
+
+def test_legacy_rules_deleted_from_builtin_chains(monkeypatch, capsys):
+    legacy = [
+        "-D POSTROUTING -s 192.168.10.0/24 ! -o testbr -j MASQUERADE",
+        "-D PREROUTING -p tcp -m tcp --dport 8080 -j DNAT --to-destination 192.168.10.2:80",
+    ]
+    fake_iptables(monkeypatch, legacy)
+    firewall = IptablesFirewall()
+    firewall.teardown_network(NETWORK)
+    firewall.remove_port_mappings(NETWORK, "abc", "192.168.10.2", ["8080:80"])
+    assert not firewall.commit()
+    assert legacy == []
+    assert capsys.readouterr().out == ""
+    assert firewall.legacy_rules == []
+
+
+def test_missing_rules_still_reported(monkeypatch, capsys):
+    commands = fake_iptables(monkeypatch, [])
+    firewall = IptablesFirewall()
+    firewall.teardown_network(NETWORK)
+    assert not firewall.commit(exit_if_error=False)
+    assert "line 2 failed" in capsys.readouterr().out
+    assert ["iptables", "--wait", "-t", "nat", "-D", "POSTROUTING"] == commands[-1][:6]
@@ -0,0 +1,43 @@
+import os
+import stat
+import tarfile
+
+import pytest
+
+from container.extractor import OPAQUE_XATTR, Extractor
+from container.layer_store import LayerStore
+
+pytestmark = pytest.mark.skipif(
+    os.geteuid() != 0, reason="whiteouts and trusted xattrs require root"
+)
+
+
+def test_diff_converts_whiteouts(tmp_path):
+    upper = tmp_path / "upper"
+    (upper / "etc").mkdir(parents=True)
+    (upper / "etc" / "hostname").write_text("box\n")
+    # overlayfs 用 0:0 的字符设备表示删除，用 opaque xattr 表示目录被整个替换
+    os.mknod(upper / "etc" / "motd", 0o600 | stat.S_IFCHR, os.makedev(0, 0))
+    (upper / "var").mkdir()
+    os.setxattr(upper / "var", OPAQUE_XATTR, b"y")
+    tar_path = str(tmp_path / "layer.tar")
+    LayerStore.diff(str(upper), tar_path)
+    with tarfile.open(tar_path) as tar:
+        members = {member.name: member for member in tar}
+    assert sorted(members) == [
+        "etc",
+        "etc/.wh.motd",
+        "etc/hostname",
+        "var",
+        "var/.wh..wh..opq",
+    ]
+    assert members["etc/.wh.motd"].isreg()
+    assert members["var/.wh..wh..opq"].isreg()
+
+    # 解压时再转换回 overlayfs 的格式
+    lower = tmp_path / "lower"
+    Extractor(str(lower), whiteouts=True).extract(tar_path)
+    st = os.lstat(lower / "etc" / "motd")
+    assert stat.S_ISCHR(st.st_mode) and st.st_rdev == os.makedev(0, 0)
+    assert (lower / "etc" / "hostname").read_text() == "box\n"
+    assert os.getxattr(lower / "var", OPAQUE_XATTR) == b"y"
@@ -0,0 +1,55 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+
+from container.logger import LogReader
+
+base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 和 run -d 一样：打开日志驱动，fork 出还在运行的“容器”进程，启动 shim 之后 mydocker 退出
+run_detached = textwrap.dedent("""
+    import os, sys, time
+    sys.path.insert(0, sys.argv[1])
+    from container.logger import log_drivers
+
+    driver = log_drivers["json-file"](sys.argv[2])
+    driver.open()
+    pid = os.fork()
+    if pid == 0:
+        driver.redirect()
+        print("hello", flush=True)
+        time.sleep(30)
+        os._exit(0)
+    # mydockerd 的工作进程还拿着和客户端的连接，shim 不能继承
+    connection = os.dup(1)
+    driver.start()
+    print(pid, flush=True)
+    """)
+
+
+def test_run_detached_output_reaches_eof(tmp_path):
+    log_path = str(tmp_path / "c" / "c-json.log")
+    start = time.monotonic()
+    # 有进程还拿着 stdout 的写端时 communicate 会一直等到超时
+    result = subprocess.run(
+        [sys.executable, "-c", run_detached, base_path, log_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=10,
+    )
+    container_pid = int(result.stdout)
+    try:
+        assert time.monotonic() - start < 5
+        os.kill(container_pid, 0)
+    finally:
+        os.kill(container_pid, signal.SIGKILL)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if os.path.exists(log_path) and os.path.getsize(log_path):
+            break
+        time.sleep(0.05)
+    with open(log_path, "rb") as f:
+        assert LogReader.parse_line(f.readline())[1:] == ("stdout", "hello\n")
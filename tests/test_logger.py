@@ -0,0 +1,91 @@
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from container.logger import LogReader
+
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def entry(i):
+    time = (start + timedelta(seconds=i)).isoformat()
+    return json.dumps({"log": f"line {i}\n", "stream": "stdout", "time": time}) + "\n"
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    # 轮转后的分段从旧到新：.2.gz、.1、当前文件
+    path = tmp_path / "c-json.log"
+    with gzip.open(f"{path}.2.gz", "wt") as f:
+        f.write("".join(entry(i) for i in range(0, 3)))
+    with open(f"{path}.1", "w") as f:
+        f.write("".join(entry(i) for i in range(3, 6)))
+    with open(path, "w") as f:
+        f.write("".join(entry(i) for i in range(6, 8)))
+    return str(path)
+
+
+def lines(*numbers):
+    return "".join(f"line {i}\n" for i in numbers)
+
+
+def test_segments(log_path):
+    assert LogReader(log_path).segments() == [
+        f"{log_path}.2.gz",
+        f"{log_path}.1",
+        log_path,
+    ]
+
+
+@pytest.mark.parametrize(
+    "tail, expected",
+    [(0, []), (1, [7]), (2, [6, 7]), (4, [4, 5, 6, 7]), (7, list(range(1, 8)))],
+)
+def test_tail(log_path, capsys, tail, expected):
+    LogReader(log_path).print(tail=tail)
+    assert capsys.readouterr().out == lines(*expected)
+
+
+def test_tail_more_than_available(log_path, capsys):
+    LogReader(log_path).print(tail=100)
+    assert capsys.readouterr().out == lines(*range(8))
+
+
+@pytest.mark.parametrize(
+    "since, expected",
+    [(-10, range(8)), (0, range(8)), (1, range(1, 8)), (4, range(4, 8)), (7, [7])],
+)
+def test_since(log_path, capsys, since, expected):
+    LogReader(log_path).print(since=(start + timedelta(seconds=since)).isoformat())
+    assert capsys.readouterr().out == lines(*expected)
+
+
+def test_since_after_last(log_path, capsys):
+    LogReader(log_path).print(since=(start + timedelta(seconds=60)).isoformat())
+    assert capsys.readouterr().out == ""
+
+
+def test_since_until_and_tail(log_path, capsys):
+    LogReader(log_path).print(
+        since=(start + timedelta(seconds=2)).isoformat(),
+        until=(start + timedelta(seconds=5)).isoformat(),
+    )
+    assert capsys.readouterr().out == lines(2, 3, 4, 5)
+    # tail 和 since 同时指定时取两者中更靠后的位置
+    LogReader(log_path).print(tail=6, since=(start + timedelta(seconds=4)).isoformat())
+    assert capsys.readouterr().out == lines(4, 5, 6, 7)
+    LogReader(log_path).print(tail=2, since=(start + timedelta(seconds=1)).isoformat())
+    assert capsys.readouterr().out == lines(6, 7)
+
+
+def test_since_in_large_segment(tmp_path, capsys):
+    # 分段大于 BLOCK_SIZE 时按时间二分查找起始位置
+    path = tmp_path / "c-json.log"
+    with open(f"{path}.1", "w") as f:
+        f.write("".join(entry(i) for i in range(5000)))
+    with open(path, "w") as f:
+        f.write(entry(5000))
+    LogReader(str(path)).print(since=(start + timedelta(seconds=4321)).isoformat())
+    assert capsys.readouterr().out == lines(*range(4321, 5001))
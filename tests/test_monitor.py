@@ -0,0 +1,84 @@
+import json
+import os
+import select
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+
+from container import monitor
+from container.monitor import EventMonitor
+from container.state_store import StateStore
+
+base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 容器还在运行、cgroup 还没有出现时监控进程一直等待，mydocker 已经退出
+start_monitor = textwrap.dedent("""
+    import os, sys, time
+    sys.path.insert(0, sys.argv[1])
+    from container.monitor import EventMonitor
+
+    pid = os.fork()
+    if pid == 0:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for i in range(3):
+            os.dup2(devnull, i)
+        time.sleep(30)
+        os._exit(0)
+    connection = os.dup(1)
+    EventMonitor.start("c", pid, sys.argv[2], sys.argv[3])
+    print(pid, flush=True)
+    """)
+
+
+def test_start_detaches_stdio(tmp_path):
+    start = time.monotonic()
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            start_monitor,
+            base_path,
+            str(tmp_path / "cgroup"),
+            str(tmp_path / "events.log"),
+        ],
+        stdout=subprocess.PIPE,
+        timeout=10,
+    )
+    container_pid = int(result.stdout)
+    try:
+        assert time.monotonic() - start < 5
+    finally:
+        os.kill(container_pid, signal.SIGKILL)
+
+
+def test_memory_events(tmp_path, monkeypatch):
+    # 用普通目录代替 cgroup：没有 PSI 文件，memory.events 的变化通过 inotify 通知
+    store = StateStore(str(tmp_path / "state.db"))
+    store.put("c", {"ID": "c", "STATUS": "running"})
+    monkeypatch.setattr(monitor, "StateStore", lambda: StateStore(store.path))
+    cgroup_path = tmp_path / "cgroup"
+    cgroup_path.mkdir()
+    events = cgroup_path / "memory.events"
+    events.write_text("low 0\nhigh 0\nmax 0\noom 0\noom_kill 0\n")
+    events_path = tmp_path / "events.log"
+    event_monitor = EventMonitor("c", os.getpid(), str(cgroup_path), str(events_path))
+    # 和 mydockerd 一样把监控 fd 注册到 epoll 中
+    epoll = select.epoll()
+    fds = event_monitor.open(os.open(cgroup_path, os.O_RDONLY | os.O_DIRECTORY))
+    for fd, mask in fds.items():
+        epoll.register(fd, mask)
+    events.write_text("low 0\nhigh 3\nmax 0\noom 1\noom_kill 1\n")
+    for fd, _ in epoll.poll(5):
+        event_monitor.handle(fd)
+    events.write_text("low 0\nhigh 4\nmax 0\noom 1\noom_kill 1\n")
+    event_monitor.close()
+    epoll.close()
+    recorded = [json.loads(line)["event"] for line in open(events_path)]
+    assert recorded == ["memory_high", "memory_oom", "memory_oom_kill", "memory_high"]
+    assert store.get("c")["EVENTS"] == {
+        "memory_high": 4,
+        "memory_oom": 1,
+        "memory_oom_kill": 1,
+    }
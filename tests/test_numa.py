@@ -0,0 +1,20 @@
+from container.numa import format_cpulist, parse_cpulist
+
+
+def test_parse_cpulist():
+    assert parse_cpulist("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpulist("5") == [5]
+    assert parse_cpulist("") == []
+    assert parse_cpulist("\n") == []
+
+
+def test_format_cpulist():
+    assert format_cpulist([0, 1, 2, 3, 8, 10, 11]) == "0-3,8,10-11"
+    assert format_cpulist([7, 3, 1, 2, 2]) == "1-3,7"
+    assert format_cpulist([4]) == "4"
+    assert format_cpulist([]) == ""
+
+
+def test_roundtrip():
+    for cpulist in ["0", "0-63", "0,2,4,6", "1-2,4-5,9"]:
+        assert format_cpulist(parse_cpulist(cpulist)) == cpulist
@@ -0,0 +1,66 @@
+import os
+
+from container import container as container_module
+from container import pool
+from container.container import Container
+from container.pool import SandboxPool
+
+
+def make_sandbox(overlay_root, sandbox_id, upper_size, merged_size):
+    sandbox_dir = os.path.join(overlay_root, sandbox_id)
+    for name in ("upper", "work", "merged"):
+        os.makedirs(os.path.join(sandbox_dir, name))
+    with open(os.path.join(sandbox_dir, "upper", "data"), "wb") as f:
+        f.write(os.urandom(upper_size))
+    # merged 里是只读层和 upper 合并后的内容，不能算进沙箱的占用
+    with open(os.path.join(sandbox_dir, "merged", "rootfs"), "wb") as f:
+        f.write(os.urandom(merged_size))
+    return {
+        "ID": sandbox_id,
+        "KEY": SandboxPool.key("test", None),
+        "PID": os.getpid(),
+        "START_TIME": None,
+    }
+
+
+def test_disk_usage_counts_upper_only(tmp_path):
+    overlay_root = str(tmp_path / "overlay")
+    sandbox = make_sandbox(overlay_root, "a", 64 << 10, 4 << 20)
+    usage = SandboxPool.disk_usage([sandbox], overlay_root)
+    assert 64 << 10 <= usage < 1 << 20
+
+
+def fill(tmp_path, monkeypatch, upper_size, merged_size):
+    overlay_root = str(tmp_path / "overlay")
+    pool_root = str(tmp_path / "pool")
+
+    class TmpSandboxPool(SandboxPool):
+        def __init__(self) -> None:
+            super().__init__(pool_root)
+
+    os.makedirs(pool_root)
+    TmpSandboxPool().add(make_sandbox(overlay_root, "a", upper_size, merged_size))
+    created = []
+
+    def create_sandbox(image_name, network):
+        sandbox_id = f"new{len(created)}"
+        created.append(sandbox_id)
+        return make_sandbox(overlay_root, sandbox_id, upper_size, merged_size)
+
+    monkeypatch.setattr(pool, "SandboxPool", TmpSandboxPool)
+    monkeypatch.setattr(pool, "default_pool_disk", "1m")
+    monkeypatch.setattr(pool, "default_pool_memory", "1t")
+    monkeypatch.setattr(container_module, "overlay_path", overlay_root)
+    monkeypatch.setattr(Container, "create_sandbox", staticmethod(create_sandbox))
+    Container.pool_fill("test", None, 3)
+    return created
+
+
+def test_pool_fill_ignores_merged(tmp_path, monkeypatch):
+    # 每个沙箱只写了 64k，merged 再大也不影响预算
+    assert fill(tmp_path, monkeypatch, 64 << 10, 4 << 20) == ["new0", "new1"]
+
+
+def test_pool_fill_stops_at_disk_budget(tmp_path, monkeypatch, capsys):
+    assert fill(tmp_path, monkeypatch, 600 << 10, 0) == []
+    assert "pool budget exhausted" in capsys.readouterr().out
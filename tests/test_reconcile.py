@@ -0,0 +1,40 @@
+import os
+
+from container.container import Container
+from container.state_store import StateStore
+from utility import proc_start_time
+
+
+def test_reconcile_deletes_placements_of_killed_runs(tmp_path, monkeypatch):
+    store = StateStore(str(tmp_path / "state.db"))
+    monkeypatch.setattr(Container, "_state_store", store)
+    monkeypatch.setattr(Container, "_state_pid", os.getpid())
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    start_time = proc_start_time(os.getpid())
+    rows = {
+        "live": {"OWNER_PID": os.getpid(), "OWNER_START_TIME": start_time},
+        "killed": {"OWNER_PID": pid, "OWNER_START_TIME": start_time},
+        # 旧版本写入的占位没有记录启动进程
+        "legacy": {},
+    }
+    for container_id, owner in rows.items():
+        store.put(
+            container_id,
+            {"ID": container_id, "STATUS": "created", "CPUSET": "0", **owner},
+        )
+    store.put(
+        "running",
+        {
+            "ID": "running",
+            "STATUS": "running",
+            "PID": os.getpid(),
+            "START_TIME": start_time,
+        },
+    )
+    containers = Container.reconcile(store.list())
+    assert [c["ID"] for c in containers] == ["live", "running"]
+    assert [c["ID"] for c in store.list()] == ["live", "running"]
+    assert store.get("running")["STATUS"] == "running"
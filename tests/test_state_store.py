@@ -0,0 +1,22 @@
+from container.state_store import StateStore
+
+
+def test_list_keeps_creation_order_after_update(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    for container_id in ["a", "b", "c"]:
+        store.put(container_id, {"ID": container_id, "STATUS": "running"})
+    store.update("a", {"STATUS": "exited"})
+    store.update_many({"b": {"STATUS": "exited"}})
+    store.mark_released(["a"])
+    assert [c["ID"] for c in store.list()] == ["a", "b", "c"]
+    assert [c["ID"] for c in store.list("exited")] == ["a", "b"]
+    assert store.get("a") == {"ID": "a", "STATUS": "exited", "RELEASED": True}
+
+
+def test_delete_many(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    for container_id in ["a", "b", "c"]:
+        store.put(container_id, {"ID": container_id, "STATUS": "running"})
+    store.delete_many(["a", "c"])
+    assert [c["ID"] for c in store.list()] == ["b"]
+    assert store.get("a") == {}
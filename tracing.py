@@ -0,0 +1,130 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+# 设置了 MYDOCKER_TRACE 时记录各个阶段的耗时，没有设置时 traced 直接返回原函数，span 返回同一个空上下文，
+# 几乎没有开销
+enabled = bool(os.environ.get("MYDOCKER_TRACE"))
+# 追踪文件的路径通过环境变量传给 fork/execve 之后的子进程，子进程的 span 追加到同一个文件
+trace_file_env = "MYDOCKER_TRACE_FILE"
+# 还不知道容器 ID 时产生的事件先缓存起来，set_output 之后再写入
+pending = []
+null_span = nullcontext()
+# getpid -> 追踪文件的 fd
+output_fds = {}
+# getpid -> 宿主机上的 pid
+host_pids = {}
+
+
+def set_output(path):
+    # Chrome trace event 的 JSON 数组格式允许省略结尾的 ]，每个进程以 O_APPEND 追加一行一个事件，
+    # 不需要在进程之间协调；只在 run 的进程中创建文件，子进程从环境变量中拿到路径
+    if not enabled:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("[\n")
+    os.environ[trace_file_env] = path
+    events = list(pending)
+    pending.clear()
+    for event in events:
+        write(event)
+
+
+def output_fd():
+    # 每个进程打开一次追踪文件；容器的 init 进程在 pivot_root 之后就看不到宿主机上的路径了，
+    # 所以在 span 开始时就打开并缓存 fd，O_CLOEXEC 保证不会泄漏给容器中的命令
+    pid = os.getpid()
+    if pid not in output_fds:
+        path = os.environ.get(trace_file_env)
+        if path is None:
+            return None
+        output_fds[pid] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CLOEXEC)
+        # 每个进程第一次写入时记录进程名，chrome://tracing 中按进程分组显示
+        write(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": host_pid(),
+                "args": {"name": " ".join(sys.argv[1:2]) or sys.argv[0]},
+            }
+        )
+    return output_fds[pid]
+
+
+def write(event):
+    fd = output_fd()
+    if fd is None:
+        pending.append(event)
+        return
+    os.write(fd, (json.dumps(event) + ",\n").encode())
+
+
+@contextmanager
+def record(name, args):
+    # 时间戳用 CLOCK_MONOTONIC，所有进程共用同一个时钟，单位是 chrome trace 要求的微秒
+    pid = host_pid()
+    output_fd()
+    start = time.monotonic_ns()
+    try:
+        yield
+    finally:
+        end = time.monotonic_ns()
+        write(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (end - start) / 1000,
+                "pid": pid,
+                "tid": pid,
+                "args": args,
+            }
+        )
+
+
+def host_pid():
+    # pid namespace 中的子进程 getpid 得到 1，用宿主机上的 pid 区分不同进程：
+    # /proc 还是宿主机的 proc 时 /proc/self 指向宿主机上的 pid，每个进程只读一次
+    pid = os.getpid()
+    if pid not in host_pids:
+        try:
+            host_pids[pid] = int(os.readlink("/proc/self"))
+        except (OSError, ValueError):
+            host_pids[pid] = pid
+    return host_pids[pid]
+
+
+def span(name, **args):
+    if not enabled:
+        return null_span
+    return record(name, args)
+
+
+def traced(name=None):
+    # 函数装饰器，没有开启追踪时原样返回函数
+    def decorator(func):
+        if not enabled:
+            return func
+        span_name = name or func.__qualname__
+
+        def wrapper(*args, **kwargs):
+            with record(span_name, {}):
+                return func(*args, **kwargs)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__qualname__ = func.__qualname__
+        return wrapper
+
+    return decorator
+
+
+def load_trace(path):
+    # 按 JSON 数组格式读取，补上可能缺失的结尾
+    with open(path) as f:
+        content = f.read().rstrip().rstrip(",")
+    if not content.endswith("]"):
+        content += "]"
+    return json.loads(content)
@@ -1,10 +1,12 @@
 import ctypes
-import ctypes.util
+import fcntl
 import os
 import subprocess
 import sys
+from contextlib import contextmanager
 
-libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+# 直接使用进程中已经加载的 libc，ctypes.util.find_library 会启动 ldconfig 子进程查找，很慢
+libc = ctypes.CDLL(None, use_errno=True)
 libc.mount.argtypes = (
     ctypes.c_char_p,
     ctypes.c_char_p,
@@ -35,6 +37,8 @@ def mount(source, target, fs, mountflags, options=""):
 
 
 def umount(target, flags=None):
+    if isinstance(target, str):
+        target = target.encode()
     ret = 0
     if flags is None:
         ret = libc.umount(target)
@@ -61,3 +65,147 @@ def shell(command, exit_if_error=True):
         print(result.stderr)
         sys.exit(1)
     return result.stdout
+
+
+@contextmanager
+def file_lock(path):
+    # 通过 flock 对同一个文件的读-改-写加排他锁，防止多个 mydocker 进程并发修改
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield fd
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def parse_size(size):
+    # 将 100m、10g 这样的字符串转换成字节数
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+    size = str(size).strip().lower().rstrip("b")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    # 将字节数转换成 1.5MiB 这样便于阅读的字符串
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.4g}{unit}"
+        size /= 1024
+    return f"{size:.4g}TiB"
+
+
+def proc_start_time(pid):
+    # 读取 /proc/<pid>/stat 中的进程启动时间（第 22 个字段），和记录的值对比可以识别 PID 复用
+    # 进程不存在或者已经是僵尸进程时返回 None
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    fields = stat[stat.rindex(b")") + 2 :].split()
+    if fields[0] in (b"Z", b"X"):
+        return None
+    return int(fields[19])
+
+
+def format_table(rows, headers):
+    # 和 tabulate 的 simple 格式一样的输出，行数很多时比 tabulate 快得多
+    widths = [len(h) for h in headers]
+    for row in rows:
+        for i, cell in enumerate(row):
+            widths[i] = max(widths[i], len(cell))
+    fmt = "  ".join(f"{{:<{w}}}" for w in widths)
+    lines = [fmt.format(*headers).rstrip(), "  ".join("-" * w for w in widths)]
+    lines.extend(fmt.format(*row).rstrip() for row in rows)
+    return "\n".join(lines)
+
+
+# inotify 事件类型，见 <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+libc.inotify_init1.argtypes = [ctypes.c_int]
+libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+
+def inotify_init():
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+    return fd
+
+
+def inotify_add_watch(fd, path, mask):
+    wd = libc.inotify_add_watch(fd, path.encode(), mask)
+    if wd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"inotify_add_watch {path} failed: {os.strerror(errno)}")
+    return wd
+
+
+# statfs 返回的文件系统类型，见 <linux/magic.h>
+TMPFS_MAGIC = 0x01021994
+CGROUP_SUPER_MAGIC = 0x27E0EB
+CGROUP2_SUPER_MAGIC = 0x63677270
+libc.statfs.argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+
+
+def statfs_type(path):
+    # struct statfs 的第一个字段就是 f_type，os.statvfs 拿不到这个字段
+    buf = ctypes.create_string_buffer(256)
+    if libc.statfs(path.encode(), buf) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"statfs {path} failed: {os.strerror(errno)}")
+    return ctypes.c_long.from_buffer(buf).value
+
+
+PR_SET_CHILD_SUBREAPER = 36
+
+
+def set_child_subreaper():
+    # 成为子孙进程的收养者：中间进程退出后，孤儿进程交给当前进程而不是 init 回收
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"prctl failed: {os.strerror(errno)}")
+
+
+def detach_stdio(keep=()):
+    # fork 之后不 execve 的常驻进程（日志 shim、事件监控、回收进程等）会继承调用者所有的 fd：
+    # 标准输入输出换成 /dev/null，keep 以外的 fd 都关闭，否则调用者的管道、mydockerd 工作进程和客户端的连接
+    # 要等这个进程退出才会关闭
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for i in range(3):
+        os.dup2(devnull, i)
+    for fd in [int(fd) for fd in os.listdir("/proc/self/fd")]:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                # listdir 自己打开的目录 fd 已经关闭了
+                pass
+
+
+# ioprio_set 没有 libc 封装，只能通过 syscall 调用，系统调用号和架构有关
+SYS_ioprio_set = {"x86_64": 251, "aarch64": 30}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def set_idle_io_priority():
+    # 当前进程只在磁盘空闲时才能得到 IO 时间，返回是否设置成功
+    nr = SYS_ioprio_set.get(os.uname().machine)
+    if nr is None:
+        return False
+    return (
+        libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        == 0
+    )